@@ -1,5 +1,5 @@
 from fastapi import FastAPI, Depends, HTTPException, Request
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, Response
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 import uvicorn
@@ -9,6 +9,13 @@ from typing import List, Dict, Any
 from pydantic import BaseModel
 from datetime import datetime
 
+from create_database import (
+    CATEGORY_STATS_SQL, COUNTERS_SQL, TOP_DOMAINS_SQL, TOP_SENDERS_SQL, get_bodies, get_email_categories,
+    migrate_database
+)
+from pagination import count_emails, fetch_page, page_links
+from search import make_match_query
+
 # Создаем FastAPI приложение
 app = FastAPI(title="Email Manager")
 
@@ -19,6 +26,12 @@ DB_PATH = "email_database.db"
 if not os.path.exists(DB_PATH):
     raise Exception(f"База данных {DB_PATH} не найдена. Запустите create_database.py для создания базы данных.")
 
+# Обновляем схему базы данных один раз при запуске: запросы приложения
+# используют таблицы email_stats, emails_fts, email_bodies и senders
+conn = sqlite3.connect(DB_PATH)
+migrate_database(conn)
+conn.close()
+
 # Создаем директорию для шаблонов, если её нет
 templates_dir = os.path.join(os.path.dirname(__file__), "templates")
 os.makedirs(templates_dir, exist_ok=True)
@@ -101,6 +114,10 @@ body {
     color: white;
     border-radius: 5px;
 }
+.pagination span {
+    color: #666;
+    padding: 8px 16px;
+}
 .search-form {
     margin-bottom: 20px;
 }
@@ -220,7 +237,8 @@ with open(os.path.join(templates_dir, "emails.html"), "w") as f:
 {% block content %}
 <div class="card">
     <form class="search-form" action="/emails" method="get">
-        <input type="text" name="query" placeholder="Поиск по теме или отправителю" class="search-input" value="{{ query }}">
+        <input type="text" name="query" placeholder="Поиск по теме, отправителю и тексту письма" class="search-input" value="{{ query }}">
+        <label><input type="checkbox" name="syntax" value="true" {% if syntax %}checked{% endif %}> Синтаксис FTS5</label>
         <button type="submit" class="search-button">Поиск</button>
     </form>
     
@@ -230,7 +248,7 @@ with open(os.path.join(templates_dir, "emails.html"), "w") as f:
             <div class="email-subject">{{ email.subject }}</div>
             <div class="email-sender">От: {{ email.sender }}</div>
             <div class="email-date">Дата: {{ email.date }}</div>
-            <div class="email-body">{{ email.body[:200] }}{% if email.body|length > 200 %}...{% endif %}</div>
+            <div class="email-body">{{ email.preview }}</div>
             {% if email.categories %}
             <div class="email-categories">
                 {% for category in email.categories %}
@@ -245,16 +263,24 @@ with open(os.path.join(templates_dir, "emails.html"), "w") as f:
     </div>
     
     <div class="pagination">
-        {% if page > 1 %}
-        <a href="/emails?page={{ page - 1 }}&query={{ query }}">&laquo; Предыдущая</a>
+        {% if prev_cursor %}
+        <a href="/emails?cursor={{ prev_cursor }}&page={{ page - 1 }}&query={{ query|urlencode }}{% if syntax %}&syntax=true{% endif %}">&laquo; Предыдущая</a>
         {% endif %}
         
-        {% for p in range(1, total_pages + 1) %}
-        <a href="/emails?page={{ p }}&query={{ query }}" class="{{ 'active' if p == page else '' }}">{{ p }}</a>
+        {% for link in page_links %}
+        {% if link is none %}
+        <span>&hellip;</span>
+        {% elif link.current %}
+        <a class="active">{{ link.page }}</a>
+        {% else %}
+        <a href="/emails?{% if link.cursor %}cursor={{ link.cursor }}&{% endif %}page={{ link.page }}&query={{ query|urlencode }}{% if syntax %}&syntax=true{% endif %}">{{ link.page }}</a>
+        {% endif %}
         {% endfor %}
         
-        {% if page < total_pages %}
-        <a href="/emails?page={{ page + 1 }}&query={{ query }}">Следующая &raquo;</a>
+        <span>Страница {{ page }} из {% if not total_exact %}более чем {% endif %}{{ total_pages }}</span>
+        
+        {% if next_cursor %}
+        <a href="/emails?cursor={{ next_cursor }}&page={{ page + 1 }}&query={{ query|urlencode }}{% if syntax %}&syntax=true{% endif %}">Следующая &raquo;</a>
         {% endif %}
     </div>
 </div>
@@ -318,6 +344,13 @@ with open(os.path.join(templates_dir, "stats.html"), "w") as f:
         <li>{{ sender.sender }}: {{ sender.count }} писем</li>
         {% endfor %}
     </ul>
+    
+    <h2>Топ доменов отправителей</h2>
+    <ul>
+        {% for domain in stats.top_domains %}
+        <li>{{ domain.domain }}: {{ domain.count }} писем</li>
+        {% endfor %}
+    </ul>
 </div>
 {% endblock %}
     """)
@@ -336,29 +369,17 @@ def get_db_connection():
 def get_statistics():
     conn = get_db_connection()
     
-    # Общее количество писем
-    total_emails = conn.execute("SELECT COUNT(*) FROM emails").fetchone()[0]
-    
-    # Количество обработанных писем
-    processed_emails = conn.execute("SELECT COUNT(*) FROM emails WHERE is_processed = 1").fetchone()[0]
+    # Общее количество писем и количество обработанных писем - из счетчиков email_stats
+    total_emails, processed_emails = conn.execute(COUNTERS_SQL).fetchone()
     
     # Количество писем по категориям
-    categories_stats = conn.execute("""
-        SELECT c.name, COUNT(ec.email_id) as count
-        FROM categories c
-        LEFT JOIN email_categories ec ON c.id = ec.category_id
-        GROUP BY c.id
-        ORDER BY count DESC
-    """).fetchall()
+    categories_stats = conn.execute(CATEGORY_STATS_SQL + " ORDER BY count DESC").fetchall()
     
     # Количество писем по отправителям
-    senders_stats = conn.execute("""
-        SELECT sender, COUNT(*) as count
-        FROM emails
-        GROUP BY sender
-        ORDER BY count DESC
-        LIMIT 5
-    """).fetchall()
+    senders_stats = conn.execute(TOP_SENDERS_SQL, (5,)).fetchall()
+    
+    # Количество писем по доменам отправителей
+    domains_stats = conn.execute(TOP_DOMAINS_SQL, (5,)).fetchall()
     
     conn.close()
     
@@ -367,7 +388,8 @@ def get_statistics():
         "processed_emails": processed_emails,
         "unprocessed_emails": total_emails - processed_emails,
         "categories": [{"name": row["name"], "count": row["count"]} for row in categories_stats],
-        "top_senders": [{"sender": row["sender"], "count": row["count"]} for row in senders_stats]
+        "top_senders": [{"sender": row["sender"], "count": row["count"]} for row in senders_stats],
+        "top_domains": [{"domain": row["domain"], "count": row["count"]} for row in domains_stats]
     }
 
 # Маршрут для главной страницы
@@ -378,58 +400,60 @@ async def read_root(request: Request):
 
 # Маршрут для страницы писем
 @app.get("/emails", response_class=HTMLResponse)
-async def read_emails(request: Request, page: int = 1, query: str = ""):
+async def read_emails(request: Request, page: int = 1, query: str = "", syntax: bool = False, cursor: str = ""):
+    """
+    Список писем; переход между страницами - по курсору (параметр cursor).
+    Номер страницы page без курсора открывает страницу через OFFSET - только первые
+    PAGE_WINDOW + 1 страниц (pagination.PAGE_WINDOW), дальше - ошибка 400
+    """
     conn = get_db_connection()
     
     # Количество писем на странице
     per_page = 10
-    
-    # Строим SQL запрос
-    sql = "SELECT e.id, e.subject, e.sender, e.date, e.body FROM emails e"
-    params = []
-    
-    # Добавляем условие поиска, если есть запрос
-    if query:
-        sql += " WHERE e.subject LIKE ? OR e.sender LIKE ?"
-        params.extend([f"%{query}%", f"%{query}%"])
-    
-    # Добавляем сортировку и пагинацию
-    sql += " ORDER BY e.date DESC LIMIT ? OFFSET ?"
-    params.extend([per_page, (page - 1) * per_page])
-    
-    # Выполняем запрос
-    emails_data = conn.execute(sql, params).fetchall()
-    
-    # Получаем категории для каждого письма
-    emails = []
-    for email in emails_data:
-        # Получаем категории письма
-        categories = conn.execute("""
-            SELECT c.name FROM categories c
-            JOIN email_categories ec ON c.id = ec.category_id
-            WHERE ec.email_id = ?
-        """, (email["id"],)).fetchall()
-        
-        # Формируем данные о письме
-        emails.append({
+    page = max(page, 1)
+    
+    # Полнотекстовый поиск, если есть запрос; результаты - по релевантности
+    match = make_match_query(query, syntax) if query else None
+    
+    # Получаем страницу писем от курсора
+    try:
+        emails_data, next_cursor, prev_cursor = fetch_page(
+            conn, per_page, match, cursor or None, (page - 1) * per_page
+        )
+    except ValueError as e:
+        conn.close()
+        raise HTTPException(status_code=400, detail=str(e))
+    except sqlite3.OperationalError as e:
+        conn.close()
+        # Запрос на языке FTS5 пишет пользователь, и в нем может быть ошибка
+        if match and syntax:
+            raise HTTPException(status_code=400, detail=f"Ошибка в поисковом запросе: {e}")
+        raise
+    if prev_cursor is None:
+        page = 1
+    
+    # Получаем категории всех писем страницы одним запросом
+    categories = get_email_categories(conn, [email["id"] for email in emails_data])
+    
+    # Формируем данные о письмах
+    emails = [
+        {
             "id": email["id"],
             "subject": email["subject"],
             "sender": email["sender"],
             "date": email["date"],
-            "body": email["body"],
-            "categories": [category["name"] for category in categories]
-        })
-    
-    # Получаем общее количество писем для пагинации
-    count_sql = "SELECT COUNT(*) FROM emails"
-    count_params = []
-    
-    if query:
-        count_sql += " WHERE subject LIKE ? OR sender LIKE ?"
-        count_params.extend([f"%{query}%", f"%{query}%"])
+            "preview": email["preview"] or "",
+            "categories": categories[email["id"]]
+        }
+        for email in emails_data
+    ]
     
-    total_emails = conn.execute(count_sql, count_params).fetchone()[0]
+    # Получаем количество писем для пагинации: из счетчиков или из кэша найденных писем.
+    # Если найдено больше COUNT_LIMIT писем, количество страниц - оценка снизу
+    total_emails, total_exact = count_emails(conn, match)
     total_pages = (total_emails + per_page - 1) // per_page
+    if not total_exact:
+        total_pages = max(total_pages, page)
     
     conn.close()
     
@@ -440,7 +464,12 @@ async def read_emails(request: Request, page: int = 1, query: str = ""):
             "emails": emails, 
             "page": page, 
             "total_pages": total_pages,
-            "query": query
+            "total_exact": total_exact,
+            "page_links": page_links(page, total_pages, per_page, next_cursor, prev_cursor),
+            "next_cursor": next_cursor,
+            "prev_cursor": prev_cursor,
+            "query": query,
+            "syntax": syntax
         }
     )
 
@@ -450,13 +479,7 @@ async def read_categories(request: Request):
     conn = get_db_connection()
     
     # Получаем категории с количеством писем
-    categories = conn.execute("""
-        SELECT c.id, c.name, c.description, COUNT(ec.email_id) as count
-        FROM categories c
-        LEFT JOIN email_categories ec ON c.id = ec.category_id
-        GROUP BY c.id
-        ORDER BY c.name
-    """).fetchall()
+    categories = conn.execute(CATEGORY_STATS_SQL + " ORDER BY c.name").fetchall()
     
     conn.close()
     
@@ -484,44 +507,60 @@ async def read_stats(request: Request):
 
 # API маршрут для получения писем в формате JSON
 @app.get("/api/emails")
-async def api_emails(page: int = 1, limit: int = 10, query: str = ""):
+async def api_emails(response: Response, page: int = 1, limit: int = 10, query: str = "", syntax: bool = False,
+                     cursor: str = ""):
+    """
+    Список писем; с параметром query - полнотекстовый поиск по теме, отправителю и телу письма.
+    При syntax=true запрос задается на языке запросов FTS5 (OR, NOT, "фраза", префикс*, subject: ...)
+    
+    Курсоры соседних страниц возвращаются в заголовках X-Next-Cursor и X-Prev-Cursor
+    и передаются в параметре cursor. Параметр page (страница через OFFSET) оставлен
+    для совместимости и без курсора работает только для первых PAGE_WINDOW + 1 страниц
+    """
     conn = get_db_connection()
     
-    # Строим SQL запрос
-    sql = "SELECT e.id, e.subject, e.sender, e.date, e.body FROM emails e"
-    params = []
-    
-    # Добавляем условие поиска, если есть запрос
-    if query:
-        sql += " WHERE e.subject LIKE ? OR e.sender LIKE ?"
-        params.extend([f"%{query}%", f"%{query}%"])
-    
-    # Добавляем сортировку и пагинацию
-    sql += " ORDER BY e.date DESC LIMIT ? OFFSET ?"
-    params.extend([limit, (page - 1) * limit])
-    
-    # Выполняем запрос
-    emails_data = conn.execute(sql, params).fetchall()
-    
-    # Получаем категории для каждого письма
-    emails = []
-    for email in emails_data:
-        # Получаем категории письма
-        categories = conn.execute("""
-            SELECT c.name FROM categories c
-            JOIN email_categories ec ON c.id = ec.category_id
-            WHERE ec.email_id = ?
-        """, (email["id"],)).fetchall()
-        
-        # Формируем данные о письме
-        emails.append({
+    # Полнотекстовый поиск, если есть запрос; результаты - по релевантности
+    match = make_match_query(query, syntax) if query else None
+    
+    # Получаем страницу писем от курсора
+    try:
+        emails_data, next_cursor, prev_cursor = fetch_page(
+            conn, limit, match, cursor or None, (max(page, 1) - 1) * limit
+        )
+    except ValueError as e:
+        conn.close()
+        raise HTTPException(status_code=400, detail=str(e))
+    except sqlite3.OperationalError as e:
+        conn.close()
+        # Запрос на языке FTS5 пишет пользователь, и в нем может быть ошибка
+        if match and syntax:
+            raise HTTPException(status_code=400, detail=f"Ошибка в поисковом запросе: {e}")
+        raise
+    
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    if prev_cursor:
+        response.headers["X-Prev-Cursor"] = prev_cursor
+    
+    # Получаем категории и тела всех писем страницы - по одному запросу
+    email_ids = [email["id"] for email in emails_data]
+    categories = get_email_categories(conn, email_ids)
+    bodies = get_bodies(conn, email_ids)
+    
+    # Формируем данные о письмах
+    emails = [
+        {
             "id": email["id"],
             "subject": email["subject"],
             "sender": email["sender"],
             "date": email["date"],
-            "body": email["body"],
-            "categories": [category["name"] for category in categories]
-        })
+            "preview": email["preview"] or "",
+            # Полный текст письма, как и раньше; None - тело еще не загружено с сервера
+            "body": bodies[email["id"]],
+            "categories": categories[email["id"]]
+        }
+        for email in emails_data
+    ]
     
     conn.close()
     
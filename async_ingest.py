@@ -0,0 +1,309 @@
+import asyncio
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+
+import create_database
+from mail_to_db import sync_folder_to_database
+from mail_to_json import (
+    EmailWriter, connect_imap, iter_emails_info, mail_port, mail_server, select_folder, search_uids
+)
+
+# Сколько секунд ждать, пока другой поток или процесс освободит базу данных
+DB_TIMEOUT = 60
+
+# Серверы IMAP для известных суффиксов переменных окружения.
+# Основной ящик EMAIL_RU использует сервер и порт из mail_to_json (IMAP_SERVER/IMAP_PORT)
+KNOWN_SERVERS = {
+    "RU": (mail_server, mail_port),
+}
+
+def load_accounts():
+    """
+    Загружает учетные записи из переменных окружения
+
+    Используется та же схема, что и для основного ящика: EMAIL_<ИМЯ> и PASSWORD_<ИМЯ>,
+    например EMAIL_RU/PASSWORD_RU или EMAIL_WORK/PASSWORD_WORK.
+    Дополнительно можно указать IMAP_SERVER_<ИМЯ>, IMAP_PORT_<ИМЯ>,
+    FOLDERS_<ИМЯ> (папки через запятую) и IMAP_CONNECTIONS_<ИМЯ>
+    (максимальное количество одновременных соединений с ящиком).
+
+    Returns:
+        list: Список учетных записей
+    """
+    accounts = []
+    for key, address in sorted(os.environ.items()):
+        if not key.startswith("EMAIL_") or not address:
+            continue
+        name = key[len("EMAIL_"):]
+        password = os.getenv(f"PASSWORD_{name}")
+        if not password:
+            print(f"Для {key} не задан PASSWORD_{name}, ящик пропущен")
+            continue
+
+        domain = address.rsplit("@", 1)[-1]
+        server, port = KNOWN_SERVERS.get(name, (f"imap.{domain}", 993))
+        folders = os.getenv(f"FOLDERS_{name}", "INBOX")
+        accounts.append({
+            "name": name,
+            "email": address,
+            "password": password,
+            "server": os.getenv(f"IMAP_SERVER_{name}", server),
+            "port": int(os.getenv(f"IMAP_PORT_{name}", port)),
+            "folders": [folder.strip() for folder in folders.split(",") if folder.strip()],
+            "max_connections": int(os.getenv(f"IMAP_CONNECTIONS_{name}", "3")),
+        })
+    return accounts
+
+
+class ConnectionPool:
+    """Ограниченный пул IMAP-соединений с одним почтовым ящиком"""
+
+    def __init__(self, account, limit):
+        """
+        Args:
+            account (dict): Учетная запись из load_accounts
+            limit (asyncio.Semaphore): Общее ограничение на число соединений всех ящиков
+        """
+        self.account = account
+        self.limit = limit
+        self.size = account["max_connections"]
+        self.created = 0
+        self.idle = asyncio.Queue()
+        self.connections = []
+
+    def _connect(self):
+        mail = connect_imap(self.account["server"], self.account["port"])
+        mail.login(self.account["email"], self.account["password"])
+        return mail
+
+    async def acquire(self):
+        """
+        Возвращает свободное соединение, открывая новое, пока не достигнут лимит
+
+        Место в общем ограничении limit занимает только открытое соединение - на все
+        время жизни, до close. Ожидание свободного соединения места не занимает:
+        если у ящика уже есть соединения, а общий лимит исчерпан, ждем одно из них.
+        """
+        if not self.idle.empty():
+            return self.idle.get_nowait()
+        if self.created >= self.size or (self.created and self.limit.locked()):
+            return await self.idle.get()
+
+        self.created += 1
+        try:
+            await self.limit.acquire()
+        except BaseException:
+            self.created -= 1
+            raise
+        try:
+            mail = await asyncio.to_thread(self._connect)
+        except BaseException:
+            self.created -= 1
+            self.limit.release()
+            raise
+        self.connections.append(mail)
+        return mail
+
+    def release(self, mail):
+        """Возвращает соединение в пул"""
+        self.idle.put_nowait(mail)
+
+    async def close(self):
+        """Закрывает все соединения пула и освобождает их места в общем ограничении"""
+        for mail in self.connections:
+            try:
+                await asyncio.to_thread(mail.logout)
+            except Exception:
+                pass
+            self.limit.release()
+        self.connections = []
+        self.created = 0
+        self.idle = asyncio.Queue()
+
+
+def _fetch_folder(mail, account, folder, writer, max_emails, batch_size, headers_only, executor):
+    """
+    Синхронно загружает самые новые письма одной папки в файл через выбранное соединение
+
+    Письма не попадают в базу данных, поэтому вложения и исходные письма не сохраняются:
+    в хранилище вложений и архиве они остались бы без ссылок на них.
+
+    Returns:
+        int: Количество полученных писем или None, если папка не выбрана
+    """
+    uidvalidity = select_folder(mail, folder)
+    if uidvalidity is None:
+        return None
+
+    uids = search_uids(mail, None, uidvalidity)
+    if uids is None:
+        return 0
+
+    count = 0
+    for email_info in iter_emails_info(mail, uids[::-1][:max_emails], folder, account["email"], headers_only,
+                                       batch_size, executor, store_files=False):
+        writer.write(email_info)
+        count += 1
+    return count
+
+
+def _store_folder(mail, account, folder, writer, max_emails, batch_size, headers_only, executor):
+    """
+    Синхронно загружает новые письма одной папки в базу данных и в файл
+
+    Письма сохраняются пачками, и последний UID фиксируется в одной транзакции
+    с письмами пачки (см. mail_to_db.sync_folder_to_database), поэтому отметка
+    синхронизации не опережает сохраненные письма. Соединение с базой данных
+    открывается в потоке папки: соединения sqlite3 нельзя передавать между потоками.
+
+    Returns:
+        int: Количество полученных писем или None, если папка не выбрана
+    """
+    conn = sqlite3.connect(create_database.DB_PATH, timeout=DB_TIMEOUT)
+    try:
+        result = sync_folder_to_database(mail, conn, folder, account["email"], max_emails, batch_size,
+                                         True, headers_only, executor, writer)
+    finally:
+        conn.close()
+    return sum(result) if result else None
+
+
+async def sync_folder(pool, folder, writer, incremental=False, max_emails=1000, batch_size=200,
+                      headers_only=False, executor=None):
+    """
+    Загружает письма одной папки, занимая соединение из пула
+
+    Args:
+        pool (ConnectionPool): Пул соединений ящика
+        folder (str): Имя папки
+        writer (EmailWriter): Файл, в который записываются письма
+        incremental (bool): Загружать только новые письма и сразу сохранять их в базу данных
+        max_emails (int): Максимальное количество писем из папки
+        batch_size (int): Количество писем в одной команде FETCH
+        headers_only (bool): Загружать только заголовки и размер писем
+        executor (concurrent.futures.Executor): Общий пул процессов для разбора писем
+
+    Returns:
+        int: Количество полученных писем
+    """
+    account = pool.account
+
+    mail = await pool.acquire()
+    try:
+        count = await asyncio.to_thread(
+            _store_folder if incremental else _fetch_folder, mail, account, folder, writer,
+            max_emails, batch_size, headers_only, executor
+        )
+    finally:
+        pool.release(mail)
+
+    if count is None:
+        return 0
+
+    print(f"{account['email']}/{folder}: получено {count} писем")
+    return count
+
+
+async def sync_account(pool, writer, incremental=False, max_emails=1000, batch_size=200,
+                       headers_only=False, executor=None):
+    """
+    Загружает все папки почтового ящика и закрывает его соединения
+
+    Соединения закрываются сразу после загрузки папок ящика, чтобы их места
+    в общем ограничении достались ящикам, которые еще ждут соединения.
+
+    Returns:
+        list: Результат sync_folder для каждой папки (количество писем или исключение)
+    """
+    try:
+        return await asyncio.gather(*[
+            sync_folder(pool, folder, writer, incremental, max_emails, batch_size, headers_only, executor)
+            for folder in pool.account["folders"]
+        ], return_exceptions=True)
+    finally:
+        await pool.close()
+
+
+async def ingest_all(accounts=None, output_file="emails_data.json", max_emails=1000,
+                     batch_size=200, incremental=False, max_total_connections=10,
+                     headers_only=False, parse_workers=0):
+    """
+    Одновременно загружает письма из нескольких папок и почтовых ящиков
+
+    Args:
+        accounts (list): Учетные записи; по умолчанию загружаются из переменных окружения
+        output_file (str): Имя файла для сохранения результатов (.ndjson - по одному письму на строку)
+        max_emails (int): Максимальное количество писем из одной папки
+        batch_size (int): Количество писем в одной команде FETCH
+        incremental (bool): Загружать только новые письма и сразу сохранять их в базу данных
+        max_total_connections (int): Общее ограничение на число IMAP-соединений
+        headers_only (bool): Загружать только заголовки и размер писем
+        parse_workers (int): Количество процессов для разбора писем (0 - разбор в потоках загрузки)
+
+    Returns:
+        bool: True если загрузка выполнена без ошибок
+    """
+    accounts = accounts if accounts is not None else load_accounts()
+    if not accounts:
+        print("Не найдено ни одной учетной записи (EMAIL_<ИМЯ>/PASSWORD_<ИМЯ>)")
+        return False
+
+    if incremental:
+        if not os.path.exists(create_database.DB_PATH):
+            print(f"База данных {create_database.DB_PATH} не найдена. Сначала создайте базу данных.")
+            return False
+        conn = sqlite3.connect(create_database.DB_PATH, timeout=DB_TIMEOUT)
+        create_database.migrate_database(conn)
+        # Папки сохраняются в базу данных одновременно из нескольких потоков
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.close()
+
+    limit = asyncio.Semaphore(max_total_connections)
+    pools = [ConnectionPool(account, limit) for account in accounts]
+    writer = EmailWriter(output_file)
+    executor = ProcessPoolExecutor(max_workers=parse_workers) if parse_workers else None
+
+    try:
+        tasks = [
+            sync_account(pool, writer, incremental, max_emails, batch_size, headers_only, executor)
+            for pool in pools
+        ]
+        results = [result for results in await asyncio.gather(*tasks) for result in results]
+
+        success = True
+        for result in results:
+            if isinstance(result, Exception):
+                print(f"Ошибка при загрузке папки: {result}")
+                success = False
+
+        print(f"\nДанные {writer.count} писем сохранены в файл {output_file}")
+        return success
+
+    finally:
+        writer.close()
+        if executor:
+            executor.shutdown(cancel_futures=True)
+        for pool in pools:
+            await pool.close()
+
+
+if __name__ == "__main__":
+    accounts = load_accounts()
+    print(f"Найдено учетных записей: {len(accounts)}")
+    for account in accounts:
+        print(f"  - {account['email']} ({account['server']}): {', '.join(account['folders'])}")
+
+    try:
+        max_emails = int(input("Введите максимальное количество писем из одной папки (по умолчанию 1000): ") or "1000")
+    except:
+        max_emails = 1000
+        print("Некорректный ввод, будет использовано значение по умолчанию: 1000")
+
+    output_file = input("Введите имя файла для сохранения (по умолчанию emails_data.json): ") or "emails_data.json"
+    incremental = input("Загрузить только новые письма с прошлой синхронизации? (y/n): ").lower() == 'y'
+
+    if asyncio.run(ingest_all(accounts, output_file, max_emails, incremental=incremental)):
+        print("Программа успешно завершена")
+    else:
+        print("Программа завершена с ошибками")
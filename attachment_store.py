@@ -0,0 +1,161 @@
+"""
+Хранилище вложений с адресацией по содержимому
+
+Каждое вложение сохраняется в файл, имя которого - SHA-256 его содержимого,
+поэтому одинаковые файлы из разных писем хранятся на диске один раз.
+В базе данных (таблица attachments) хранятся только хеш, размер и метаданные вложения.
+"""
+import hashlib
+import os
+import sqlite3
+import tempfile
+import time
+
+# Размер части, которыми вложение записывается на диск
+CHUNK_SIZE = 1 << 16
+
+# Файлы, которые сохранялись за последние GRACE_PERIOD секунд, remove_unreferenced не удаляет:
+# письма со ссылками на них могут быть еще не сохранены в базе данных
+GRACE_PERIOD = 60 * 60
+
+def get_store_dir(db_path):
+    """Возвращает каталог хранилища вложений: каталог attachments рядом с базой данных"""
+    return os.path.join(os.path.dirname(os.path.abspath(db_path)), "attachments")
+
+def attachment_path(store_dir, sha256):
+    """
+    Возвращает путь к файлу вложения
+
+    Файлы раскладываются по подкаталогам по первым двум символам хеша,
+    чтобы в одном каталоге не оказывалось слишком много файлов.
+    """
+    return os.path.join(store_dir, sha256[:2], sha256)
+
+def _iter_chunks(source):
+    """Возвращает содержимое вложения частями: из bytes, файлового объекта или итератора частей"""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        view = memoryview(source)
+        return (view[start:start + CHUNK_SIZE] for start in range(0, len(view), CHUNK_SIZE))
+    if hasattr(source, "read"):
+        return iter(lambda: source.read(CHUNK_SIZE), b"")
+    return source
+
+def _touch(path):
+    """
+    Обновляет время изменения файла вложения, если он уже есть в хранилище
+
+    Новое время изменения не дает remove_unreferenced удалить файл, пока письмо
+    со ссылкой на него не сохранено в базе данных.
+
+    Returns:
+        bool: True, если файл есть в хранилище
+    """
+    try:
+        os.utime(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+def save_attachment(store_dir, source):
+    """
+    Сохраняет вложение в хранилище, если такого файла там еще нет
+
+    Содержимое записывается во временный файл по частям, SHA-256 считается
+    по ходу записи, и после записи временный файл переименовывается в файл
+    с именем хеша. Поэтому вложение не нужно целиком держать в памяти,
+    а несколько процессов могут сохранять одно и то же вложение одновременно.
+
+    Args:
+        store_dir (str): Каталог хранилища
+        source (bytes | file | iterable): Содержимое вложения: bytes, файловый объект,
+            открытый для чтения в двоичном режиме, или итератор частей (bytes)
+
+    Returns:
+        tuple: (SHA-256 содержимого, размер в байтах)
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        # Содержимое уже в памяти: если такой файл есть, записывать его не нужно
+        sha256 = hashlib.sha256(source).hexdigest()
+        if _touch(attachment_path(store_dir, sha256)):
+            return sha256, len(source)
+
+    os.makedirs(store_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=store_dir, suffix=".tmp")
+    try:
+        digest = hashlib.sha256()
+        size = 0
+        with os.fdopen(fd, "wb") as f:
+            for chunk in _iter_chunks(source):
+                digest.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+
+        sha256 = digest.hexdigest()
+        path = attachment_path(store_dir, sha256)
+        if _touch(path):
+            os.remove(tmp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    return sha256, size
+
+def open_attachment(store_dir, sha256):
+    """Открывает файл вложения для чтения"""
+    return open(attachment_path(store_dir, sha256), "rb")
+
+def remove_unreferenced(conn, store_dir, grace_period=GRACE_PERIOD):
+    """
+    Удаляет из хранилища файлы, на которые не ссылается ни одна запись таблицы attachments
+
+    Такие файлы остаются после удаления писем, например при смене UIDVALIDITY папки.
+    Файлы, сохраненные за последние grace_period секунд, не удаляются: загрузка писем
+    сохраняет вложения раньше, чем фиксирует ссылки на них в базе данных.
+
+    Returns:
+        int: Количество удаленных файлов
+    """
+    if not os.path.isdir(store_dir):
+        return 0
+
+    referenced = {row[0] for row in conn.execute("SELECT DISTINCT sha256 FROM attachments")}
+    removed = 0
+    for directory, _, files in os.walk(store_dir):
+        for name in files:
+            # Временные файлы могут принадлежать записи, которая еще идет
+            if name.endswith(".tmp") or name in referenced:
+                continue
+            path = os.path.join(directory, name)
+            try:
+                if time.time() - os.path.getmtime(path) < grace_period:
+                    continue
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            removed += 1
+    return removed
+
+if __name__ == "__main__":
+    import create_database
+
+    store_dir = get_store_dir(create_database.DB_PATH)
+    conn = sqlite3.connect(create_database.DB_PATH)
+    create_database.migrate_database(conn)
+
+    count, total, unique = conn.execute(
+        "SELECT COUNT(*), COALESCE(SUM(size), 0), COUNT(DISTINCT sha256) FROM attachments"
+    ).fetchone()
+    stored = conn.execute(
+        "SELECT COALESCE(SUM(size), 0) FROM (SELECT MAX(size) AS size FROM attachments GROUP BY sha256)"
+    ).fetchone()[0]
+    print(f"Вложений: {count} ({total / 1024 / 1024:.1f} МБ), "
+          f"уникальных файлов: {unique} ({stored / 1024 / 1024:.1f} МБ)")
+
+    print("Перед удалением импортируйте все JSON-файлы загрузки: их вложения еще не связаны с письмами в базе данных.")
+    if input("Удалить файлы, на которые не ссылается ни одно письмо? (y/n): ").lower() == 'y':
+        print(f"Удалено файлов: {remove_unreferenced(conn, store_dir)}")
+    conn.close()
@@ -0,0 +1,199 @@
+"""
+Сравнение способов загрузки писем на локальном IMAP-сервере (fake_imap.py)
+
+Каждый способ запускается в отдельном процессе с чистой базой данных,
+поэтому пиковое потребление памяти измеряется независимо для каждого способа.
+"""
+import asyncio
+import contextlib
+import io
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+try:
+    import resource
+except ImportError:
+    # Модуль resource недоступен в Windows, память в этом случае не измеряется
+    resource = None
+
+from fake_imap import FakeIMAPServer, Mailbox
+
+BENCHMARK_EMAIL = "benchmark@example.ru"
+
+# Способы загрузки писем и их описание
+MODES = {
+    "json": "mail_to_json.py, JSON файл",
+    "ndjson": "mail_to_json.py, NDJSON файл",
+    "json-headers": "mail_to_json.py, только заголовки",
+    "json-workers": "mail_to_json.py, разбор в 2 процессах",
+    "db": "mail_to_db.py, сразу в базу данных",
+    "db-headers": "mail_to_db.py, только заголовки",
+    "async": "async_ingest.py, пул соединений",
+}
+
+def peak_memory_mb():
+    """
+    Возвращает пиковое потребление памяти текущим процессом и его дочерними процессами в МБ
+
+    Для дочерних процессов (например, процессов разбора писем) учитывается пик
+    самого большого из завершившихся, поэтому сумма - оценка сверху.
+    """
+    if resource is None:
+        return None
+    peak = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            + resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # В macOS ru_maxrss измеряется в байтах, в Linux - в килобайтах
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def run_mode(mode, workdir, max_emails, batch_size):
+    """
+    Выполняет один способ загрузки. Вызывается в отдельном процессе
+
+    Args:
+        mode (str): Способ загрузки из MODES
+        workdir (str): Каталог для базы данных и файлов с письмами
+        max_emails (int): Количество загружаемых писем
+        batch_size (int): Количество писем в одной команде FETCH
+
+    Returns:
+        tuple: (время загрузки в секундах, количество загруженных писем, пиковая память в МБ)
+
+    Raises:
+        RuntimeError: Загрузка завершилась с ошибкой или загружены не все письма
+    """
+    import create_database
+    import mail_to_db
+    import mail_to_json
+    from async_ingest import ingest_all
+
+    create_database.DB_PATH = os.path.join(workdir, f"{mode}.db")
+    output_file = os.path.join(workdir, f"{mode}.ndjson" if mode == "ndjson" else f"{mode}.json")
+
+    # Вывод загрузки сохраняем, чтобы показать его, если загрузка не удалась
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        create_database.create_database()
+
+        start = time.perf_counter()
+        if mode in ("json", "ndjson", "json-headers", "json-workers"):
+            success = mail_to_json.save_emails_to_json(
+                max_emails, output_file, batch_size,
+                headers_only=mode == "json-headers",
+                parse_workers=2 if mode == "json-workers" else 0
+            )
+        elif mode in ("db", "db-headers"):
+            success = mail_to_db.save_emails_to_database(
+                max_emails, batch_size, headers_only=mode == "db-headers",
+                commit_every=max(batch_size, 500)
+            )
+        elif mode == "async":
+            account = {
+                "name": "RU", "email": BENCHMARK_EMAIL, "password": "benchmark",
+                "server": mail_to_json.mail_server, "port": mail_to_json.mail_port,
+                "folders": ["INBOX"], "max_connections": 3,
+            }
+            success = asyncio.run(ingest_all([account], output_file, max_emails, batch_size))
+        else:
+            raise ValueError(f"Неизвестный способ загрузки: {mode}")
+        elapsed = time.perf_counter() - start
+
+        if mode.startswith("db"):
+            conn = sqlite3.connect(create_database.DB_PATH)
+            count = conn.execute("SELECT COUNT(*) FROM emails").fetchone()[0]
+            conn.close()
+        else:
+            count = sum(1 for _ in create_database.iter_emails_from_file(output_file))
+
+    if not success:
+        raise RuntimeError(f"Способ {mode}: загрузка завершилась с ошибкой\n{output.getvalue()}")
+    if count != max_emails:
+        raise RuntimeError(f"Способ {mode}: загружено {count} писем из {max_emails}\n{output.getvalue()}")
+
+    return elapsed, count, peak_memory_mb()
+
+def run_benchmark(count=2000, parts=1, body_size=2000, latency=0.0, batch_size=200, modes=None):
+    """
+    Запускает локальный IMAP-сервер и измеряет скорость каждого способа загрузки
+
+    Args:
+        count (int): Количество писем в синтетическом ящике
+        parts (int): Количество частей MIME в каждом письме
+        body_size (int): Размер текста письма в символах
+        latency (float): Задержка ответа сервера на каждую команду в секундах
+        batch_size (int): Количество писем в одной команде FETCH
+        modes (list): Способы загрузки; по умолчанию все из MODES
+
+    Returns:
+        list: Результаты в виде словарей с ключами mode, seconds, emails,
+              emails_per_sec, mb_per_sec, peak_mb
+    """
+    modes = modes or list(MODES)
+    mailbox = Mailbox(count, parts=parts, body_size=body_size, latency=latency)
+    server = FakeIMAPServer(mailbox).start()
+
+    # Настройки наследуются процессами, в которых выполняется загрузка
+    os.environ.update({
+        "IMAP_SERVER": "127.0.0.1",
+        "IMAP_PORT": str(server.port),
+        "IMAP_SSL": "0",
+        "EMAIL_RU": BENCHMARK_EMAIL,
+        "PASSWORD_RU": "benchmark",
+    })
+
+    print(f"Ящик: {count} писем, {mailbox.total_size() / 1024 / 1024:.1f} МБ, "
+          f"частей MIME: {parts}, задержка: {latency} с, пачка: {batch_size}\n")
+
+    results = []
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            for mode in modes:
+                bytes_before = mailbox.bytes_sent
+                # Новый процесс для каждого способа, чтобы пиковая память не накапливалась
+                with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+                    seconds, emails, peak_mb = executor.submit(
+                        run_mode, mode, workdir, count, batch_size
+                    ).result()
+                sent = mailbox.bytes_sent - bytes_before
+
+                result = {
+                    "mode": mode,
+                    "seconds": seconds,
+                    "emails": emails,
+                    "emails_per_sec": emails / seconds if seconds else 0,
+                    "mb_per_sec": sent / 1024 / 1024 / seconds if seconds else 0,
+                    "peak_mb": peak_mb,
+                }
+                results.append(result)
+                print_result(result)
+    finally:
+        server.stop()
+
+    return results
+
+def print_result(result):
+    """Выводит строку таблицы результатов"""
+    peak = f"{result['peak_mb']:.0f} МБ" if result["peak_mb"] is not None else "н/д"
+    print(f"{result['mode']:<14} {MODES[result['mode']]:<38} "
+          f"{result['emails']:>7} писем  {result['seconds']:>7.2f} с  "
+          f"{result['emails_per_sec']:>8.0f} писем/с  {result['mb_per_sec']:>7.2f} МБ/с  "
+          f"память {peak}")
+
+if __name__ == "__main__":
+    try:
+        count = int(input("Введите количество писем в ящике (по умолчанию 2000): ") or "2000")
+        parts = int(input("Введите количество частей MIME в письме (по умолчанию 1): ") or "1")
+        latency = float(input("Введите задержку ответа сервера в секундах (по умолчанию 0): ") or "0")
+        batch_size = int(input("Введите размер пачки FETCH (по умолчанию 200): ") or "200")
+    except ValueError:
+        count, parts, latency, batch_size = 2000, 1, 0.0, 200
+        print("Некорректный ввод, будут использованы значения по умолчанию")
+
+    modes = input(f"Способы загрузки через запятую ({', '.join(MODES)}; по умолчанию все): ")
+    modes = [mode.strip() for mode in modes.split(",") if mode.strip() in MODES]
+
+    run_benchmark(count, parts, latency=latency, batch_size=batch_size, modes=modes)
@@ -1,11 +1,194 @@
 import sqlite3
 import os
 import json
-from datetime import datetime
+import re
+import zlib
+from datetime import datetime, timezone
+from email.utils import parseaddr
+from itertools import islice
+
+import search
+
+try:
+    import zstandard
+except ImportError:
+    # Пакет zstandard не обязателен: без него тела писем сжимаются zlib
+    zstandard = None
 
 # Путь к базе данных
 DB_PATH = "email_database.db"
 
+# Сжатие тел писем в таблице email_bodies: None, "zlib" или "zstd"
+BODY_COMPRESSION = "zlib"
+
+# Тела писем короче этого размера в байтах хранятся без сжатия
+BODY_COMPRESS_MIN_SIZE = 256
+
+# Длина краткого текста письма для списков писем
+PREVIEW_LENGTH = 200
+
+# Статистика читается из счетчиков таблицы email_stats, которые обновляют триггеры,
+# а не вычисляется заново по таблице писем при каждом запросе
+
+# Всего писем и обработанных писем
+COUNTERS_SQL = '''
+SELECT
+    COALESCE((SELECT count FROM email_stats WHERE kind = 'total' AND key = 0), 0) AS total,
+    COALESCE((SELECT count FROM email_stats WHERE kind = 'processed' AND key = 0), 0) AS processed
+'''
+
+# Количество писем по категориям
+CATEGORY_STATS_SQL = '''
+SELECT c.id, c.name, c.description, COALESCE(st.count, 0) AS count
+FROM categories c
+LEFT JOIN email_stats st ON st.kind = 'category' AND st.key = c.id
+'''
+
+# Самые частые отправители
+TOP_SENDERS_SQL = '''
+SELECT CASE WHEN s.display_name != '' THEN s.display_name || ' <' || s.address || '>' ELSE s.address END
+       AS sender, st.count
+FROM email_stats st
+JOIN senders s ON s.id = st.key
+WHERE st.kind = 'sender' AND st.count > 0
+ORDER BY st.count DESC LIMIT ?
+'''
+
+# Самые частые домены отправителей: суммируются счетчики отправителей, а не письма
+TOP_DOMAINS_SQL = '''
+SELECT s.domain, SUM(st.count) AS count
+FROM email_stats st
+JOIN senders s ON s.id = st.key
+WHERE st.kind = 'sender' AND st.count > 0 AND s.domain IS NOT NULL
+GROUP BY s.domain ORDER BY count DESC LIMIT ?
+'''
+
+# Категории писем страницы одним запросом: ID писем передаются одним параметром -
+# JSON-массивом, поэтому число запросов не зависит от количества писем на странице
+EMAIL_CATEGORIES_SQL = '''
+SELECT ec.email_id, c.name
+FROM email_categories ec
+JOIN categories c ON c.id = ec.category_id
+WHERE ec.email_id IN (SELECT value FROM json_each(?))
+ORDER BY c.name
+'''
+
+# Тела писем страницы одним запросом (ID писем - JSON-массивом, как в EMAIL_CATEGORIES_SQL)
+EMAIL_BODIES_SQL = '''
+SELECT email_id, body, compression
+FROM email_bodies
+WHERE email_id IN (SELECT value FROM json_each(?))
+'''
+
+# Триггеры, поддерживающие счетчики email_stats в актуальном состоянии
+STATS_TRIGGERS = {
+    'trg_emails_stats_insert': '''
+    AFTER INSERT ON emails BEGIN
+        INSERT INTO email_stats (kind, key, count) VALUES ('total', 0, 1)
+        ON CONFLICT (kind, key) DO UPDATE SET count = count + 1;
+        INSERT INTO email_stats (kind, key, count) SELECT 'processed', 0, 1 WHERE NEW.is_processed = 1
+        ON CONFLICT (kind, key) DO UPDATE SET count = count + 1;
+        INSERT INTO email_stats (kind, key, count) SELECT 'sender', NEW.sender_id, 1 WHERE NEW.sender_id IS NOT NULL
+        ON CONFLICT (kind, key) DO UPDATE SET count = count + 1;
+    END''',
+    'trg_emails_stats_delete': '''
+    AFTER DELETE ON emails BEGIN
+        UPDATE email_stats SET count = count - 1 WHERE kind = 'total' AND key = 0;
+        UPDATE email_stats SET count = count - 1 WHERE kind = 'processed' AND key = 0 AND OLD.is_processed = 1;
+        UPDATE email_stats SET count = count - 1 WHERE kind = 'sender' AND key = OLD.sender_id;
+    END''',
+    'trg_emails_stats_processed': '''
+    AFTER UPDATE OF is_processed ON emails
+    WHEN (OLD.is_processed = 1) != (NEW.is_processed = 1) BEGIN
+        INSERT INTO email_stats (kind, key, count)
+        VALUES ('processed', 0, CASE WHEN NEW.is_processed = 1 THEN 1 ELSE -1 END)
+        ON CONFLICT (kind, key) DO UPDATE SET count = count + excluded.count;
+    END''',
+    'trg_emails_stats_sender': '''
+    AFTER UPDATE OF sender_id ON emails
+    WHEN OLD.sender_id IS NOT NEW.sender_id BEGIN
+        UPDATE email_stats SET count = count - 1 WHERE kind = 'sender' AND key = OLD.sender_id;
+        INSERT INTO email_stats (kind, key, count) SELECT 'sender', NEW.sender_id, 1 WHERE NEW.sender_id IS NOT NULL
+        ON CONFLICT (kind, key) DO UPDATE SET count = count + 1;
+    END''',
+    'trg_email_categories_stats_insert': '''
+    AFTER INSERT ON email_categories BEGIN
+        INSERT INTO email_stats (kind, key, count) VALUES ('category', NEW.category_id, 1)
+        ON CONFLICT (kind, key) DO UPDATE SET count = count + 1;
+    END''',
+    'trg_email_categories_stats_delete': '''
+    AFTER DELETE ON email_categories BEGIN
+        UPDATE email_stats SET count = count - 1 WHERE kind = 'category' AND key = OLD.category_id;
+    END''',
+    'trg_email_categories_stats_update': '''
+    AFTER UPDATE OF category_id ON email_categories
+    WHEN OLD.category_id != NEW.category_id BEGIN
+        UPDATE email_stats SET count = count - 1 WHERE kind = 'category' AND key = OLD.category_id;
+        INSERT INTO email_stats (kind, key, count) VALUES ('category', NEW.category_id, 1)
+        ON CONFLICT (kind, key) DO UPDATE SET count = count + 1;
+    END''',
+}
+
+# Текст тела письма для полнотекстового индекса: пустая строка, если тело не загружено.
+# Весь текст перед записью в индекс приводится к основам слов функцией search_text (search.py)
+_FTS_BODY = "COALESCE((SELECT search_text(body_text(body, compression)) FROM email_bodies WHERE email_id = {id}), '')"
+
+# Триггеры, поддерживающие полнотекстовый индекс emails_fts в актуальном состоянии.
+# Индекс не хранит сам текст (content=''), поэтому для удаления строки из индекса
+# ему передаются прежние значения колонок (команда 'delete').
+# Краткий текст письма (preview) есть только у писем с телом: письмо без тела
+# индексируется сразу, а письмо с телом - когда тело записывается в email_bodies,
+# чтобы при загрузке писем не индексировать каждое письмо дважды
+FTS_TRIGGERS = {
+    'trg_emails_fts_insert': '''
+    AFTER INSERT ON emails WHEN NEW.preview IS NULL BEGIN
+        INSERT INTO emails_fts (rowid, subject, sender, body) VALUES (NEW.id, search_text(NEW.subject), search_text(NEW.sender), '');
+    END''',
+    'trg_emails_fts_delete': f'''
+    AFTER DELETE ON emails BEGIN
+        INSERT INTO emails_fts (emails_fts, rowid, subject, sender, body)
+        VALUES ('delete', OLD.id, search_text(OLD.subject), search_text(OLD.sender), {_FTS_BODY.format(id='OLD.id')});
+    END''',
+    'trg_emails_fts_update': f'''
+    AFTER UPDATE OF subject, sender ON emails
+    WHEN OLD.subject IS NOT NEW.subject OR OLD.sender IS NOT NEW.sender BEGIN
+        INSERT INTO emails_fts (emails_fts, rowid, subject, sender, body)
+        VALUES ('delete', OLD.id, search_text(OLD.subject), search_text(OLD.sender), {_FTS_BODY.format(id='OLD.id')});
+        INSERT INTO emails_fts (rowid, subject, sender, body)
+        VALUES (NEW.id, search_text(NEW.subject), search_text(NEW.sender), {_FTS_BODY.format(id='NEW.id')});
+    END''',
+    'trg_email_bodies_fts_insert': '''
+    AFTER INSERT ON email_bodies BEGIN
+        INSERT INTO emails_fts (emails_fts, rowid, subject, sender, body)
+        SELECT 'delete', id, search_text(subject), search_text(sender), '' FROM emails WHERE id = NEW.email_id AND preview IS NULL;
+        INSERT INTO emails_fts (rowid, subject, sender, body)
+        SELECT id, search_text(subject), search_text(sender), COALESCE(search_text(body_text(NEW.body, NEW.compression)), '')
+        FROM emails WHERE id = NEW.email_id;
+    END''',
+    'trg_email_bodies_fts_update': '''
+    AFTER UPDATE ON email_bodies BEGIN
+        INSERT INTO emails_fts (emails_fts, rowid, subject, sender, body)
+        SELECT 'delete', id, search_text(subject), search_text(sender), COALESCE(search_text(body_text(OLD.body, OLD.compression)), '')
+        FROM emails WHERE id = OLD.email_id;
+        INSERT INTO emails_fts (rowid, subject, sender, body)
+        SELECT id, search_text(subject), search_text(sender), COALESCE(search_text(body_text(NEW.body, NEW.compression)), '')
+        FROM emails WHERE id = NEW.email_id;
+    END''',
+    'trg_email_bodies_fts_delete': '''
+    AFTER DELETE ON email_bodies BEGIN
+        INSERT INTO emails_fts (emails_fts, rowid, subject, sender, body)
+        SELECT 'delete', id, search_text(subject), search_text(sender), COALESCE(search_text(body_text(OLD.body, OLD.compression)), '')
+        FROM emails WHERE id = OLD.email_id;
+        INSERT INTO emails_fts (rowid, subject, sender, body)
+        SELECT id, search_text(subject), search_text(sender), '' FROM emails WHERE id = OLD.email_id;
+        UPDATE emails SET preview = NULL WHERE id = OLD.email_id;
+    END''',
+}
+
+# Пробелы и разделители между элементами JSON-массива
+JSON_WHITESPACE = re.compile(r'\s*')
+JSON_SEPARATORS = re.compile(r'[\s,]*')
+
 def create_database():
     """Создает базу данных и необходимые таблицы"""
 
@@ -32,8 +215,19 @@ def create_database():
         sender TEXT,
         date TEXT,
         date_received TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        body TEXT,
-        is_processed INTEGER DEFAULT 0
+        is_processed INTEGER DEFAULT 0,
+        account TEXT,
+        folder TEXT,
+        uid INTEGER,
+        message_id TEXT,
+        size INTEGER,
+        raw_segment TEXT,
+        raw_offset INTEGER,
+        raw_length INTEGER,
+        flags TEXT,
+        date_ts INTEGER,
+        sender_id INTEGER REFERENCES senders (id),
+        preview TEXT
     )
     ''')
 
@@ -44,7 +238,8 @@ def create_database():
         email_id INTEGER,
         filename TEXT,
         content_type TEXT,
-        data BLOB,
+        sha256 TEXT,
+        size INTEGER,
         FOREIGN KEY (email_id) REFERENCES emails (id)
     )
     ''')
@@ -85,6 +280,9 @@ def create_database():
 
     cursor.executemany('INSERT OR IGNORE INTO categories (name, description) VALUES (?, ?)', categories)
 
+    # Создаем служебные таблицы и применяем миграции
+    migrate_database(conn)
+
     # Сохраняем изменения и закрываем соединение
     conn.commit()
     conn.close()
@@ -93,8 +291,811 @@ def create_database():
     return True
 
 
+def migrate_database(conn):
+    """
+    Приводит схему существующей базы данных к актуальной версии
+
+    Также регистрирует в соединении функции, которые вызывают триггеры
+    полнотекстового индекса (см. register_functions).
+    """
+
+    cursor = conn.cursor()
+    register_functions(conn)
+
+    # Добавляем недостающие колонки в таблицу писем
+    columns = {row[1] for row in cursor.execute('PRAGMA table_info(emails)')}
+    for name, definition in [
+        ('account', 'TEXT'), ('folder', 'TEXT'), ('uid', 'INTEGER'),
+        ('message_id', 'TEXT'), ('size', 'INTEGER'),
+        ('raw_segment', 'TEXT'), ('raw_offset', 'INTEGER'), ('raw_length', 'INTEGER'),
+        ('flags', 'TEXT'), ('date_ts', 'INTEGER'), ('sender_id', 'INTEGER REFERENCES senders (id)'),
+        ('preview', 'TEXT')
+    ]:
+        if name not in columns:
+            cursor.execute(f'ALTER TABLE emails ADD COLUMN {name} {definition}')
+
+    # Дата письма в Unix-времени (UTC) для сортировки и отбора по дате через индекс.
+    # Для уже сохраненных писем вычисляется из текстовой даты: часовой пояс отправителя
+    # в ней не сохранился, поэтому она считается датой в UTC
+    if 'date_ts' not in columns:
+        cursor.execute('''
+        UPDATE emails SET date_ts = CAST(strftime('%s', date) AS INTEGER)
+        WHERE date GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]*'
+        ''')
+        if cursor.rowcount:
+            print(f"Вычислена дата в Unix-времени для писем: {cursor.rowcount}")
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_emails_date_ts ON emails (date_ts)')
+
+    # Отправители с разобранным адресом: письма ссылаются на них по sender_id,
+    # поэтому статистика по отправителям и доменам группирует числа, а не строки
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS senders (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        address TEXT UNIQUE,
+        domain TEXT,
+        display_name TEXT
+    )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_senders_domain ON senders (domain)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_emails_sender_id ON emails (sender_id)')
+
+    if 'sender_id' not in columns:
+        senders = [row[0] for row in cursor.execute('SELECT DISTINCT sender FROM emails WHERE sender IS NOT NULL')]
+        cursor.executemany(
+            'INSERT OR IGNORE INTO senders (address, domain, display_name) VALUES (?, ?, ?)',
+            [parse_sender(sender) for sender in senders]
+        )
+        cursor.executemany(
+            'UPDATE emails SET sender_id = (SELECT id FROM senders WHERE address = ?) WHERE sender = ?',
+            [(parse_sender(sender)[0], sender) for sender in senders]
+        )
+        if senders:
+            print(f"Заполнена таблица отправителей: {len(senders)} отправителей")
+
+    # Тела писем хранятся отдельно от заголовков: списки писем и поиск по заголовкам
+    # читают только небольшие строки таблицы emails, а не страницы с длинным текстом.
+    # Письма, сохраненные только с заголовками, записи в этой таблице не имеют
+    bodies_exist = cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'email_bodies'"
+    ).fetchone()
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS email_bodies (
+        email_id INTEGER PRIMARY KEY REFERENCES emails (id),
+        body BLOB,
+        compression TEXT
+    )
+    ''')
+
+    # Тела копируются один раз, при создании таблицы. Колонка emails.body при этом
+    # не удаляется: ее удаляет только явный вызов compact_database()
+    if 'body' in columns and not bodies_exist:
+        moved = move_bodies(conn)
+        if moved:
+            print(f"Тела писем скопированы в таблицу email_bodies: {moved}")
+            print("Колонка emails.body больше не используется. Чтобы удалить ее и уменьшить "
+                  "файл базы данных, сделайте резервную копию и выполните compact_database()")
+
+    # Создаем таблицу состояния синхронизации папок почтового ящика
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS sync_state (
+        account TEXT,
+        folder TEXT,
+        uidvalidity INTEGER,
+        last_uid INTEGER,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        batch_no INTEGER DEFAULT 0,
+        status TEXT DEFAULT 'complete',
+        highest_modseq INTEGER,
+        PRIMARY KEY (account, folder)
+    )
+    ''')
+
+    columns = {row[1] for row in cursor.execute('PRAGMA table_info(sync_state)')}
+    for name, definition in [
+        ('batch_no', 'INTEGER DEFAULT 0'), ('status', "TEXT DEFAULT 'complete'"), ('highest_modseq', 'INTEGER')
+    ]:
+        if name not in columns:
+            cursor.execute(f'ALTER TABLE sync_state ADD COLUMN {name} {definition}')
+
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_emails_folder_uid ON emails (account, folder, uid)')
+
+    # Первичный ключ email_categories начинается с email_id: для отбора писем категории
+    # нужен индекс в обратном порядке. Список необработанных писем сортируется по дате.
+    # Планы всех запросов приложения проверяет test_query_plans.py
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_email_categories_category ON email_categories (category_id, email_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_emails_processed_date_ts ON emails (is_processed, date_ts)')
+
+    # Содержимое вложений хранится в хранилище вложений (attachment_store),
+    # в таблице - только SHA-256 и размер. Колонка data больше не заполняется
+    columns = {row[1] for row in cursor.execute('PRAGMA table_info(attachments)')}
+    for name, definition in [('sha256', 'TEXT'), ('size', 'INTEGER')]:
+        if name not in columns:
+            cursor.execute(f'ALTER TABLE attachments ADD COLUMN {name} {definition}')
+
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_attachments_email_id ON attachments (email_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_attachments_sha256 ON attachments (sha256)')
+
+    # Уникальный индекс по идентификатору письма на сервере позволяет
+    # добавлять письма через INSERT OR IGNORE без предварительной проверки
+    if not cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_emails_email_id'"
+    ).fetchone():
+        cursor.execute('''
+        DELETE FROM emails WHERE email_id IS NOT NULL AND id NOT IN (
+            SELECT MIN(id) FROM emails WHERE email_id IS NOT NULL GROUP BY email_id
+        )
+        ''')
+        if cursor.rowcount:
+            print(f"Удалено повторяющихся писем: {cursor.rowcount}")
+            cursor.execute('DELETE FROM email_categories WHERE email_id NOT IN (SELECT id FROM emails)')
+            cursor.execute('DELETE FROM attachments WHERE email_id NOT IN (SELECT id FROM emails)')
+            cursor.execute('DELETE FROM email_bodies WHERE email_id NOT IN (SELECT id FROM emails)')
+        cursor.execute('CREATE UNIQUE INDEX idx_emails_email_id ON emails (email_id)')
+
+    # Письма папки INBOX основного ящика раньше сохранялись с голым UID в email_id,
+    # который совпадает с порядковыми номерами писем в старых записях. Переводим их
+    # к виду "ящик/папка/UID" (make_email_id). Такие email_id начинаются с цифры,
+    # поэтому просматривается только этот диапазон индекса idx_emails_email_id
+    cursor.execute('''
+    UPDATE OR IGNORE emails SET email_id = account || '/' || folder || '/' || uid
+    WHERE email_id >= '0' AND email_id < ':' AND email_id = CAST(uid AS TEXT)
+      AND account IS NOT NULL AND folder IS NOT NULL
+    ''')
+    if cursor.rowcount:
+        print(f"Обновлены идентификаторы писем: {cursor.rowcount}")
+
+    # Счетчики статистики создаются последними, когда все колонки и данные писем уже на месте
+    if not cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'email_stats'"
+    ).fetchone():
+        cursor.execute('''
+        CREATE TABLE email_stats (
+            kind TEXT,
+            key INTEGER,
+            count INTEGER,
+            PRIMARY KEY (kind, key)
+        ) WITHOUT ROWID
+        ''')
+        rebuild_stats(conn)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_email_stats_count ON email_stats (kind, count)')
+
+    for name, body in STATS_TRIGGERS.items():
+        cursor.execute(f'CREATE TRIGGER IF NOT EXISTS {name} {body}')
+
+    # Полнотекстовый индекс по теме, отправителю и телу письма (FTS5), rowid - ID письма.
+    # Сам текст в индексе не хранится: тела писем уже лежат сжатыми в email_bodies
+    if not cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'emails_fts'"
+    ).fetchone():
+        cursor.execute('''
+        CREATE VIRTUAL TABLE emails_fts USING fts5 (
+            subject, sender, body,
+            content = '',
+            tokenize = 'unicode61 remove_diacritics 2'
+        )
+        ''')
+        rebuild_fts(conn)
+    else:
+        # Индекс, построенный прежними триггерами (например, без приведения слов к основам),
+        # перестраивается вместе с триггерами
+        stored_triggers = dict(cursor.execute(
+            "SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND name IN (%s)"
+            % ', '.join('?' * len(FTS_TRIGGERS)), list(FTS_TRIGGERS)
+        ))
+        if any(stored_triggers.get(name) != f'CREATE TRIGGER {name} {body}' for name, body in FTS_TRIGGERS.items()):
+            for name in stored_triggers:
+                cursor.execute(f'DROP TRIGGER {name}')
+            rebuild_fts(conn)
+
+    for name, body in FTS_TRIGGERS.items():
+        cursor.execute(f'CREATE TRIGGER IF NOT EXISTS {name} {body}')
+
+    conn.commit()
+
+
+def rebuild_fts(conn):
+    """
+    Заново заполняет полнотекстовый индекс emails_fts по всем письмам
+
+    Триггеры поддерживают индекс при каждом изменении писем, перестроение нужно
+    при создании индекса в существующей базе данных и при изменении триггеров.
+    Изменения не фиксируются: транзакцию завершает вызывающий код.
+    """
+    conn.execute("INSERT INTO emails_fts (emails_fts) VALUES ('delete-all')")
+    cursor = conn.execute('''
+    INSERT INTO emails_fts (rowid, subject, sender, body)
+    SELECT e.id, search_text(e.subject), search_text(e.sender),
+           COALESCE(search_text(body_text(b.body, b.compression)), '')
+    FROM emails e LEFT JOIN email_bodies b ON b.email_id = e.id
+    ''')
+    if cursor.rowcount:
+        print(f"Построен полнотекстовый индекс писем: {cursor.rowcount}")
+
+
+def rebuild_stats(conn):
+    """
+    Пересчитывает счетчики таблицы email_stats по таблицам писем и категорий
+
+    Триггеры поддерживают счетчики при каждом изменении, пересчет нужен при создании
+    таблицы в существующей базе данных или если данные изменялись без триггеров.
+    Изменения не фиксируются: транзакцию завершает вызывающий код.
+    """
+    conn.execute('DELETE FROM email_stats')
+    conn.execute('''
+    INSERT INTO email_stats (kind, key, count)
+    SELECT 'total', 0, COUNT(*) FROM emails
+    UNION ALL
+    SELECT 'processed', 0, COUNT(*) FROM emails WHERE is_processed = 1
+    UNION ALL
+    SELECT 'sender', sender_id, COUNT(*) FROM emails WHERE sender_id IS NOT NULL GROUP BY sender_id
+    UNION ALL
+    SELECT 'category', category_id, COUNT(*) FROM email_categories GROUP BY category_id
+    ''')
+
+
+def compress_body(body, compression=None):
+    """
+    Сжимает тело письма для записи в таблицу email_bodies
+
+    Args:
+        body (str): Тело письма
+        compression (str): None, "zlib" или "zstd"; по умолчанию BODY_COMPRESSION
+
+    Returns:
+        tuple: (данные для колонки body, способ сжатия или None)
+    """
+    compression = compression or BODY_COMPRESSION
+    data = body.encode('utf-8')
+    if not compression or len(data) < BODY_COMPRESS_MIN_SIZE:
+        return body, None
+
+    if compression == 'zstd' and zstandard is not None:
+        compressed = zstandard.ZstdCompressor().compress(data)
+    else:
+        compression = 'zlib'
+        compressed = zlib.compress(data, 6)
+
+    # Сжатие не всегда уменьшает размер, например у уже закодированных данных
+    if len(compressed) >= len(data):
+        return body, None
+    return compressed, compression
+
+
+def decompress_body(data, compression):
+    """
+    Восстанавливает тело письма из колонки body таблицы email_bodies
+
+    Returns:
+        str: Тело письма или None, если тело не сохранено
+    """
+    if data is None or compression is None:
+        return data
+    if compression == 'zlib':
+        return zlib.decompress(data).decode('utf-8')
+    if compression == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("Для чтения тел писем, сжатых zstd, установите пакет zstandard")
+        return zstandard.ZstdDecompressor().decompress(data).decode('utf-8')
+    raise ValueError(f"Неизвестный способ сжатия: {compression}")
+
+
+def make_preview(body):
+    """
+    Возвращает краткий текст письма для списков писем
+
+    Пробелы и переводы строк схлопываются, текст обрезается до PREVIEW_LENGTH символов.
+    """
+    if body is None:
+        return None
+    preview = ' '.join(body[:PREVIEW_LENGTH * 4].split())
+    if len(preview) > PREVIEW_LENGTH:
+        return preview[:PREVIEW_LENGTH] + '...'
+    return preview
+
+
+def register_functions(conn):
+    """
+    Регистрирует в соединении функции body_text(body, compression), распаковывающую
+    тело письма прямо в SQL-запросе, и search_text(text), приводящую слова текста
+    к основам для полнотекстового индекса (search.search_text)
+
+    Их вызывают триггеры полнотекстового индекса emails_fts, поэтому функции должно
+    зарегистрировать каждое соединение, изменяющее письма и их тела. Функции этого
+    модуля, изменяющие письма, регистрируют их сами.
+    """
+    for name, num_params, func in (('body_text', 2, decompress_body), ('search_text', 1, search.search_text)):
+        try:
+            conn.create_function(name, num_params, func, deterministic=True)
+        except sqlite3.OperationalError:
+            # SQLite не дает заменить уже зарегистрированную функцию,
+            # пока в соединении есть незавершенные запросы
+            pass
+
+
+def save_body(conn, row_id, body):
+    """
+    Сохраняет тело письма и его краткий текст
+
+    Изменения не фиксируются: транзакцию завершает вызывающий код.
+
+    Args:
+        conn (sqlite3.Connection): Соединение с базой данных
+        row_id (int): ID письма в базе данных
+        body (str): Тело письма
+    """
+    register_functions(conn)
+    # UPSERT, а не INSERT OR REPLACE: замена строки не вызывает триггеры удаления,
+    # и полнотекстовый индекс не узнал бы о прежнем тексте письма
+    conn.execute('''
+    INSERT INTO email_bodies (email_id, body, compression) VALUES (?, ?, ?)
+    ON CONFLICT (email_id) DO UPDATE SET body = excluded.body, compression = excluded.compression
+    ''', (row_id, *compress_body(body)))
+    conn.execute('UPDATE emails SET preview = ? WHERE id = ?', (make_preview(body), row_id))
+
+
+def get_body(conn, row_id):
+    """
+    Возвращает тело письма
+
+    Returns:
+        str: Тело письма или None, если тело еще не загружено с сервера
+    """
+    row = conn.execute('SELECT body, compression FROM email_bodies WHERE email_id = ?', (row_id,)).fetchone()
+    return decompress_body(*row) if row else None
+
+
+def get_bodies(conn, email_ids):
+    """
+    Возвращает тела писем одним запросом
+
+    Args:
+        conn (sqlite3.Connection): Соединение с базой данных
+        email_ids (list): ID писем в базе данных
+
+    Returns:
+        dict: Словарь {ID письма: тело письма}; у писем, тело которых еще не загружено с сервера, - None
+    """
+    bodies = {email_id: None for email_id in email_ids}
+    if bodies:
+        for email_id, body, compression in conn.execute(EMAIL_BODIES_SQL, (json.dumps(list(bodies)),)):
+            bodies[email_id] = decompress_body(body, compression)
+    return bodies
+
+
+def get_email_categories(conn, email_ids):
+    """
+    Возвращает названия категорий писем одним запросом
+
+    Args:
+        conn (sqlite3.Connection): Соединение с базой данных
+        email_ids (list): ID писем в базе данных
+
+    Returns:
+        dict: Словарь {ID письма: список названий категорий}; у писем без категорий - пустой список
+    """
+    categories = {email_id: [] for email_id in email_ids}
+    if categories:
+        for email_id, name in conn.execute(EMAIL_CATEGORIES_SQL, (json.dumps(list(categories)),)):
+            categories[email_id].append(name)
+    return categories
+
+
+def move_bodies(conn, chunk_size=1000):
+    """
+    Копирует тела писем из колонки emails.body в таблицу email_bodies
+
+    Используется при обновлении базы данных, созданной до появления таблицы email_bodies.
+    Изменения не фиксируются: транзакцию завершает вызывающий код.
+
+    Returns:
+        int: Количество скопированных тел писем
+    """
+    moved = 0
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            'SELECT id, body FROM emails WHERE id > ? AND body IS NOT NULL ORDER BY id LIMIT ?',
+            (last_id, chunk_size)
+        ).fetchall()
+        if not rows:
+            break
+        conn.executemany(
+            'INSERT OR REPLACE INTO email_bodies (email_id, body, compression) VALUES (?, ?, ?)',
+            [(row_id, *compress_body(body)) for row_id, body in rows]
+        )
+        conn.executemany(
+            'UPDATE emails SET preview = ? WHERE id = ?',
+            [(make_preview(body), row_id) for row_id, body in rows]
+        )
+        moved += len(rows)
+        last_id = rows[-1][0]
+    return moved
+
+
+def compact_database(db_path=None):
+    """
+    Удаляет колонку emails.body, тела из которой уже скопированы в email_bodies,
+    и перестраивает файл базы данных (VACUUM), освобождая место после удаления писем
+
+    Удаление колонки необратимо, поэтому выполняется только этой функцией,
+    а не при обновлении схемы в migrate_database.
+    """
+    db_path = db_path or DB_PATH
+    size = os.path.getsize(db_path)
+    conn = sqlite3.connect(db_path)
+    migrate_database(conn)
+    if 'body' in {row[1] for row in conn.execute('PRAGMA table_info(emails)')}:
+        try:
+            conn.execute('ALTER TABLE emails DROP COLUMN body')
+        except sqlite3.OperationalError:
+            # SQLite до версии 3.35 не умеет удалять колонки - очищаем ее
+            conn.execute('UPDATE emails SET body = NULL WHERE body IS NOT NULL')
+        conn.commit()
+        print("Колонка emails.body удалена")
+    conn.execute('VACUUM')
+    conn.close()
+    print(f"Размер базы данных: {size / 1024 / 1024:.1f} МБ -> {os.path.getsize(db_path) / 1024 / 1024:.1f} МБ")
+
+
+def get_sync_state(conn, account, folder):
+    """
+    Возвращает сохраненное состояние синхронизации папки
+
+    Args:
+        conn (sqlite3.Connection): Соединение с базой данных
+        account (str): Адрес почтового ящика
+        folder (str): Имя папки на сервере
+
+    Returns:
+        dict: UIDVALIDITY, последний загруженный UID, номер последней сохраненной
+        пачки, статус синхронизации ('running' - прервана, 'complete' - завершена)
+        и HIGHESTMODSEQ последней сверки флагов или None
+    """
+    row = conn.execute(
+        'SELECT uidvalidity, last_uid, batch_no, status, highest_modseq FROM sync_state '
+        'WHERE account = ? AND folder = ?',
+        (account, folder)
+    ).fetchone()
+
+    if not row:
+        return None
+
+    return {
+        "uidvalidity": row[0], "last_uid": row[1], "batch_no": row[2] or 0, "status": row[3],
+        "highest_modseq": row[4]
+    }
+
+
+def save_sync_state(conn, account, folder, uidvalidity, last_uid, batch_no=0, status='complete',
+                    commit=True):
+    """
+    Сохраняет UIDVALIDITY и последний загруженный UID папки
+
+    Args:
+        batch_no (int): Номер последней сохраненной пачки писем
+        status (str): 'running' - синхронизация еще идет, 'complete' - завершена
+        commit (bool): Зафиксировать транзакцию. False позволяет сохранить состояние
+            в одной транзакции с пачкой писем
+    """
+
+    # Обновляем только эти колонки, не затрагивая HIGHESTMODSEQ, сохраненный при сверке папки
+    conn.execute('''
+    INSERT INTO sync_state (account, folder, uidvalidity, last_uid, updated_at, batch_no, status)
+    VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP, ?, ?)
+    ON CONFLICT (account, folder) DO UPDATE SET
+        uidvalidity = excluded.uidvalidity, last_uid = excluded.last_uid, updated_at = excluded.updated_at,
+        batch_no = excluded.batch_no, status = excluded.status
+    ''', (account, folder, uidvalidity, last_uid, batch_no, status))
+    if commit:
+        conn.commit()
+
+
+def save_highest_modseq(conn, account, folder, uidvalidity, highest_modseq):
+    """
+    Сохраняет HIGHESTMODSEQ папки после сверки флагов писем с сервером (CONDSTORE)
+
+    Изменения не фиксируются: транзакцию завершает вызывающий код.
+    """
+    conn.execute('''
+    INSERT INTO sync_state (account, folder, uidvalidity, last_uid, highest_modseq)
+    VALUES (?, ?, ?, 0, ?)
+    ON CONFLICT (account, folder) DO UPDATE SET highest_modseq = excluded.highest_modseq
+    ''', (account, folder, uidvalidity, highest_modseq))
+
+
+def get_stored_uids(conn, account, folder):
+    """Возвращает множество UID писем папки, уже сохраненных в базе данных"""
+
+    rows = conn.execute(
+        'SELECT uid FROM emails WHERE account = ? AND folder = ? AND uid IS NOT NULL',
+        (account, folder)
+    )
+    return {row[0] for row in rows}
+
+
+def delete_emails(conn, ids, chunk_size=500):
+    """
+    Удаляет письма вместе с их категориями и вложениями
+
+    Изменения не фиксируются: транзакцию завершает вызывающий код.
+
+    Args:
+        conn (sqlite3.Connection): Соединение с базой данных
+        ids (list): ID писем в базе данных
+        chunk_size (int): Количество писем в одном запросе DELETE
+    """
+    register_functions(conn)
+    ids = list(ids)
+    cursor = conn.cursor()
+    for start in range(0, len(ids), chunk_size):
+        chunk = ids[start:start + chunk_size]
+        placeholders = ','.join('?' * len(chunk))
+        cursor.execute(f'DELETE FROM email_categories WHERE email_id IN ({placeholders})', chunk)
+        cursor.execute(f'DELETE FROM attachments WHERE email_id IN ({placeholders})', chunk)
+        cursor.execute(f'DELETE FROM email_bodies WHERE email_id IN ({placeholders})', chunk)
+        cursor.execute(f'DELETE FROM emails WHERE id IN ({placeholders})', chunk)
+
+
+def reset_folder(conn, account, folder):
+    """
+    Удаляет письма папки и ее состояние синхронизации.
+    Используется при смене UIDVALIDITY, когда сохраненные UID больше не действительны.
+    """
+    register_functions(conn)
+    cursor = conn.cursor()
+
+    ids = 'SELECT id FROM emails WHERE account = ? AND folder = ?'
+    cursor.execute(f'DELETE FROM email_categories WHERE email_id IN ({ids})', (account, folder))
+    cursor.execute(f'DELETE FROM attachments WHERE email_id IN ({ids})', (account, folder))
+    cursor.execute(f'DELETE FROM email_bodies WHERE email_id IN ({ids})', (account, folder))
+    cursor.execute('DELETE FROM emails WHERE account = ? AND folder = ?', (account, folder))
+    cursor.execute('DELETE FROM sync_state WHERE account = ? AND folder = ?', (account, folder))
+
+    conn.commit()
+
+
+def iter_json_array(f, chunk_size=1 << 20):
+    """
+    Последовательно разбирает элементы JSON-массива из файла
+
+    Файл читается частями по chunk_size символов, поэтому в памяти находится
+    только текущая часть файла, а не весь массив.
+
+    Args:
+        f (file): Открытый текстовый файл, начинающийся с JSON-массива
+        chunk_size (int): Размер читаемой части файла
+
+    Yields:
+        object: Очередной элемент массива
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    pos = 0
+    eof = False
+    started = False
+
+    while True:
+        # Пропускаем пробелы и разделители
+        pos = (JSON_SEPARATORS if started else JSON_WHITESPACE).match(buffer, pos).end()
+
+        # Разбираем очередной элемент, если он целиком находится в буфере
+        if pos < len(buffer):
+            if not started:
+                if buffer[pos] != '[':
+                    raise ValueError('Ожидался JSON-массив')
+                started = True
+                pos += 1
+                continue
+
+            if buffer[pos] == ']':
+                return
+
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                end = None
+
+            # Элемент считается полным, только если за ним уже прочитан разделитель:
+            # иначе он мог быть обрезан границей буфера (например, число)
+            if end is not None:
+                next_pos = JSON_WHITESPACE.match(buffer, end).end()
+                if next_pos < len(buffer) and buffer[next_pos] in ',]':
+                    yield item
+                    pos = end
+
+                    # Отбрасываем уже разобранную часть буфера
+                    if pos >= chunk_size:
+                        buffer = buffer[pos:]
+                        pos = 0
+                    continue
+                if eof:
+                    raise ValueError('Некорректный JSON-массив')
+
+        if eof:
+            raise ValueError('Неожиданный конец JSON файла')
+
+        # Дочитываем следующую часть файла
+        more = f.read(chunk_size)
+        eof = not more
+        buffer = buffer[pos:] + more
+        pos = 0
+
+
+def iter_emails_from_file(json_file):
+    """
+    Последовательно читает письма из файла экспорта
+
+    Поддерживается JSON-массив и NDJSON (один JSON-объект на строку).
+    Оба формата читаются по частям, без загрузки всего файла в память.
+    """
+    with open(json_file, 'r', encoding='utf-8') as f:
+        # Определяем формат по первому значимому символу
+        first_char = ''
+        while True:
+            first_char = f.read(1)
+            if not first_char or not first_char.isspace():
+                break
+        f.seek(0)
+
+        if first_char == '[':
+            yield from iter_json_array(f)
+            return
+
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def parse_sender(sender):
+    """
+    Разбирает заголовок From на адрес, домен и отображаемое имя
+
+    Адрес приводится к нижнему регистру, чтобы письма с одного адреса
+    с разными отображаемыми именами относились к одному отправителю.
+    Если адрес выделить не удалось, адресом считается весь заголовок.
+
+    Returns:
+        tuple: (адрес, домен или None, отображаемое имя)
+    """
+    display_name, address = parseaddr(sender or '')
+    address = address.strip().lower()
+    if '@' not in address:
+        return (sender or '').strip().lower(), None, display_name.strip()
+    return address, address.rsplit('@', 1)[1], display_name.strip()
+
+
+def date_text_to_timestamp(date_text):
+    """
+    Преобразует дату вида YYYY-MM-DD HH:MM:SS в Unix-время, считая ее датой в UTC
+
+    Используется для писем из JSON файлов, сохраненных до появления поля date_ts.
+
+    Returns:
+        int: Количество секунд с 1970-01-01 UTC или None, если дата не распознана
+    """
+    try:
+        date = datetime.strptime(date_text, '%Y-%m-%d %H:%M:%S')
+    except (TypeError, ValueError):
+        return None
+    return int(date.replace(tzinfo=timezone.utc).timestamp())
+
+
+def store_emails(conn, emails, chunk_size=5000):
+    """
+    Добавляет письма в базу данных, пропуская уже сохраненные
+
+    Письма добавляются пачками через executemany и INSERT OR IGNORE:
+    повторяющиеся письма отсекает уникальный индекс по email_id.
+    Изменения не фиксируются: транзакцию завершает вызывающий код.
+
+    Args:
+        conn (sqlite3.Connection): Соединение с базой данных
+        emails (iterable): Письма в формате mail_to_json
+        chunk_size (int): Количество писем в одном вызове executemany
+
+    Returns:
+        tuple: (количество добавленных писем, количество пропущенных писем)
+    """
+    register_functions(conn)
+    cursor = conn.cursor()
+
+    # Счетчики для статистики
+    added = 0
+    skipped = 0
+
+    emails = iter(emails)
+    while True:
+        chunk_emails = list(islice(emails, chunk_size))
+        senders = [parse_sender(email_info['from']) for email_info in chunk_emails]
+        cursor.executemany(
+            'INSERT OR IGNORE INTO senders (address, domain, display_name) VALUES (?, ?, ?)', senders
+        )
+
+        chunk = [
+            (
+                email_info['id'],
+                email_info['subject'],
+                email_info['from'],
+                email_info['date'],
+                make_preview(email_info['body']),
+                email_info.get('account'),
+                email_info.get('folder'),
+                email_info.get('uid'),
+                email_info.get('message_id'),
+                email_info.get('size'),
+                *(email_info.get('raw_location') or (None, None, None)),
+                email_info['date_ts'] if 'date_ts' in email_info else date_text_to_timestamp(email_info['date']),
+                sender[0]
+            )
+            for email_info, sender in zip(chunk_emails, senders)
+        ]
+        if not chunk:
+            break
+
+        cursor.executemany('''
+        INSERT OR IGNORE INTO emails (
+            email_id, subject, sender, date, preview, account, folder, uid, message_id, size,
+            raw_segment, raw_offset, raw_length, date_ts, sender_id
+        )
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, (SELECT id FROM senders WHERE address = ?))
+        ''', chunk)
+
+        # rowcount для executemany - сумма changes() по всем строкам пачки
+        added += cursor.rowcount
+        skipped += len(chunk) - cursor.rowcount
+
+        # Тела писем записываются отдельно; у писем, сохраненных только с заголовками, тела нет
+        cursor.executemany(
+            'INSERT OR IGNORE INTO email_bodies (email_id, body, compression) '
+            'SELECT id, ?, ? FROM emails WHERE email_id = ?',
+            [
+                (*compress_body(email_info['body']), email_info['id'])
+                for email_info in chunk_emails if email_info['body'] is not None
+            ]
+        )
+
+        store_attachments(conn, chunk_emails)
+
+    return added, skipped
+
+
+def store_attachments(conn, emails):
+    """
+    Добавляет метаданные вложений писем в таблицу attachments
+
+    Сами файлы к этому моменту уже сохранены в хранилище вложений.
+    Вложения, уже записанные для письма, повторно не добавляются.
+    Изменения не фиксируются: транзакцию завершает вызывающий код.
+
+    Args:
+        conn (sqlite3.Connection): Соединение с базой данных
+        emails (list): Письма в формате mail_to_json со списком attachments
+    """
+    rows = [
+        (
+            attachment['filename'], attachment['content_type'], attachment['sha256'],
+            attachment['size'], email_info['id'], attachment['sha256'], attachment['filename']
+        )
+        for email_info in emails
+        for attachment in email_info.get('attachments') or ()
+    ]
+    if not rows:
+        return
+
+    conn.executemany('''
+    INSERT INTO attachments (email_id, filename, content_type, sha256, size)
+    SELECT e.id, ?, ?, ?, ? FROM emails e
+    WHERE e.email_id = ? AND NOT EXISTS (
+        SELECT 1 FROM attachments a WHERE a.email_id = e.id AND a.sha256 = ? AND a.filename IS ?
+    )
+    ''', rows)
+
+
 def import_from_json(json_file):
-    """Импортирует данные из JSON файла в базу данных"""
+    """Импортирует данные из JSON или NDJSON файла в базу данных"""
 
     if not os.path.exists(json_file):
         print(f"Файл {json_file} не найден.")
@@ -107,41 +1108,15 @@ def import_from_json(json_file):
     print(f"Импорт данных из {json_file}...")
 
     try:
-        # Загружаем данные из JSON файла
-        with open(json_file, 'r', encoding='utf-8') as f:
-            emails_data = json.load(f)
+        # Читаем письма из файла по мере импорта
+        emails_data = iter_emails_from_file(json_file)
 
         # Подключаемся к базе данных
         conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-
-        # Счетчики для статистики
-        added = 0
-        skipped = 0
-
-        # Обрабатываем каждое письмо
-        for email_info in emails_data:
-            # Проверяем, существует ли уже письмо с таким email_id
-            cursor.execute('SELECT id FROM emails WHERE email_id = ?', (email_info['id'],))
-            existing = cursor.fetchone()
-
-            if existing:
-                skipped += 1
-                continue
+        migrate_database(conn)
 
-            # Добавляем новое письмо
-            cursor.execute('''
-            INSERT INTO emails (email_id, subject, sender, date, body)
-            VALUES (?, ?, ?, ?, ?)
-            ''', (
-                email_info['id'],
-                email_info['subject'],
-                email_info['from'],
-                email_info['date'],
-                email_info['body']
-            ))
-
-            added += 1
+        # Добавляем письма
+        added, skipped = store_emails(conn, emails_data)
 
         # Сохраняем изменения
         conn.commit()
@@ -167,23 +1142,22 @@ def show_database_stats():
         cursor = conn.cursor()
 
         # Получаем общее количество писем
-        cursor.execute('SELECT COUNT(*) FROM emails')
+        cursor.execute(COUNTERS_SQL)
         total_emails = cursor.fetchone()[0]
 
         # Получаем количество писем по отправителям
-        cursor.execute('''
-        SELECT sender, COUNT(*) as count
-        FROM emails
-        GROUP BY sender
-        ORDER BY count DESC
-        LIMIT 5
-        ''')
+        cursor.execute(TOP_SENDERS_SQL, (5,))
         top_senders = cursor.fetchall()
 
+        # Получаем количество писем по доменам отправителей
+        cursor.execute(TOP_DOMAINS_SQL, (5,))
+        top_domains = cursor.fetchall()
+
         # Получаем количество писем по датам
         cursor.execute('''
-        SELECT substr(date, 1, 10) as day, COUNT(*) as count
+        SELECT date(date_ts, 'unixepoch') as day, COUNT(*) as count
         FROM emails
+        WHERE date_ts IS NOT NULL
         GROUP BY day
         ORDER BY day DESC
         LIMIT 5
@@ -194,6 +1168,10 @@ def show_database_stats():
         cursor.execute('SELECT COUNT(*) FROM categories')
         total_categories = cursor.fetchone()[0]
 
+        # Получаем количество и размер сохраненных тел писем
+        cursor.execute('SELECT COUNT(*), COALESCE(SUM(length(CAST(body AS BLOB))), 0) FROM email_bodies')
+        total_bodies, bodies_size = cursor.fetchone()
+
         # Закрываем соединение
         conn.close()
 
@@ -201,11 +1179,16 @@ def show_database_stats():
         print("\n=== Статистика базы данных ===")
         print(f"Всего писем: {total_emails}")
         print(f"Всего категорий: {total_categories}")
+        print(f"Тел писем: {total_bodies} ({bodies_size / 1024 / 1024:.1f} МБ)")
 
         print("\nТоп отправителей:")
         for sender, count in top_senders:
             print(f"  - {sender}: {count} писем")
 
+        print("\nТоп доменов отправителей:")
+        for domain, count in top_domains:
+            print(f"  - {domain}: {count} писем")
+
         print("\nПисьма по датам:")
         for date, count in emails_by_date:
             print(f"  - {date}: {count} писем")
@@ -1,7 +1,94 @@
 import sqlite3
 import os
 import json
-from datetime import datetime
+import threading
+from datetime import datetime, timezone
+
+import attachment_store
+import raw_archive
+from search import FTS_JOIN_SQL, make_match_query
+from create_database import (
+    CATEGORY_STATS_SQL, COUNTERS_SQL, TOP_DOMAINS_SQL, TOP_SENDERS_SQL, get_body, get_email_categories,
+    register_functions
+)
+
+def day_to_timestamp(day):
+    """
+    Преобразует дату в формате YYYY-MM-DD в Unix-время начала дня (UTC)
+
+    Raises:
+        ValueError: Дата не в формате YYYY-MM-DD
+    """
+    try:
+        return int(datetime.strptime(day, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp())
+    except (ValueError, TypeError):
+        raise ValueError(f"Некорректная дата {day!r}: ожидается формат YYYY-MM-DD") from None
+
+def build_search_query(match=None, sender=None, date_from=None, date_to=None, category=None, processed=None,
+                       limit=10):
+    """
+    Строит запрос поиска писем (EmailManager.search_emails)
+
+    Args:
+        match (str): Выражение MATCH для полнотекстового поиска (search.make_match_query)
+        sender (str): Фильтр по отправителю
+        date_from (str): Начальная дата в формате YYYY-MM-DD (UTC)
+        date_to (str): Конечная дата в формате YYYY-MM-DD (UTC), включительно
+        category (str): Название категории
+        processed (bool): Только обработанные (True) или только необработанные (False) письма
+        limit (int): Максимальное количество результатов
+
+    Returns:
+        tuple: (SQL запрос, параметры)
+
+    Raises:
+        ValueError: Дата date_from или date_to не в формате YYYY-MM-DD
+    """
+    # Строим SQL запрос
+    sql = "SELECT e.id, e.email_id, e.subject, e.sender, e.date, e.preview FROM emails e"
+    params = []
+    conditions = []
+    
+    # Добавляем полнотекстовый поиск по индексу emails_fts
+    if match:
+        sql += FTS_JOIN_SQL
+        params.append(match)
+    
+    if sender:
+        # Ищем по небольшой таблице отправителей, а письма отбираем по индексу sender_id
+        conditions.append(
+            "e.sender_id IN (SELECT id FROM senders WHERE address LIKE ? OR display_name LIKE ?)"
+        )
+        params.extend([f"%{sender}%", f"%{sender}%"])
+    
+    # Даты сравниваются в Unix-времени (UTC) по индексу idx_emails_date_ts
+    if date_from:
+        conditions.append("e.date_ts >= ?")
+        params.append(day_to_timestamp(date_from))
+    
+    if date_to:
+        # Включаем в выборку весь последний день
+        conditions.append("e.date_ts < ?")
+        params.append(day_to_timestamp(date_to) + 24 * 60 * 60)
+    
+    # Отбор по статусу обработки и сортировка по дате - по индексу idx_emails_processed_date_ts
+    if processed is not None:
+        conditions.append("e.is_processed = ?")
+        params.append(1 if processed else 0)
+    
+    if category:
+        sql += " JOIN email_categories ec ON e.id = ec.email_id JOIN categories c ON ec.category_id = c.id"
+        conditions.append("c.name = ?")
+        params.append(category)
+    
+    # Собираем условия в WHERE клаузу
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    
+    # Добавляем сортировку и лимит: при поиске по запросу - сначала самые релевантные письма
+    sql += " ORDER BY f.rank, e.date_ts DESC LIMIT ?" if match else " ORDER BY e.date_ts DESC LIMIT ?"
+    params.append(limit)
+    return sql, params
 
 class EmailManager:
     """Класс для управления электронными письмами в базе данных SQLite"""
@@ -16,65 +103,55 @@ class EmailManager:
     
     def connect(self):
         """Создает и возвращает соединение с базой данных"""
-        return sqlite3.connect(self.db_path)
+        conn = sqlite3.connect(self.db_path)
+        register_functions(conn)
+        return conn
     
-    def search_emails(self, query=None, sender=None, date_from=None, date_to=None, category=None, limit=10):
+    def search_emails(self, query=None, sender=None, date_from=None, date_to=None, category=None, processed=None,
+                      limit=10, syntax=False):
         """
         Поиск писем по различным критериям
         
         Args:
-            query (str): Поисковый запрос для поиска в теме и теле письма
+            query (str): Поисковый запрос для полнотекстового поиска по теме, отправителю и телу письма
             sender (str): Фильтр по отправителю
-            date_from (str): Начальная дата в формате YYYY-MM-DD
-            date_to (str): Конечная дата в формате YYYY-MM-DD
+            date_from (str): Начальная дата в формате YYYY-MM-DD (UTC)
+            date_to (str): Конечная дата в формате YYYY-MM-DD (UTC), включительно
             category (str): Название категории
+            processed (bool): Только обработанные (True) или только необработанные (False) письма
             limit (int): Максимальное количество результатов
+            syntax (bool): Запрос написан на языке запросов FTS5 (см. search.make_match_query)
             
         Returns:
-            list: Список писем, соответствующих критериям поиска
+            list: Список писем с их категориями, соответствующих критериям поиска;
+                  при поиске по запросу - в порядке релевантности
         """
+        # Полнотекстовый поиск по индексу emails_fts
+        match = make_match_query(query, syntax) if query else None
+        try:
+            sql, params = build_search_query(match, sender, date_from, date_to, category, processed, limit)
+        except ValueError as e:
+            print(f"Ошибка в фильтре по дате: {str(e)}")
+            return []
+        
         conn = self.connect()
         cursor = conn.cursor()
         
-        # Строим SQL запрос
-        sql = "SELECT e.id, e.email_id, e.subject, e.sender, e.date, e.body FROM emails e"
-        params = []
-        conditions = []
-        
-        # Добавляем условия поиска
-        if query:
-            conditions.append("(e.subject LIKE ? OR e.body LIKE ?)")
-            params.extend([f"%{query}%", f"%{query}%"])
-        
-        if sender:
-            conditions.append("e.sender LIKE ?")
-            params.append(f"%{sender}%")
-        
-        if date_from:
-            conditions.append("e.date >= ?")
-            params.append(date_from)
-        
-        if date_to:
-            conditions.append("e.date <= ?")
-            params.append(date_to)
-        
-        if category:
-            sql += " JOIN email_categories ec ON e.id = ec.email_id JOIN categories c ON ec.category_id = c.id"
-            conditions.append("c.name = ?")
-            params.append(category)
-        
-        # Собираем условия в WHERE клаузу
-        if conditions:
-            sql += " WHERE " + " AND ".join(conditions)
-        
-        # Добавляем сортировку и лимит
-        sql += " ORDER BY e.date DESC LIMIT ?"
-        params.append(limit)
-        
         # Выполняем запрос
-        cursor.execute(sql, params)
+        try:
+            cursor.execute(sql, params)
+        except sqlite3.OperationalError as e:
+            conn.close()
+            # Запрос на языке FTS5 может содержать ошибку
+            if match and syntax:
+                print(f"Ошибка в поисковом запросе: {str(e)}")
+                return []
+            raise
         results = cursor.fetchall()
         
+        # Категории всех найденных писем - одним запросом
+        categories = get_email_categories(conn, [row[0] for row in results])
+        
         # Преобразуем результаты в список словарей
         emails = []
         for row in results:
@@ -84,7 +161,9 @@ class EmailManager:
                 "subject": row[2],
                 "sender": row[3],
                 "date": row[4],
-                "body": row[5][:200] + "..." if len(row[5]) > 200 else row[5]  # Ограничиваем длину тела
+                # Краткий текст письма; пустой, если тело еще не загружено с сервера
+                "body": row[5] or "",
+                "categories": categories[row[0]]
             })
         
         conn.close()
@@ -104,24 +183,30 @@ class EmailManager:
         cursor = conn.cursor()
         
         # Получаем информацию о письме
-        cursor.execute("SELECT * FROM emails WHERE id = ?", (email_id,))
+        cursor.execute(
+            "SELECT id, email_id, subject, sender, date, date_received, is_processed FROM emails WHERE id = ?",
+            (email_id,)
+        )
         email_data = cursor.fetchone()
         
         if not email_data:
             conn.close()
             return None
         
+        # Письмо сохранено только с заголовками - загружаем тело с сервера
+        body = get_body(conn, email_id)
+        if body is None and self.download_bodies([email_id]):
+            body = get_body(conn, email_id)
+        
         # Получаем категории письма
-        cursor.execute("""
-            SELECT c.name FROM categories c
-            JOIN email_categories ec ON c.id = ec.category_id
-            WHERE ec.email_id = ?
-        """, (email_id,))
-        categories = [row[0] for row in cursor.fetchall()]
+        categories = get_email_categories(conn, [email_id])[email_id]
         
         # Получаем вложения письма
-        cursor.execute("SELECT id, filename, content_type FROM attachments WHERE email_id = ?", (email_id,))
-        attachments = [{"id": row[0], "filename": row[1], "content_type": row[2]} for row in cursor.fetchall()]
+        cursor.execute("SELECT id, filename, content_type, size FROM attachments WHERE email_id = ?", (email_id,))
+        attachments = [
+            {"id": row[0], "filename": row[1], "content_type": row[2], "size": row[3]}
+            for row in cursor.fetchall()
+        ]
         
         # Формируем результат
         result = {
@@ -131,8 +216,8 @@ class EmailManager:
             "sender": email_data[3],
             "date": email_data[4],
             "date_received": email_data[5],
-            "body": email_data[6],
-            "is_processed": bool(email_data[7]),
+            "body": body,
+            "is_processed": bool(email_data[6]),
             "categories": categories,
             "attachments": attachments
         }
@@ -140,6 +225,138 @@ class EmailManager:
         conn.close()
         return result
     
+    def get_attachment(self, attachment_id):
+        """
+        Получает вложение по его ID
+        
+        Args:
+            attachment_id (int): ID вложения в таблице attachments
+            
+        Returns:
+            dict: Имя файла, тип, размер и путь к файлу в хранилище вложений или None
+        """
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT filename, content_type, size, sha256 FROM attachments WHERE id = ?",
+            (attachment_id,)
+        )
+        row = cursor.fetchone()
+        conn.close()
+        
+        if not row or not row[3]:
+            return None
+        
+        return {
+            "filename": row[0],
+            "content_type": row[1],
+            "size": row[2],
+            "path": attachment_store.attachment_path(attachment_store.get_store_dir(self.db_path), row[3])
+        }
+    
+    def get_raw_email(self, email_id):
+        """
+        Получает исходное письмо в формате RFC 822 из архива исходных писем
+        
+        Args:
+            email_id (int): ID письма в базе данных
+            
+        Returns:
+            bytes: Исходное письмо или None, если письмо не сохранено в архиве
+        """
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute("SELECT raw_segment, raw_offset, raw_length FROM emails WHERE id = ?", (email_id,))
+        row = cursor.fetchone()
+        conn.close()
+        
+        if not row or row[0] is None:
+            return None
+        
+        return self.get_archive().read(*row)
+    
+    def get_archive(self):
+        """Возвращает архив исходных писем, расположенный рядом с базой данных"""
+        return raw_archive.get_archive(raw_archive.get_archive_dir(self.db_path))
+    
+    def reparse_emails(self, ids=None, commit_every=500):
+        """
+        Заново разбирает письма из архива исходных писем без обращения к серверу
+        
+        Обновляет тела писем и вложения, например после изменения правил разбора писем.
+        
+        Args:
+            ids (list): ID писем; по умолчанию все письма, сохраненные в архиве
+            commit_every (int): Количество писем в одной транзакции
+            
+        Returns:
+            int: Количество разобранных писем
+        """
+        import email
+        from create_database import save_body, store_attachments
+        from mail_to_json import get_email_attachments, get_email_body
+        
+        sql = "SELECT id, email_id, raw_segment, raw_offset, raw_length FROM emails WHERE raw_segment IS NOT NULL"
+        params = []
+        if ids is not None:
+            sql += f" AND id IN ({','.join('?' * len(ids))})"
+            params.extend(ids)
+        
+        archive = self.get_archive()
+        attachments_dir = attachment_store.get_store_dir(self.db_path)
+        
+        conn = self.connect()
+        count = 0
+        try:
+            for row_id, email_id, segment, offset, length in conn.execute(sql, params).fetchall():
+                email_message = email.message_from_bytes(archive.read(segment, offset, length))
+                save_body(conn, row_id, get_email_body(email_message))
+                store_attachments(conn, [{
+                    "id": email_id,
+                    "attachments": get_email_attachments(email_message, attachments_dir)
+                }])
+                count += 1
+                if count % commit_every == 0:
+                    conn.commit()
+            conn.commit()
+        finally:
+            conn.close()
+        
+        return count
+    
+    def download_bodies(self, ids=None, limit=None):
+        """
+        Загружает с сервера тела писем, сохраненных только с заголовками
+        
+        Args:
+            ids (list): ID писем; по умолчанию все письма без тела
+            limit (int): Максимальное количество писем
+            
+        Returns:
+            int: Количество загруженных тел писем
+        """
+        from mail_to_json import download_bodies
+        
+        conn = self.connect()
+        try:
+            return download_bodies(conn, ids, limit)
+        except Exception as e:
+            print(f"Ошибка при загрузке тел писем: {str(e)}")
+            return 0
+        finally:
+            conn.close()
+    
+    def download_bodies_in_background(self, limit=None):
+        """
+        Запускает загрузку тел писем в фоновом потоке
+        
+        Returns:
+            threading.Thread: Поток загрузки
+        """
+        thread = threading.Thread(target=self.download_bodies, kwargs={"limit": limit}, daemon=True)
+        thread.start()
+        return thread
+    
     def add_email_to_category(self, email_id, category_name):
         """
         Добавляет письмо в указанную категорию
@@ -277,34 +494,22 @@ class EmailManager:
         conn = self.connect()
         cursor = conn.cursor()
         
-        # Общее количество писем
-        cursor.execute("SELECT COUNT(*) FROM emails")
-        total_emails = cursor.fetchone()[0]
-        
-        # Количество обработанных писем
-        cursor.execute("SELECT COUNT(*) FROM emails WHERE is_processed = 1")
-        processed_emails = cursor.fetchone()[0]
+        # Общее количество писем и количество обработанных писем - из счетчиков email_stats
+        cursor.execute(COUNTERS_SQL)
+        total_emails, processed_emails = cursor.fetchone()
         
         # Количество писем по категориям
-        cursor.execute("""
-            SELECT c.name, COUNT(ec.email_id) as count
-            FROM categories c
-            LEFT JOIN email_categories ec ON c.id = ec.category_id
-            GROUP BY c.id
-            ORDER BY count DESC
-        """)
-        categories_stats = [{"name": row[0], "count": row[1]} for row in cursor.fetchall()]
+        cursor.execute(CATEGORY_STATS_SQL + " ORDER BY count DESC")
+        categories_stats = [{"name": row[1], "count": row[3]} for row in cursor.fetchall()]
         
         # Количество писем по отправителям
-        cursor.execute("""
-            SELECT sender, COUNT(*) as count
-            FROM emails
-            GROUP BY sender
-            ORDER BY count DESC
-            LIMIT 5
-        """)
+        cursor.execute(TOP_SENDERS_SQL, (5,))
         senders_stats = [{"sender": row[0], "count": row[1]} for row in cursor.fetchall()]
         
+        # Количество писем по доменам отправителей
+        cursor.execute(TOP_DOMAINS_SQL, (5,))
+        domains_stats = [{"domain": row[0], "count": row[1]} for row in cursor.fetchall()]
+        
         conn.close()
         
         return {
@@ -312,7 +517,8 @@ class EmailManager:
             "processed_emails": processed_emails,
             "unprocessed_emails": total_emails - processed_emails,
             "categories": categories_stats,
-            "top_senders": senders_stats
+            "top_senders": senders_stats,
+            "top_domains": domains_stats
         }
 
 # Пример использования
@@ -0,0 +1,329 @@
+"""
+Локальный IMAP-сервер с синтетическим почтовым ящиком
+
+Позволяет проверять и сравнивать способы загрузки писем без доступа к mail.ru.
+Поддерживается подмножество IMAP4rev1, которое используют скрипты проекта:
+LOGIN, SELECT, LIST, SEARCH, FETCH (RFC822, BODY[], BODY.PEEK[HEADER.FIELDS],
+RFC822.SIZE, FLAGS, MODSEQ, CHANGEDSINCE), UID-варианты команд и IDLE.
+
+Чтобы скрипты подключались к локальному серверу, задайте переменные окружения:
+IMAP_SERVER=127.0.0.1, IMAP_PORT=<порт> и IMAP_SSL=0.
+"""
+import re
+import select
+import socketserver
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from email.message import EmailMessage
+from email.utils import format_datetime
+
+def make_message(number, parts=1, body_size=500):
+    """
+    Создает синтетическое письмо
+
+    Args:
+        number (int): Номер письма, от него зависят тема, отправитель и дата
+        parts (int): Количество частей MIME (текст и parts - 1 вложений)
+        body_size (int): Размер текста письма в символах
+
+    Returns:
+        bytes: Письмо в формате RFC 822
+    """
+    msg = EmailMessage()
+    msg["Subject"] = f"Письмо номер {number}: счет на оплату"
+    msg["From"] = f"Отправитель {number % 7} <sender{number % 7}@example{number % 3}.ru>"
+    msg["Date"] = format_datetime(
+        datetime(2025, 1, 1, tzinfo=timezone(timedelta(hours=3))) + timedelta(minutes=number)
+    )
+    msg["Message-ID"] = f"<msg{number}@example.ru>"
+
+    text = f"Текст письма {number}. Счета и платежи. "
+    msg.set_content((text * (body_size // len(text) + 1))[:body_size])
+
+    # Вложения повторяются, чтобы письма содержали одинаковые файлы
+    for part in range(1, parts):
+        msg.add_attachment(
+            f"attachment {part % 2}\n".encode() * 100,
+            maintype="application", subtype="pdf", filename=f"file{part % 2}.pdf"
+        )
+    return msg.as_bytes()
+
+
+class Mailbox:
+    """Синтетический почтовый ящик, который обслуживает сервер"""
+
+    def __init__(self, count=100, folders=("INBOX",), parts=1, body_size=500, latency=0.0):
+        """
+        Args:
+            count (int): Количество писем в каждой папке
+            folders (tuple): Имена папок
+            parts (int): Количество частей MIME в каждом письме
+            body_size (int): Размер текста письма в символах
+            latency (float): Задержка перед ответом на каждую команду в секундах
+        """
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.bytes_sent = 0
+        self.folders = {}
+        for folder in folders:
+            self.folders[folder] = {"uidvalidity": 1000, "next_uid": 1, "modseq": 1, "messages": []}
+            for number in range(count):
+                self.append(folder, make_message(number, parts, body_size))
+
+    def append(self, folder, raw_email, flags=()):
+        """Добавляет письмо в папку и возвращает его UID"""
+        with self.lock:
+            box = self.folders[folder]
+            box["modseq"] += 1
+            uid = box["next_uid"]
+            box["messages"].append({
+                "uid": uid, "raw": raw_email, "flags": list(flags), "modseq": box["modseq"]
+            })
+            box["next_uid"] += 1
+            return uid
+
+    def expunge(self, folder, uid):
+        """Удаляет письмо из папки"""
+        with self.lock:
+            box = self.folders[folder]
+            box["messages"] = [msg for msg in box["messages"] if msg["uid"] != uid]
+
+    def set_flags(self, folder, uid, flags):
+        """Заменяет флаги письма"""
+        with self.lock:
+            box = self.folders[folder]
+            for msg in box["messages"]:
+                if msg["uid"] == uid:
+                    box["modseq"] += 1
+                    msg["flags"] = list(flags)
+                    msg["modseq"] = box["modseq"]
+
+    def reset_uidvalidity(self, folder):
+        """Имитирует переназначение UID писем папки на сервере"""
+        with self.lock:
+            self.folders[folder]["uidvalidity"] += 1
+
+    def total_size(self):
+        """Возвращает суммарный размер всех писем в байтах"""
+        return sum(len(msg["raw"]) for box in self.folders.values() for msg in box["messages"])
+
+
+def in_set(number, spec, max_number):
+    """Проверяет, входит ли номер в набор IMAP вида 1:5,7,10:*"""
+    for part in spec.split(","):
+        if ":" in part:
+            start, end = (max_number if value == "*" else int(value) for value in part.split(":"))
+            if min(start, end) <= number <= max(start, end):
+                return True
+        elif (max_number if part == "*" else int(part)) == number:
+            return True
+    return False
+
+
+class IMAPHandler(socketserver.StreamRequestHandler):
+    """Обработчик одного IMAP-соединения"""
+
+    def send(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.wfile.write(data)
+        with self.server.mailbox.lock:
+            self.server.mailbox.bytes_sent += len(data)
+
+    def handle(self):
+        mailbox = self.server.mailbox
+        self.folder = None
+        self.send("* OK IMAP4rev1 test server ready\r\n")
+
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            line = line.decode().rstrip("\r\n")
+            if not line:
+                continue
+            if mailbox.latency:
+                time.sleep(mailbox.latency)
+
+            tag, _, rest = line.partition(" ")
+            command, _, args = rest.partition(" ")
+            command = command.upper()
+            uid_mode = command == "UID"
+            if uid_mode:
+                command, _, args = args.partition(" ")
+                command = command.upper()
+
+            if command == "CAPABILITY":
+                self.send("* CAPABILITY IMAP4rev1 IDLE CONDSTORE\r\n")
+            elif command in ("LOGIN", "NOOP"):
+                pass
+            elif command == "LOGOUT":
+                self.send("* BYE logging out\r\n")
+                self.send(f"{tag} OK LOGOUT completed\r\n")
+                return
+            elif command in ("SELECT", "EXAMINE"):
+                if not self.select(tag, args.strip().strip('"')):
+                    continue
+            elif command == "CLOSE":
+                self.folder = None
+            elif command == "LIST":
+                for name in mailbox.folders:
+                    self.send(f'* LIST (\\HasNoChildren) "/" "{name}"\r\n')
+            elif command == "SEARCH" and self.folder:
+                self.search(args, uid_mode)
+            elif command == "FETCH" and self.folder:
+                self.fetch(args, uid_mode)
+            elif command == "IDLE" and self.folder:
+                self.idle(tag)
+                continue
+            else:
+                self.send(f"{tag} BAD command not supported\r\n")
+                continue
+            self.send(f"{tag} OK {command} completed\r\n")
+
+    def messages(self):
+        """Возвращает пары (порядковый номер, письмо) выбранной папки"""
+        with self.server.mailbox.lock:
+            return list(enumerate(self.server.mailbox.folders[self.folder]["messages"], 1))
+
+    def select(self, tag, folder):
+        mailbox = self.server.mailbox
+        if folder not in mailbox.folders:
+            self.send(f"{tag} NO folder not found\r\n")
+            return False
+        self.folder = folder
+        box = mailbox.folders[folder]
+        self.send(f"* {len(box['messages'])} EXISTS\r\n* 0 RECENT\r\n")
+        self.send(f"* OK [UIDVALIDITY {box['uidvalidity']}] UIDs valid\r\n")
+        self.send(f"* OK [UIDNEXT {box['next_uid']}] predicted next UID\r\n")
+        self.send(f"* OK [HIGHESTMODSEQ {box['modseq']}] highest modseq\r\n")
+        return True
+
+    def select_messages(self, spec, uid_mode):
+        messages = self.messages()
+        if uid_mode:
+            max_uid = messages[-1][1]["uid"] if messages else 0
+            return [(seq, msg) for seq, msg in messages if in_set(msg["uid"], spec, max_uid)]
+        return [(seq, msg) for seq, msg in messages if in_set(seq, spec, len(messages))]
+
+    def search(self, args, uid_mode):
+        # Поддерживаются только критерии ALL и UID <набор>
+        tokens = args.split()
+        if tokens and tokens[0].upper() == "CHARSET":
+            tokens = tokens[2:]
+        if len(tokens) >= 2 and tokens[0].upper() == "UID":
+            found = self.select_messages(tokens[1], True)
+        else:
+            found = self.messages()
+        numbers = [str(msg["uid"] if uid_mode else seq) for seq, msg in found]
+        self.send("* SEARCH " + " ".join(numbers) + "\r\n")
+
+    def fetch(self, args, uid_mode):
+        spec, _, items = args.partition(" ")
+        changed_since = None
+        match = re.search(r"\(CHANGEDSINCE (\d+)\)\s*$", items, re.I)
+        if match:
+            changed_since = int(match.group(1))
+            items = items[:match.start()].strip()
+        upper = items.upper()
+
+        for seq, msg in self.select_messages(spec, uid_mode):
+            if changed_since is not None and msg["modseq"] <= changed_since:
+                continue
+
+            parts = [f"UID {msg['uid']}"]
+            if "FLAGS" in upper:
+                parts.append("FLAGS (" + " ".join(msg["flags"]) + ")")
+            if "MODSEQ" in upper or changed_since is not None:
+                parts.append(f"MODSEQ ({msg['modseq']})")
+            if "RFC822.SIZE" in upper:
+                parts.append(f"RFC822.SIZE {len(msg['raw'])}")
+
+            literal = None
+            match = re.search(r"BODY(?:\.PEEK)?\[HEADER\.FIELDS \(([^)]*)\)\]", items, re.I)
+            if match:
+                fields = match.group(1).upper()
+                wanted = set(fields.split())
+                header = re.split(rb"\r?\n\r?\n", msg["raw"], 1)[0]
+                lines = [
+                    line for line in re.split(rb"\r?\n(?![ \t])", header)
+                    if line.split(b":", 1)[0].decode().upper() in wanted
+                ]
+                literal = (f"BODY[HEADER.FIELDS ({fields})]", b"\r\n".join(lines) + b"\r\n\r\n")
+            elif re.search(r"RFC822(?![.\w])", items, re.I):
+                literal = ("RFC822", msg["raw"])
+            elif re.search(r"BODY(?:\.PEEK)?\[\]", items, re.I):
+                literal = ("BODY[]", msg["raw"])
+
+            response = f"* {seq} FETCH (" + " ".join(parts)
+            if literal:
+                name, data = literal
+                self.send(f"{response} {name} {{{len(data)}}}\r\n".encode() + data + b")\r\n")
+            else:
+                self.send(response + ")\r\n")
+
+    def idle(self, tag):
+        # О новых письмах сообщаем, пока клиент не пришлет DONE
+        box = self.server.mailbox.folders[self.folder]
+        known = len(box["messages"])
+        self.send("+ idling\r\n")
+        while True:
+            ready, _, _ = select.select([self.connection], [], [], 0.05)
+            if ready:
+                if not self.rfile.readline():
+                    return
+                break
+            if len(box["messages"]) != known:
+                known = len(box["messages"])
+                self.send(f"* {known} EXISTS\r\n")
+        self.send(f"{tag} OK IDLE terminated\r\n")
+
+
+class FakeIMAPServer(socketserver.ThreadingTCPServer):
+    """Многопоточный IMAP-сервер, каждое соединение обслуживается в своем потоке"""
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, mailbox, host="127.0.0.1", port=0):
+        """
+        Args:
+            mailbox (Mailbox): Почтовый ящик, который обслуживает сервер
+            host (str): Адрес для входящих соединений
+            port (int): Порт (0 - любой свободный)
+        """
+        super().__init__((host, port), IMAPHandler)
+        self.mailbox = mailbox
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        """Запускает сервер в фоновом потоке"""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        """Останавливает сервер"""
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == "__main__":
+    try:
+        count = int(input("Введите количество писем в ящике (по умолчанию 1000): ") or "1000")
+        parts = int(input("Введите количество частей MIME в письме (по умолчанию 1): ") or "1")
+        latency = float(input("Введите задержку ответа сервера в секундах (по умолчанию 0): ") or "0")
+    except ValueError:
+        count, parts, latency = 1000, 1, 0.0
+        print("Некорректный ввод, будут использованы значения по умолчанию")
+
+    server = FakeIMAPServer(Mailbox(count, parts=parts, latency=latency), port=1143)
+    print(f"Сервер запущен на 127.0.0.1:{server.port}")
+    print("Для подключения задайте IMAP_SERVER=127.0.0.1, IMAP_PORT=1143, IMAP_SSL=0")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -0,0 +1,220 @@
+import imaplib
+import os
+import select
+import sqlite3
+import ssl
+import threading
+import time
+
+import create_database
+from async_ingest import load_accounts
+from mail_to_json import connect_imap
+from mail_to_db import sync_folder_to_database
+
+# RFC 2177 рекомендует перезапускать IDLE не реже, чем раз в 29 минут
+IDLE_TIMEOUT = 29 * 60
+
+# Пауза между попытками переподключения: от 1 секунды до 5 минут
+RECONNECT_DELAY = 1
+MAX_RECONNECT_DELAY = 300
+
+# Сколько секунд поток ждет, пока база данных занята записью другого потока
+DB_TIMEOUT = 60
+
+def _has_buffered_line(mail):
+    """
+    Проверяет без блокировки, есть ли в буфере imaplib полностью прочитанная строка
+
+    Буфер проверяется через peek на время переведенного в неблокирующий режим
+    сокета: при пустом буфере peek не ждет данных от сервера.
+    """
+    mail.sock.setblocking(False)
+    try:
+        return b"\n" in mail.file.peek()
+    except (BlockingIOError, ssl.SSLWantReadError):
+        return False
+    finally:
+        mail.sock.setblocking(True)
+
+
+def _wait_readable(mail, timeout):
+    """Ожидает данные от сервера не дольше timeout секунд"""
+    if _has_buffered_line(mail):
+        return True
+    # Расшифрованные, но еще не прочитанные данные SSL не видны select
+    if isinstance(mail.sock, ssl.SSLSocket) and mail.sock.pending():
+        return True
+    ready, _, _ = select.select([mail.sock], [], [], timeout)
+    return bool(ready)
+
+
+def idle_wait(mail, timeout=IDLE_TIMEOUT, stop_event=None):
+    """
+    Ожидает изменений в выбранной папке командой IDLE
+
+    imaplib не поддерживает IDLE, поэтому команда отправляется вручную,
+    а ответы сервера читаются только после того, как select сообщит о данных.
+
+    Args:
+        mail (imaplib.IMAP4): Соединение с выбранной папкой
+        timeout (int): Максимальное время ожидания в секундах
+        stop_event (threading.Event): Событие остановки демона
+
+    Returns:
+        bool: True если сервер сообщил о новых письмах (EXISTS)
+    """
+    tag = mail._new_tag().decode()
+    mail.send(f"{tag} IDLE\r\n".encode())
+
+    response = mail.readline()
+    if not response.startswith(b"+"):
+        raise imaplib.IMAP4.error(f"Сервер не поддерживает IDLE: {response!r}")
+
+    has_new = False
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline and not (stop_event and stop_event.is_set()):
+        # Раз в секунду проверяем событие остановки
+        if not _wait_readable(mail, 1):
+            continue
+        line = mail.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("Соединение закрыто сервером")
+        if line.rstrip().endswith(b"EXISTS"):
+            has_new = True
+            break
+
+    # Завершаем IDLE и дочитываем ответ на команду
+    mail.send(b"DONE\r\n")
+    while True:
+        line = mail.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("Соединение закрыто сервером")
+        if line.startswith(tag.encode()):
+            break
+        if line.rstrip().endswith(b"EXISTS"):
+            has_new = True
+
+    return has_new
+
+
+def watch_folder(account, folder, stop_event, batch_size=200, headers_only=False):
+    """
+    Держит IDLE-сессию с папкой и сохраняет новые письма в базу данных сразу после их появления
+
+    При обрыве соединения или ошибке базы данных (например, база занята записью
+    другого потока) переподключается с экспоненциально растущей паузой.
+
+    Args:
+        account (dict): Учетная запись из async_ingest.load_accounts
+        folder (str): Имя папки
+        stop_event (threading.Event): Событие остановки демона
+        batch_size (int): Количество писем в одной команде FETCH
+        headers_only (bool): Загружать только заголовки и размер писем
+    """
+    name = f"{account['email']}/{folder}"
+    delay = RECONNECT_DELAY
+    conn = sqlite3.connect(create_database.DB_PATH, timeout=DB_TIMEOUT)
+
+    try:
+        while not stop_event.is_set():
+            mail = None
+            try:
+                mail = connect_imap(account["server"], account["port"])
+                mail.login(account["email"], account["password"])
+                print(f"{name}: соединение установлено")
+
+                # Догружаем письма, пришедшие пока демон не работал
+                has_new = True
+                while not stop_event.is_set():
+                    if has_new:
+                        result = sync_folder_to_database(
+                            mail, conn, folder, account["email"], max_emails=None,
+                            batch_size=batch_size, incremental=True, headers_only=headers_only
+                        )
+                        if result is None:
+                            raise imaplib.IMAP4.error(f"Не удалось синхронизировать папку {folder}")
+                        if result[0]:
+                            print(f"{name}: сохранено новых писем: {result[0]}")
+
+                    delay = RECONNECT_DELAY
+                    has_new = idle_wait(mail, IDLE_TIMEOUT, stop_event)
+
+            except (imaplib.IMAP4.error, OSError, sqlite3.Error) as e:
+                # Незавершенная пачка писем не должна остаться в транзакции
+                conn.rollback()
+                if stop_event.is_set():
+                    break
+                kind = "базы данных" if isinstance(e, sqlite3.Error) else "соединения"
+                print(f"{name}: ошибка {kind} ({e}), повтор через {delay} с")
+                stop_event.wait(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+            finally:
+                if mail is not None:
+                    try:
+                        mail.logout()
+                    except Exception:
+                        pass
+    finally:
+        conn.close()
+
+
+def run_daemon(accounts=None, batch_size=200, headers_only=False, stop_event=None):
+    """
+    Запускает наблюдение за всеми папками всех учетных записей
+
+    Для каждой папки открывается отдельное соединение в отдельном потоке.
+
+    Args:
+        accounts (list): Учетные записи; по умолчанию загружаются из переменных окружения
+        batch_size (int): Количество писем в одной команде FETCH
+        headers_only (bool): Загружать только заголовки и размер писем
+        stop_event (threading.Event): Событие остановки; по умолчанию демон работает до Ctrl+C
+
+    Returns:
+        bool: False если запустить демон не удалось
+    """
+    if not os.path.exists(create_database.DB_PATH):
+        print(f"База данных {create_database.DB_PATH} не найдена. Сначала создайте базу данных.")
+        return False
+
+    conn = sqlite3.connect(create_database.DB_PATH, timeout=DB_TIMEOUT)
+    create_database.migrate_database(conn)
+    # В режиме WAL чтение не ждет записи, а потоки папок меньше блокируют друг друга
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.close()
+
+    accounts = accounts if accounts is not None else load_accounts()
+    if not accounts:
+        print("Не найдено ни одной учетной записи (EMAIL_<ИМЯ>/PASSWORD_<ИМЯ>)")
+        return False
+
+    stop_event = stop_event or threading.Event()
+    threads = []
+    for account in accounts:
+        for folder in account["folders"]:
+            thread = threading.Thread(
+                target=watch_folder,
+                args=(account, folder, stop_event, batch_size, headers_only),
+                daemon=True
+            )
+            thread.start()
+            threads.append(thread)
+
+    print(f"Наблюдение за папками запущено: {len(threads)}. Для остановки нажмите Ctrl+C")
+    try:
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(timeout=1)
+    except KeyboardInterrupt:
+        print("\nОстановка...")
+        stop_event.set()
+        for thread in threads:
+            thread.join()
+
+    return True
+
+
+if __name__ == "__main__":
+    headers_only = input("Загружать только заголовки писем (тела будут загружены по запросу)? (y/n): ").lower() == 'y'
+    run_daemon(headers_only=headers_only)
@@ -0,0 +1,215 @@
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+
+import create_database
+from mail_to_json import (
+    EmailWriter, connect_imap, email_address, app_password,
+    iter_emails_info, select_folder, search_uids
+)
+
+def sync_folder_to_database(mail, conn, folder="INBOX", account=None, max_emails=10, batch_size=200,
+                            incremental=False, headers_only=False, executor=None, writer=None,
+                            commit_every=500):
+    """
+    Загружает письма папки через открытое соединение и сохраняет их в базу данных
+
+    Письма добавляются в таблицу emails пачками, каждая пачка - в своей транзакции.
+    В инкрементальном режиме вместе с каждой пачкой сохраняется последний UID
+    и номер пачки, поэтому прерванная загрузка (в том числе первая полная)
+    при следующем запуске продолжается с места остановки.
+
+    Args:
+        mail (imaplib.IMAP4): Соединение с почтовым сервером с выполненным входом
+        conn (sqlite3.Connection): Соединение с базой данных
+        folder (str): Имя папки на сервере
+        account (str): Адрес почтового ящика
+        max_emails (int): Максимальное количество писем для обработки (None - без ограничения)
+        batch_size (int): Количество писем, запрашиваемых одной командой FETCH
+        incremental (bool): Загружать только письма, появившиеся после прошлой синхронизации
+        headers_only (bool): Загружать только заголовки и размер писем, тела загружаются позже
+        executor (concurrent.futures.Executor): Пул процессов для разбора писем
+        writer (EmailWriter): Файл для дополнительного сохранения писем
+        commit_every (int): Количество писем в одной транзакции
+
+    Returns:
+        tuple: (количество добавленных писем, количество пропущенных писем) или None при ошибке
+    """
+    account = account or email_address
+
+    uidvalidity = select_folder(mail, folder)
+    if uidvalidity is None:
+        return None
+
+    state = None
+    if incremental:
+        state = create_database.get_sync_state(conn, account, folder)
+        if state and state["uidvalidity"] != uidvalidity:
+            # UID писем на сервере переназначены, сохраненные письма папки устарели
+            print(f"{account}/{folder}: UIDVALIDITY папки изменился, выполняется полная синхронизация")
+            create_database.reset_folder(conn, account, folder)
+            state = None
+
+    uids = search_uids(mail, state, uidvalidity)
+
+    if uids is None:
+        return None
+
+    print(f"{account}/{folder}: найдено {len(uids)} писем")
+
+    batch_no = 0
+    if incremental:
+        # Загружаем новые письма от старых к новым, чтобы сохраненный UID
+        # не пропускал письма, не попавшие в max_emails
+        uids = uids[:max_emails]
+        if state and state["status"] == "running":
+            batch_no = state["batch_no"]
+            print(f"Продолжение прерванной синхронизации: сохранено пачек {batch_no}, "
+                  f"последний UID {state['last_uid']}")
+    else:
+        # Обрабатываем письма в обратном порядке - от новых к старым.
+        # Письма, сохраненные при прошлых (в том числе прерванных) запусках, не загружаем повторно
+        stored = create_database.get_stored_uids(conn, account, folder)
+        uids = [uid for uid in uids[::-1][:max_emails] if uid not in stored]
+        if stored:
+            print(f"Уже сохранено писем папки: {len(stored)}, будет загружено: {len(uids)}")
+
+    added = 0
+    skipped = 0
+    pending = []
+
+    def flush():
+        nonlocal added, skipped, batch_no
+        if not pending:
+            return
+        batch_added, batch_skipped = create_database.store_emails(conn, pending)
+        if incremental:
+            # Отметка о прогрессе сохраняется в одной транзакции с письмами пачки,
+            # поэтому после сбоя загрузка продолжится ровно с первого несохраненного письма
+            batch_no += 1
+            create_database.save_sync_state(
+                conn, account, folder, uidvalidity, max(e["uid"] for e in pending),
+                batch_no, "running", commit=False
+            )
+        conn.commit()
+        added += batch_added
+        skipped += batch_skipped
+        pending.clear()
+
+    for email_info in iter_emails_info(mail, uids, folder, account, headers_only,
+                                       batch_size, executor, show_progress=len(uids) > batch_size):
+        pending.append(email_info)
+        if writer:
+            writer.write(email_info)
+        if len(pending) >= commit_every:
+            flush()
+
+    flush()
+
+    if incremental:
+        last_uid = max(uids) if uids else (state["last_uid"] if state else 0)
+        create_database.save_sync_state(conn, account, folder, uidvalidity, last_uid, batch_no)
+
+    return added, skipped
+
+def save_emails_to_database(max_emails=10, batch_size=200, incremental=False, folder="INBOX",
+                            headers_only=False, parse_workers=0, json_output=None,
+                            commit_every=500):
+    """
+    Получает письма из почтового ящика и сразу сохраняет их в базу данных
+
+    В отличие от связки mail_to_json.py и create_database.import_from_json,
+    письма не записываются в промежуточный JSON файл (см. sync_folder_to_database).
+
+    Args:
+        max_emails (int): Максимальное количество писем для обработки
+        batch_size (int): Количество писем, запрашиваемых одной командой FETCH
+        incremental (bool): Загружать только письма, появившиеся после прошлой синхронизации
+        folder (str): Имя папки на сервере
+        headers_only (bool): Загружать только заголовки и размер писем, тела загружаются позже
+        parse_workers (int): Количество процессов для разбора писем (0 - разбор в текущем процессе)
+        json_output (str): Имя файла для дополнительного сохранения писем в JSON/NDJSON
+        commit_every (int): Количество писем в одной транзакции
+
+    Returns:
+        bool: True если загрузка выполнена без ошибок
+    """
+    if not os.path.exists(create_database.DB_PATH):
+        print(f"База данных {create_database.DB_PATH} не найдена. Сначала создайте базу данных.")
+        return False
+
+    conn = sqlite3.connect(create_database.DB_PATH)
+    create_database.migrate_database(conn)
+
+    mail = None
+    writer = None
+    executor = None
+    try:
+        print("Подключение к почтовому серверу...")
+        mail = connect_imap()
+
+        print(f"Вход в аккаунт {email_address}...")
+        mail.login(email_address, app_password)
+        print("Вход выполнен успешно")
+
+        if parse_workers:
+            executor = ProcessPoolExecutor(max_workers=parse_workers)
+        if json_output:
+            writer = EmailWriter(json_output)
+
+        result = sync_folder_to_database(mail, conn, folder, email_address, max_emails, batch_size,
+                                         incremental, headers_only, executor, writer, commit_every)
+        if result is None:
+            return False
+
+        print(f"\nЗагрузка завершена. Добавлено: {result[0]}, пропущено: {result[1]}")
+        if writer:
+            print(f"Копия писем сохранена в файл {json_output}")
+        return True
+
+    except Exception as e:
+        print(f"Произошла ошибка: {str(e)}")
+        return False
+
+    finally:
+        conn.close()
+
+        if writer:
+            writer.close()
+
+        if executor:
+            executor.shutdown(cancel_futures=True)
+
+        # Закрытие соединения
+        try:
+            mail.close()
+            mail.logout()
+            print("Соединение с почтовым сервером закрыто")
+        except:
+            pass
+
+if __name__ == "__main__":
+    # Запрашиваем у пользователя количество писем для обработки
+    try:
+        max_emails = int(input("Введите количество писем для обработки (по умолчанию 10): ") or "10")
+    except:
+        max_emails = 10
+        print("Некорректный ввод, будет использовано значение по умолчанию: 10")
+
+    # Спрашиваем, нужно ли загружать только новые письма
+    incremental = input("Загрузить только новые письма с прошлой синхронизации? (y/n): ").lower() == 'y'
+
+    # Спрашиваем, нужно ли загружать тела писем сразу
+    headers_only = input("Загрузить только заголовки писем (тела будут загружены по запросу)? (y/n): ").lower() == 'y'
+
+    # Дополнительная копия писем в файле
+    json_output = input("Введите имя файла для копии писем в JSON (по умолчанию без копии): ") or None
+
+    # Получаем письма и сохраняем их в базу данных
+    success = save_emails_to_database(max_emails, incremental=incremental, headers_only=headers_only,
+                                      json_output=json_output)
+
+    if success:
+        print("Программа успешно завершена")
+    else:
+        print("Программа завершена с ошибками")
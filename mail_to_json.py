@@ -1,21 +1,52 @@
 import imaplib
 import email
 import base64
+import binascii
 import os
 import json
+import re
+import sqlite3
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from email.header import decode_header
 from datetime import datetime
 
 from dotenv import load_dotenv
 
+import attachment_store
+import create_database
+import raw_archive
+
 load_dotenv()
 
-mail_server = "imap.mail.ru"
-mail_port = 993
+# Сервер можно переопределить, например для проверки на локальном сервере fake_imap.py
+mail_server = os.getenv("IMAP_SERVER", "imap.mail.ru")
+mail_port = int(os.getenv("IMAP_PORT", "993"))
+mail_ssl = os.getenv("IMAP_SSL", "1") != "0"
 
 email_address = os.getenv("EMAIL_RU")
 app_password = os.getenv("PASSWORD_RU")
 
+# Заголовки, которые загружаются в режиме "сначала заголовки"
+HEADER_FIELDS = "(SUBJECT FROM DATE MESSAGE-ID)"
+
+def connect_imap(server=mail_server, port=mail_port, use_ssl=mail_ssl):
+    """Создает соединение с почтовым сервером"""
+    if not use_ssl:
+        return imaplib.IMAP4(server, port)
+    return imaplib.IMAP4_SSL(server, port)
+
+def make_email_id(uid, folder="INBOX", account=None):
+    """
+    Формирует идентификатор письма для базы данных: строку вида "ящик/папка/UID"
+
+    Идентификатор всегда содержит ящик и папку: в старых базах данных колонка
+    email_id хранит порядковые номера писем, и голый UID мог бы совпасть с ними.
+    """
+    account = account or email_address
+    return f"{account}/{folder}/{uid}"
+
 def decode_str(s):
     """Декодирует строку email-заголовка"""
     if s is None:
@@ -76,6 +107,73 @@ def get_email_body(msg):
     
     return body
 
+def iter_payload(part, chunk_size=1 << 16):
+    """
+    Декодирует содержимое части письма по частям
+
+    Содержимое в base64 (обычная кодировка вложений) декодируется порциями,
+    без копии всего декодированного вложения в памяти; остальные кодировки -
+    целиком, через get_payload(decode=True).
+
+    Raises:
+        binascii.Error: Некорректные данные base64
+    """
+    payload = part.get_payload()
+    if part.get("Content-Transfer-Encoding", "").strip().lower() != "base64" or not isinstance(payload, str):
+        yield part.get_payload(decode=True) or b""
+        return
+
+    rest = ""
+    for start in range(0, len(payload), chunk_size):
+        # Символы вне алфавита base64 (переводы строк и т.п.) пропускаем, как и get_payload(decode=True)
+        data = rest + re.sub(r"[^A-Za-z0-9+/=]", "", payload[start:start + chunk_size])
+        cut = len(data) - len(data) % 4
+        rest = data[cut:]
+        if cut:
+            yield binascii.a2b_base64(data[:cut])
+    if rest:
+        yield binascii.a2b_base64(rest + "=" * (-len(rest) % 4))
+
+def get_email_attachments(msg, store_dir):
+    """
+    Сохраняет вложения письма в хранилище вложений
+
+    Args:
+        msg (email.message.Message): Разобранное письмо
+        store_dir (str): Каталог хранилища вложений (см. attachment_store)
+
+    Returns:
+        list: Метаданные вложений: имя файла, тип, SHA-256 и размер
+    """
+    attachments = []
+    for part in msg.walk():
+        if part.is_multipart():
+            continue
+
+        # Вложением считаем часть с Content-Disposition: attachment или с именем файла
+        filename = part.get_filename()
+        if part.get_content_disposition() != "attachment" and not filename:
+            continue
+
+        try:
+            try:
+                # Вложение записывается в хранилище по мере декодирования
+                sha256, size = attachment_store.save_attachment(store_dir, iter_payload(part))
+            except binascii.Error:
+                # Поврежденный base64 декодируем так же снисходительно, как get_payload
+                sha256, size = attachment_store.save_attachment(store_dir, part.get_payload(decode=True) or b"")
+        except Exception as e:
+            print(f"Ошибка при сохранении вложения {filename}: {e}")
+            continue
+
+        attachments.append({
+            "filename": decode_str(filename) if filename else None,
+            "content_type": part.get_content_type(),
+            "sha256": sha256,
+            "size": size
+        })
+    return attachments
+
 def format_date(date_tuple):
     """Форматирует дату из формата parsedate_tz в читаемый формат"""
     if not date_tuple:
@@ -88,93 +186,556 @@ def format_date(date_tuple):
     except:
         return str(date_tuple)
 
-def save_emails_to_json(max_emails=10, output_file="emails_data.json"):
+def date_to_timestamp(date_tuple):
+    """
+    Преобразует дату из формата parsedate_tz в Unix-время (UTC)
+
+    Смещение часового пояса из заголовка Date учитывается, поэтому письма
+    из разных часовых поясов сортируются правильно. Дата без часового пояса
+    считается датой в UTC.
+
+    Returns:
+        int: Количество секунд с 1970-01-01 UTC или None, если дата неизвестна
+    """
+    if not date_tuple:
+        return None
+    try:
+        return int(email.utils.mktime_tz(date_tuple))
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+def format_uid_set(uids):
+    """Формирует набор UID для команды FETCH, сворачивая подряд идущие UID в диапазоны"""
+    ranges = []
+    for uid in sorted(int(u) for u in uids):
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ",".join(str(a) if a == b else f"{a}:{b}" for a, b in ranges)
+
+def parse_fetch_response(data):
+    """
+    Разбирает ответ команды FETCH, содержащий несколько писем
+
+    Args:
+        data (list): Данные ответа imaplib
+
+    Returns:
+        dict: Словарь {UID: {"data": литерал ответа, "size": RFC822.SIZE, "flags": список флагов}}
+    """
+    messages = {}
+    current = None
+    for item in data:
+        # Части ответа с литералом приходят в виде кортежа (заголовок, данные),
+        # а элементы ответа после литерала - отдельной строкой
+        if isinstance(item, tuple):
+            line = item[0]
+            current = {"data": item[1], "size": None, "flags": None}
+        elif isinstance(item, bytes):
+            line = item
+            if current is None:
+                current = {"data": None, "size": None, "flags": None}
+        else:
+            continue
+
+        match = re.search(rb"UID (\d+)", line)
+        if match:
+            messages[int(match.group(1))] = current
+
+        match = re.search(rb"RFC822\.SIZE (\d+)", line)
+        if match:
+            current["size"] = int(match.group(1))
+
+        match = re.search(rb"FLAGS \(([^)]*)\)", line)
+        if match:
+            current["flags"] = match.group(1).decode().split()
+
+        # Ответ по письму закончился
+        if not isinstance(item, tuple) and line.endswith(b")"):
+            current = None
+    return messages
+
+def parse_email(email_id, raw_email, headers_only=False, attachments_dir=None):
+    """
+    Разбирает письмо и извлекает из него основную информацию
+
+    Args:
+        email_id (str): Идентификатор письма на сервере
+        raw_email (bytes): Письмо в формате RFC822 или только его заголовки
+        headers_only (bool): Переданы только заголовки, тело письма будет загружено позже
+        attachments_dir (str): Каталог хранилища вложений; если не задан, вложения не сохраняются
+
+    Returns:
+        dict: Информация о письме
+    """
+    email_message = email.message_from_bytes(raw_email)
+
+    # Извлекаем информацию о письме
+    try:
+        subject = decode_str(email_message["Subject"])
+    except:
+        subject = "Без темы"
+
+    try:
+        from_addr = decode_str(email_message["From"])
+    except:
+        from_addr = "Неизвестный отправитель"
+
+    # Обработка даты
+    date_tuple = email.utils.parsedate_tz(email_message["Date"])
+    date_formatted = format_date(date_tuple)
+
+    # Получаем тело письма
+    body = None if headers_only else get_email_body(email_message)
+
+    # Создаем словарь с информацией о письме
+    email_info = {
+        "id": email_id,
+        "message_id": email_message["Message-ID"],
+        "subject": subject,
+        "from": from_addr,
+        "date": date_formatted,
+        "date_ts": date_to_timestamp(date_tuple),
+        "size": None if headers_only else len(raw_email),
+        "body": body
+    }
+
+    if attachments_dir and not headers_only:
+        email_info["attachments"] = get_email_attachments(email_message, attachments_dir)
+
+    return email_info
+
+def fetch_emails_batch(mail, uids, items="(UID RFC822)"):
+    """
+    Получает несколько писем одной командой UID FETCH
+
+    Args:
+        mail (imaplib.IMAP4): Соединение с почтовым сервером
+        uids (list): Список UID писем
+        items (str): Запрашиваемые элементы писем
+
+    Returns:
+        list: Список кортежей (UID, письмо в формате RFC822) в порядке uids
+    """
+    return [(uid, message["data"]) for uid, message in _fetch_batch(mail, uids, items)]
+
+def fetch_headers_batch(mail, uids):
+    """
+    Получает только заголовки и размеры нескольких писем одной командой UID FETCH
+
+    Returns:
+        list: Список кортежей (UID, заголовки, размер письма) в порядке uids
+    """
+    items = f"(UID RFC822.SIZE BODY.PEEK[HEADER.FIELDS {HEADER_FIELDS}])"
+    return [(uid, message["data"], message["size"]) for uid, message in _fetch_batch(mail, uids, items)]
+
+def fetch_messages(mail, uids, headers_only=False):
+    """
+    Получает пачку писем выбранной папки без разбора
+
+    Returns:
+        list: Список кортежей (UID, данные письма, размер письма или None)
+    """
+    if headers_only:
+        return fetch_headers_batch(mail, uids)
+    return [(uid, raw_email, None) for uid, raw_email in fetch_emails_batch(mail, uids)]
+
+def parse_messages(messages, folder="INBOX", account=None, headers_only=False, attachments_dir=None,
+                   raw_locations=None):
+    """
+    Разбирает пачку полученных писем
+
+    Функция не использует соединение с сервером, поэтому может выполняться
+    в отдельном процессе ProcessPoolExecutor.
+
+    Args:
+        messages (list): Результат fetch_messages
+        folder (str): Имя папки
+        account (str): Адрес почтового ящика
+        headers_only (bool): Переданы только заголовки писем
+        attachments_dir (str): Каталог хранилища вложений
+        raw_locations (list): Расположение каждого письма в архиве исходных писем
+
+    Returns:
+        list: Список словарей с информацией о письмах
+    """
+    account = account or email_address
+
+    emails = []
+    for i, (uid, data, size) in enumerate(messages):
+        email_info = parse_email(make_email_id(uid, folder, account), data, headers_only, attachments_dir)
+        if size is not None:
+            email_info["size"] = size
+        if raw_locations:
+            email_info["raw_location"] = raw_locations[i]
+        email_info.update({"uid": uid, "folder": folder, "account": account})
+        emails.append(email_info)
+    return emails
+
+def iter_emails_info(mail, uids, folder="INBOX", account=None, headers_only=False,
+                     batch_size=200, executor=None, max_pending=8, show_progress=False, store_files=True):
+    """
+    Получает письма пачками и возвращает их по одному в порядке uids
+
+    Если передан executor (например, ProcessPoolExecutor), разбор писем выполняется
+    в нем: полученные пачки ставятся в очередь на разбор, а соединение с сервером
+    тем временем получает следующие пачки. С store_files вложения писем сохраняются
+    в хранилище вложений рядом с базой данных (см. attachment_store),
+    а исходные письма - в архив исходных писем (см. raw_archive).
+
+    Args:
+        mail (imaplib.IMAP4): Соединение с почтовым сервером
+        uids (list): Список UID писем
+        folder (str): Имя выбранной папки
+        account (str): Адрес почтового ящика
+        headers_only (bool): Загружать только заголовки и размер писем
+        batch_size (int): Количество писем в одной команде FETCH
+        executor (concurrent.futures.Executor): Пул для разбора писем
+        max_pending (int): Максимальное количество пачек, ожидающих разбора
+        show_progress (bool): Выводить ход получения писем
+        store_files (bool): Сохранять вложения и исходные письма рядом с базой данных.
+            Если письма не попадут в базу данных, файлы остались бы без ссылок на них
+
+    Yields:
+        dict: Информация о письме
+    """
+    pending = deque()
+    attachments_dir = archive = None
+    if store_files:
+        attachments_dir = attachment_store.get_store_dir(create_database.DB_PATH)
+        archive = raw_archive.get_archive(raw_archive.get_archive_dir(create_database.DB_PATH))
+
+    for start in range(0, len(uids), batch_size):
+        batch = uids[start:start + batch_size]
+        if show_progress:
+            print(f"Получение писем {start + 1}-{start + len(batch)} из {len(uids)}...")
+
+        messages = fetch_messages(mail, batch, headers_only)
+
+        # Сохраняем исходные письма, чтобы их можно было разобрать заново без обращения к серверу
+        raw_locations = None
+        if archive and not headers_only:
+            raw_locations = archive.append_many([data for _, data, _ in messages])
+
+        if executor is None:
+            yield from parse_messages(messages, folder, account, headers_only, attachments_dir,
+                                      raw_locations)
+            continue
+
+        pending.append(executor.submit(
+            parse_messages, messages, folder, account, headers_only, attachments_dir, raw_locations
+        ))
+
+        # Ограничиваем очередь на разбор, чтобы не накапливать полученные письма в памяти
+        while len(pending) > max_pending:
+            yield from pending.popleft().result()
+
+    while pending:
+        yield from pending.popleft().result()
+
+def _fetch_batch(mail, uids, items):
+    result, data = mail.uid("FETCH", format_uid_set(uids), items)
+
+    if result != "OK":
+        print(f"Ошибка при получении писем {format_uid_set(uids)}")
+        return []
+
+    messages = parse_fetch_response(data)
+    return [(uid, messages[uid]) for uid in uids if uid in messages and messages[uid]["data"] is not None]
+
+def select_folder(mail, folder="INBOX"):
+    """
+    Выбирает папку на сервере и возвращает ее UIDVALIDITY
+
+    Returns:
+        int: UIDVALIDITY папки или None, если папку выбрать не удалось
+    """
+    result, data = mail.select(folder)
+
+    if result != "OK":
+        print(f"Ошибка при выборе папки {folder}")
+        return None
+
+    result, data = mail.response("UIDVALIDITY")
+    if not data or data[0] is None:
+        return 0
+    return int(data[0])
+
+def search_uids(mail, state=None, uidvalidity=None):
+    """
+    Ищет UID писем в выбранной папке
+
+    Если передано сохраненное состояние синхронизации с тем же UIDVALIDITY,
+    запрашиваются только письма с UID больше последнего загруженного.
+
+    Args:
+        mail (imaplib.IMAP4): Соединение с почтовым сервером
+        state (dict): Состояние синхронизации из create_database.get_sync_state
+        uidvalidity (int): Текущий UIDVALIDITY папки
+
+    Returns:
+        list: Отсортированный по возрастанию список UID или None при ошибке
+    """
+    last_uid = 0
+    if state and state["uidvalidity"] == uidvalidity:
+        last_uid = state["last_uid"] or 0
+
+    criteria = f"UID {last_uid + 1}:*" if last_uid else "ALL"
+    result, data = mail.uid("SEARCH", None, criteria)
+
+    if result != "OK":
+        print("Ошибка при поиске писем")
+        return None
+
+    # Диапазон n:* всегда включает последнее письмо, даже если его UID меньше n
+    return sorted(uid for uid in (int(u) for u in data[0].split()) if uid > last_uid)
+
+def open_account(account=None):
+    """
+    Подключается к почтовому ящику, используя учетные данные из переменных окружения
+
+    Args:
+        account (str): Адрес почтового ящика; по умолчанию основной ящик EMAIL_RU
+
+    Returns:
+        imaplib.IMAP4: Соединение с выполненным входом
+    """
+    if account in (None, email_address):
+        mail = connect_imap()
+        mail.login(email_address, app_password)
+        return mail
+
+    from async_ingest import load_accounts
+    for info in load_accounts():
+        if info["email"] == account:
+            mail = connect_imap(info["server"], info["port"])
+            mail.login(info["email"], info["password"])
+            return mail
+
+    raise ValueError(f"Не найдены учетные данные для ящика {account}")
+
+def download_bodies(conn, ids=None, limit=None, batch_size=200):
+    """
+    Догружает тела писем, сохраненных в режиме "сначала заголовки"
+
+    Args:
+        conn (sqlite3.Connection): Соединение с базой данных
+        ids (list): ID писем в базе данных; по умолчанию все письма без тела
+        limit (int): Максимальное количество писем
+        batch_size (int): Количество писем в одной команде FETCH
+
+    Returns:
+        int: Количество загруженных тел писем
+    """
+    sql = (
+        "SELECT id, email_id, account, folder, uid FROM emails "
+        "WHERE uid IS NOT NULL AND id NOT IN (SELECT email_id FROM email_bodies)"
+    )
+    params = []
+    if ids is not None:
+        sql += f" AND id IN ({','.join('?' * len(ids))})"
+        params.extend(ids)
+    if limit:
+        sql += " LIMIT ?"
+        params.append(limit)
+
+    # Группируем письма по ящикам и папкам
+    groups = {}
+    for row_id, email_id, account, folder, uid in conn.execute(sql, params).fetchall():
+        groups.setdefault((account, folder), {})[uid] = (row_id, email_id)
+
+    attachments_dir = attachment_store.get_store_dir(create_database.DB_PATH)
+    archive = raw_archive.get_archive(raw_archive.get_archive_dir(create_database.DB_PATH))
+
+    downloaded = 0
+    for (account, folder), rows in groups.items():
+        mail = open_account(account)
+        try:
+            if select_folder(mail, folder) is None:
+                continue
+
+            uids = sorted(rows)
+            for start in range(0, len(uids), batch_size):
+                batch = uids[start:start + batch_size]
+                # BODY.PEEK не помечает письма на сервере как прочитанные
+                messages = fetch_emails_batch(mail, batch, "(UID BODY.PEEK[])")
+                raw_locations = archive.append_many([raw_email for _, raw_email in messages])
+                for (uid, raw_email), raw_location in zip(messages, raw_locations):
+                    row_id, email_id = rows[uid]
+                    email_message = email.message_from_bytes(raw_email)
+                    conn.execute(
+                        "UPDATE emails SET size = ?, raw_segment = ?, raw_offset = ?, raw_length = ? WHERE id = ?",
+                        (len(raw_email), *raw_location, row_id)
+                    )
+                    create_database.save_body(conn, row_id, get_email_body(email_message))
+                    create_database.store_attachments(conn, [{
+                        "id": email_id,
+                        "attachments": get_email_attachments(email_message, attachments_dir)
+                    }])
+                    downloaded += 1
+                conn.commit()
+        finally:
+            try:
+                mail.logout()
+            except:
+                pass
+
+    return downloaded
+
+class EmailWriter:
+    """
+    Потоково записывает письма в файл по мере их получения
+
+    Поддерживаются два формата: "json" - массив писем, как раньше, и "ndjson" -
+    один JSON-объект на строку. По умолчанию формат определяется по расширению
+    файла (.ndjson и .jsonl - NDJSON). Файл периодически сбрасывается на диск,
+    поэтому при сбое в NDJSON-файле остаются все уже записанные письма.
+    """
+
+    def __init__(self, output_file, output_format=None, flush_every=100):
+        """
+        Args:
+            output_file (str): Имя файла для сохранения результатов
+            output_format (str): "json" или "ndjson"
+            flush_every (int): Через сколько писем сбрасывать файл на диск
+        """
+        if output_format is None:
+            output_format = "ndjson" if output_file.endswith((".ndjson", ".jsonl")) else "json"
+        self.output_file = output_file
+        self.output_format = output_format
+        self.flush_every = flush_every
+        self.count = 0
+        self.lock = threading.Lock()
+        self.file = open(output_file, "w", encoding="utf-8")
+        if output_format == "json":
+            self.file.write("[")
+
+    def write(self, email_info):
+        """Записывает одно письмо"""
+        with self.lock:
+            if self.output_format == "ndjson":
+                self.file.write(json.dumps(email_info, ensure_ascii=False) + "\n")
+            else:
+                text = json.dumps(email_info, ensure_ascii=False, indent=2).replace("\n", "\n  ")
+                self.file.write(("," if self.count else "") + "\n  " + text)
+            self.count += 1
+            if self.count % self.flush_every == 0:
+                self.file.flush()
+
+    def close(self):
+        """Завершает запись и закрывает файл"""
+        with self.lock:
+            if self.file.closed:
+                return
+            if self.output_format == "json":
+                self.file.write("\n]" if self.count else "]")
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def save_emails_to_json(max_emails=10, output_file="emails_data.json", batch_size=200,
+                        incremental=False, folder="INBOX", headers_only=False, parse_workers=0,
+                        store_files=None):
     """
     Получает письма из почтового ящика и сохраняет их в JSON файл
     
     Args:
         max_emails (int): Максимальное количество писем для обработки
-        output_file (str): Имя файла для сохранения результатов
+        output_file (str): Имя файла для сохранения результатов (.ndjson - по одному письму на строку)
+        batch_size (int): Количество писем, запрашиваемых одной командой FETCH
+        incremental (bool): Загружать только письма, появившиеся после прошлой синхронизации.
+            Загруженные письма также добавляются в базу данных вместе с последним UID
+        folder (str): Имя папки на сервере
+        headers_only (bool): Загружать только заголовки и размер писем, тела загружаются позже
+        parse_workers (int): Количество процессов для разбора писем (0 - разбор в текущем процессе)
+        store_files (bool): Сохранять вложения и исходные письма рядом с базой данных
+            (нужно, если файл будет импортирован в базу данных). По умолчанию - только
+            в инкрементальном режиме, когда письма сразу добавляются в базу данных
     """
+    conn = None
+    executor = None
+    if store_files is None:
+        store_files = incremental
     try:
+        if incremental:
+            if not os.path.exists(create_database.DB_PATH):
+                print(f"База данных {create_database.DB_PATH} не найдена. Сначала создайте базу данных.")
+                return False
+            conn = sqlite3.connect(create_database.DB_PATH)
+            create_database.migrate_database(conn)
+        
         print("Подключение к почтовому серверу...")
-        mail = imaplib.IMAP4_SSL(mail_server, mail_port)
+        mail = connect_imap()
         
         print(f"Вход в аккаунт {email_address}...")
         mail.login(email_address, app_password)
         print("Вход выполнен успешно")
         
-        print("Выбор папки 'Входящие'...")
-        mail.select("INBOX")
+        print(f"Выбор папки '{folder}'...")
+        uidvalidity = select_folder(mail, folder)
+        if uidvalidity is None:
+            return False
+        
+        state = None
+        if incremental:
+            state = create_database.get_sync_state(conn, email_address, folder)
+            if state and state["uidvalidity"] != uidvalidity:
+                # UID писем на сервере переназначены, сохраненные письма папки устарели
+                print("UIDVALIDITY папки изменился, выполняется полная синхронизация")
+                create_database.reset_folder(conn, email_address, folder)
+                state = None
         
         print("Поиск писем...")
-        result, data = mail.search(None, "ALL")
+        uids = search_uids(mail, state, uidvalidity)
         
-        if result != "OK":
-            print("Ошибка при поиске писем")
+        if uids is None:
             return False
         
-        email_ids = data[0].split()
-        total_emails = len(email_ids)
+        total_emails = len(uids)
         print(f"Найдено {total_emails} писем")
         
-        # Создаем список для хранения информации о письмах
-        all_emails = []
+        if incremental:
+            # Загружаем новые письма от старых к новым, чтобы сохраненный UID
+            # не пропускал письма, не попавшие в max_emails
+            uids = uids[:max_emails]
+        else:
+            # Обрабатываем письма в обратном порядке - от новых к старым
+            uids = uids[::-1][:max_emails]
         
-        # Обрабатываем письма (в обратном порядке - от новых к старым)
-        for i, email_id in enumerate(email_ids[::-1]):
-            if i >= max_emails:  # Ограничиваем количество обрабатываемых писем
-                break
-                
-            print(f"Обработка письма {i+1} из {min(max_emails, total_emails)}...")
-            
-            # Получаем письмо по ID
-            result, data = mail.fetch(email_id, "(RFC822)")
-            
-            if result != "OK":
-                print(f"Ошибка при получении письма {email_id}")
-                continue
-                
-            raw_email = data[0][1]
-            email_message = email.message_from_bytes(raw_email)
-            
-            # Извлекаем информацию о письме
-            try:
-                subject = decode_str(email_message["Subject"])
-            except:
-                subject = "Без темы"
-                
-            try:
-                from_addr = decode_str(email_message["From"])
-            except:
-                from_addr = "Неизвестный отправитель"
+        # Разбираем письма в отдельных процессах, пока соединение получает следующие пачки
+        if parse_workers:
+            executor = ProcessPoolExecutor(max_workers=parse_workers)
+        
+        # Записываем письма в файл по мере получения, не накапливая их в памяти.
+        # Письма запрашиваются пачками, чтобы не тратить сетевой запрос на каждое письмо
+        with EmailWriter(output_file) as writer:
+            for email_info in iter_emails_info(mail, uids, folder, headers_only=headers_only,
+                                               batch_size=batch_size, executor=executor,
+                                               show_progress=True, store_files=store_files):
+                writer.write(email_info)
                 
-            # Обработка даты
-            date_tuple = email.utils.parsedate_tz(email_message["Date"])
-            date_formatted = format_date(date_tuple)
-            
-            # Получаем тело письма
-            body = get_email_body(email_message)
-            
-            # Создаем словарь с информацией о письме
-            email_info = {
-                "id": email_id.decode(),
-                "subject": subject,
-                "from": from_addr,
-                "date": date_formatted,
-                "body": body
-            }
-            
-            # Добавляем информацию о письме в общий список
-            all_emails.append(email_info)
-            
-            print(f"Письмо обработано: {subject}")
+                print(f"Письмо обработано: {email_info['subject']}")
+        
+        print(f"\nДанные {writer.count} писем сохранены в файл {output_file}")
         
-        # Сохраняем результаты в JSON файл
-        with open(output_file, "w", encoding="utf-8") as f:
-            json.dump(all_emails, f, ensure_ascii=False, indent=2)
+        if incremental:
+            # Последний UID можно сохранить, только когда письма уже в базе данных:
+            # файл перезаписывается при следующем запуске, и письма, сохраненные
+            # только в нем, больше не были бы загружены. Письма и UID сохраняются
+            # в одной транзакции
+            added, skipped = create_database.store_emails(
+                conn, create_database.iter_emails_from_file(output_file)
+            )
+            last_uid = max(uids) if uids else (state["last_uid"] if state else 0)
+            create_database.save_sync_state(conn, email_address, folder, uidvalidity, last_uid, commit=False)
+            conn.commit()
+            print(f"Письма добавлены в базу данных: {added}, пропущено: {skipped}")
         
-        print(f"\nДанные {len(all_emails)} писем сохранены в файл {output_file}")
         return True
 
     except Exception as e:
@@ -182,6 +743,12 @@ def save_emails_to_json(max_emails=10, output_file="emails_data.json"):
         return False
 
     finally:
+        if conn:
+            conn.close()
+        
+        if executor:
+            executor.shutdown(cancel_futures=True)
+        
         # Закрытие соединения
         try:
             mail.close()
@@ -199,10 +766,37 @@ if __name__ == "__main__":
         print("Некорректный ввод, будет использовано значение по умолчанию: 10")
     
     # Запрашиваем имя файла для сохранения
-    output_file = input("Введите имя файла для сохранения (по умолчанию emails_data.json): ") or "emails_data.json"
+    output_file = input("Введите имя файла для сохранения (по умолчанию emails_data.json, .ndjson - по одному письму на строку): ") or "emails_data.json"
+    
+    # Запрашиваем размер пачки писем для одной команды FETCH
+    try:
+        batch_size = int(input("Введите количество писем в одном запросе к серверу (по умолчанию 200): ") or "200")
+    except:
+        batch_size = 200
+        print("Некорректный ввод, будет использовано значение по умолчанию: 200")
+    
+    # Спрашиваем, нужно ли загружать только новые письма
+    incremental = input("Загрузить только новые письма с прошлой синхронизации? (y/n): ").lower() == 'y'
+    
+    # Спрашиваем, нужно ли загружать тела писем сразу
+    headers_only = input("Загрузить только заголовки писем (тела будут загружены по запросу)? (y/n): ").lower() == 'y'
+    
+    # Без импорта в базу данных вложения и исходные письма сохранять не нужно
+    store_files = incremental or input(
+        "Сохранить вложения и исходные письма для импорта файла в базу данных? (y/n): "
+    ).lower() == 'y'
+    
+    # Запрашиваем количество процессов для разбора писем
+    try:
+        parse_workers = int(input(f"Введите количество процессов для разбора писем (по умолчанию 0 - без отдельных процессов, ядер: {os.cpu_count()}): ") or "0")
+    except:
+        parse_workers = 0
+        print("Некорректный ввод, будет использовано значение по умолчанию: 0")
     
     # Получаем и сохраняем письма
-    success = save_emails_to_json(max_emails, output_file)
+    success = save_emails_to_json(max_emails, output_file, batch_size, incremental,
+                                  headers_only=headers_only, parse_workers=parse_workers,
+                                  store_files=store_files)
     
     if success:
         print("Программа успешно завершена")
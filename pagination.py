@@ -0,0 +1,290 @@
+"""
+Постраничный вывод списка писем по курсору (keyset pagination)
+
+Вместо OFFSET следующая страница запрашивается от последнего письма предыдущей:
+SQLite находит это место по индексу сразу, поэтому страница 5000 стоит столько же,
+сколько первая, а письма, загруженные во время просмотра, не сдвигают страницы.
+
+Курсор - непрозрачная для клиента строка (JSON в base64), в которой записаны
+ключ сортировки крайнего письма страницы и направление перехода:
+- список писем упорядочен по (date_ts DESC, id DESC), письма без даты - в конце;
+- результаты поиска упорядочены по (релевантность, id DESC).
+
+Количество писем для номеров страниц берется из счетчиков email_stats, а количество
+найденных писем считается не дальше COUNT_LIMIT и запоминается для каждого запроса.
+"""
+import base64
+import json
+import math
+import threading
+import time
+
+from create_database import COUNTERS_SQL
+from search import FTS_COUNT_SQL, FTS_JOIN_SQL
+
+# Колонки письма для списков писем
+PAGE_COLUMNS = "SELECT e.id, e.subject, e.sender, e.date, e.preview, e.date_ts{rank} FROM emails e"
+
+# Направления перехода по курсору
+NEXT = "next"
+PREV = "prev"
+
+# Найденные письма считаются точно до этого количества, дальше - "более COUNT_LIMIT"
+COUNT_LIMIT = 10000
+
+# Сколько секунд хранится количество найденных писем и сколько запросов помнит кэш
+COUNT_CACHE_TTL = 60
+COUNT_CACHE_SIZE = 256
+
+# Сколько соседних страниц показывать по обе стороны от текущей
+PAGE_WINDOW = 2
+
+# Количество найденных писем по выражениям MATCH: {match: (количество, точно ли, всего писем, время)}
+_count_cache = {}
+_count_cache_lock = threading.Lock()
+
+def encode_cursor(kind, key, direction, skip=0):
+    """
+    Кодирует курсор страницы
+
+    Args:
+        kind (str): Вид списка: "list" - все письма, "search" - результаты поиска
+        key (list): Ключ сортировки крайнего письма страницы
+        direction (str): NEXT - письма после этого письма, PREV - письма перед ним
+        skip (int): Сколько писем пропустить в этом направлении (переход через несколько страниц)
+
+    Returns:
+        str: Курсор для параметра cursor
+    """
+    data = {"k": kind, "v": key, "d": direction}
+    if skip:
+        data["s"] = skip
+    data = json.dumps(data, separators=(",", ":"))
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip("=")
+
+def _is_int64(value):
+    """Целое число, которое SQLite может принять как параметр запроса (INTEGER, 64 бита)"""
+    return type(value) is int and -2 ** 63 <= value < 2 ** 63
+
+def _parse_cursor(cursor):
+    """Разбирает курсор в словарь; ValueError, если курсор поврежден"""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        key, skip = data["v"], data.get("s", 0)
+        # Ключ сортировки: дата (целое или NULL) или релевантность (конечное число) и ID письма
+        valid = (data["d"] in (NEXT, PREV) and isinstance(key, list) and len(key) == 2
+                 and (key[0] is None or _is_int64(key[0]) or (type(key[0]) is float and math.isfinite(key[0])))
+                 and _is_int64(key[1]) and _is_int64(skip) and skip >= 0)
+    except (ValueError, TypeError, KeyError, AttributeError, RecursionError):
+        valid = False
+    if not valid:
+        raise ValueError("Некорректный курсор страницы")
+    return data
+
+def decode_cursor(cursor, kind):
+    """
+    Разбирает курсор страницы
+
+    Args:
+        cursor (str): Курсор из параметра cursor
+        kind (str): Ожидаемый вид списка
+
+    Returns:
+        tuple: (ключ сортировки, направление, сколько писем пропустить)
+
+    Raises:
+        ValueError: Курсор поврежден или получен для списка другого вида
+    """
+    data = _parse_cursor(cursor)
+    if data["k"] != kind:
+        raise ValueError("Некорректный курсор страницы")
+    return data["v"], data["d"], data.get("s", 0)
+
+def shift_cursor(cursor, skip):
+    """Возвращает курсор, пропускающий еще skip писем в направлении перехода"""
+    data = _parse_cursor(cursor)
+    return encode_cursor(data["k"], data["v"], data["d"], data.get("s", 0) + skip)
+
+def _list_queries(key, direction):
+    """
+    Возвращает запросы страницы списка писем по порядку: (условие, параметры, порядок)
+
+    Row value (date_ts, id) < (?, ?) выполняется поиском по индексу idx_emails_date_ts,
+    но не находит письма без даты (сравнение с NULL), поэтому письма без даты
+    выбираются отдельным запросом после писем с датой.
+    """
+    desc, asc = "e.date_ts DESC, e.id DESC", "e.date_ts ASC, e.id ASC"
+    if key is None:
+        return [("", [], desc)]
+
+    date_ts, row_id = key
+    if direction == NEXT:
+        if date_ts is None:
+            return [("e.date_ts IS NULL AND e.id < ?", [row_id], desc)]
+        return [("(e.date_ts, e.id) < (?, ?)", [date_ts, row_id], desc),
+                ("e.date_ts IS NULL", [], desc)]
+
+    # Перед курсором: в обратном порядке, затем результат переворачивается
+    if date_ts is None:
+        return [("e.date_ts IS NULL AND e.id > ?", [row_id], asc),
+                ("e.date_ts IS NOT NULL", [], asc)]
+    return [("(e.date_ts, e.id) > (?, ?)", [date_ts, row_id], asc)]
+
+def _search_queries(key, direction):
+    """Возвращает запрос страницы результатов поиска: (условие, параметры, порядок)"""
+    if key is None:
+        return [("", [], "f.rank, e.id DESC")]
+    rank, row_id = key
+    if direction == NEXT:
+        return [("(f.rank > ? OR (f.rank = ? AND e.id < ?))", [rank, rank, row_id], "f.rank, e.id DESC")]
+    return [("(f.rank < ? OR (f.rank = ? AND e.id > ?))", [rank, rank, row_id], "f.rank DESC, e.id ASC")]
+
+def page_sql(match, condition, order, with_offset=False):
+    """
+    Строит запрос страницы по условию и порядку из _list_queries / _search_queries
+
+    Параметры запроса: выражение MATCH (при поиске), параметры условия, LIMIT и OFFSET (with_offset)
+    """
+    sql = PAGE_COLUMNS.format(rank=", f.rank" if match else "")
+    if match:
+        sql += FTS_JOIN_SQL
+    if condition:
+        sql += f" WHERE {condition}"
+    sql += f" ORDER BY {order} LIMIT ?"
+    if with_offset:
+        sql += " OFFSET ?"
+    return sql
+
+def fetch_page(conn, limit, match=None, cursor=None, offset=0):
+    """
+    Получает страницу списка писем или результатов поиска
+
+    Args:
+        conn (sqlite3.Connection): Соединение с row_factory = sqlite3.Row
+        limit (int): Количество писем на странице
+        match (str): Выражение MATCH для полнотекстового поиска (search.make_match_query)
+        cursor (str): Курсор страницы; без курсора - первая страница
+        offset (int): Пропустить писем от начала списка (номер страницы без курсора),
+                      не больше PAGE_WINDOW страниц
+
+    Returns:
+        tuple: (письма страницы, курсор следующей страницы или None, курсор предыдущей страницы или None)
+
+    Raises:
+        ValueError: Курсор поврежден или пропускает больше PAGE_WINDOW страниц, offset больше PAGE_WINDOW страниц
+        sqlite3.OperationalError: Ошибка в выражении MATCH
+    """
+    kind = "search" if match else "list"
+    key, direction, skip = decode_cursor(cursor, kind) if cursor else (None, NEXT, 0)
+    # Курсоры page_links пропускают меньше PAGE_WINDOW страниц; больше - курсор подделан
+    if skip > PAGE_WINDOW * limit:
+        raise ValueError("Некорректный курсор страницы")
+    # Без курсора далекая страница читалась бы через OFFSET с просмотром всех писем до нее
+    if key is None and offset > PAGE_WINDOW * limit:
+        raise ValueError(f"Без курсора доступны только первые {PAGE_WINDOW + 1} страницы; "
+                         f"для следующих используйте курсор")
+    queries = _search_queries(key, direction) if match else _list_queries(key, direction)
+
+    # Запрашиваем на одно письмо больше, чтобы узнать, есть ли еще страница.
+    # Письма, пропускаемые курсором (соседние страницы), читаются и отбрасываются:
+    # их не больше нескольких страниц
+    rows = []
+    for condition, params, order in queries:
+        sql = page_sql(match, condition, order, offset and key is None)
+        params = ([match] if match else []) + params + [skip + limit + 1 - len(rows)]
+        if offset and key is None:
+            params.append(offset)
+        rows += conn.execute(sql, params).fetchall()
+        if len(rows) > skip + limit:
+            break
+
+    rows = rows[skip:]
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if direction == PREV:
+        rows.reverse()
+        if not more:
+            # Дошли до начала списка: показываем первую страницу целиком
+            return fetch_page(conn, limit, match)
+
+    def row_key(row):
+        return [row["rank"] if match else row["date_ts"], row["id"]]
+
+    has_next = more if direction == NEXT else True
+    has_prev = (key is not None or offset > 0) if direction == NEXT else True
+    next_cursor = encode_cursor(kind, row_key(rows[-1]), NEXT) if rows and has_next else None
+    prev_cursor = encode_cursor(kind, row_key(rows[0]), PREV) if rows and has_prev else None
+    return rows, next_cursor, prev_cursor
+
+def count_emails(conn, match=None):
+    """
+    Возвращает количество писем в списке или найденных писем
+
+    Количество всех писем читается из счетчиков email_stats. Найденные письма
+    считаются не дальше COUNT_LIMIT, результат запоминается для запроса
+    на COUNT_CACHE_TTL секунд или до изменения количества писем в базе данных.
+
+    Args:
+        conn (sqlite3.Connection): Соединение с базой данных
+        match (str): Выражение MATCH для полнотекстового поиска
+
+    Returns:
+        tuple: (количество писем, True - точное количество, False - писем не меньше)
+    """
+    total = conn.execute(COUNTERS_SQL).fetchone()[0]
+    if not match:
+        return total, True
+
+    with _count_cache_lock:
+        cached = _count_cache.get(match)
+    if cached and cached[2] == total and time.monotonic() - cached[3] < COUNT_CACHE_TTL:
+        return cached[0], cached[1]
+
+    count = conn.execute(FTS_COUNT_SQL, (match, COUNT_LIMIT + 1)).fetchone()[0]
+    result = (min(count, COUNT_LIMIT), count <= COUNT_LIMIT)
+    with _count_cache_lock:
+        _count_cache.pop(match, None)
+        if len(_count_cache) >= COUNT_CACHE_SIZE:
+            # Вытесняем самый старый запрос
+            _count_cache.pop(next(iter(_count_cache)))
+        _count_cache[match] = result + (total, time.monotonic())
+    return result
+
+def page_links(page, total_pages, per_page, next_cursor, prev_cursor, window=PAGE_WINDOW):
+    """
+    Возвращает ссылки на первую страницу и страницы рядом с текущей
+
+    Соседние страницы открываются по курсорам текущей страницы с пропуском
+    нескольких страниц, поэтому их стоимость не зависит от номера страницы.
+
+    Args:
+        page (int): Номер текущей страницы
+        total_pages (int): Количество страниц
+        per_page (int): Количество писем на странице
+        next_cursor (str): Курсор следующей страницы
+        prev_cursor (str): Курсор предыдущей страницы
+        window (int): Сколько страниц показывать по обе стороны от текущей
+
+    Returns:
+        list: Словари {"page": номер, "cursor": курсор или "" для первой страницы, "current": текущая ли},
+              None на месте пропущенных страниц
+    """
+    first = max(page - window, 1)
+    last = min(page + window, total_pages) if next_cursor else page
+    links = []
+    if first > 1:
+        links.append({"page": 1, "cursor": "", "current": False})
+        if first > 2:
+            links.append(None)
+    for number in range(first, last + 1):
+        if number == page or number == 1:
+            # Текущая страница не ссылка, первая страница открывается без курсора
+            cursor = ""
+        elif number < page:
+            cursor = shift_cursor(prev_cursor, (page - number - 1) * per_page)
+        else:
+            cursor = shift_cursor(next_cursor, (number - page - 1) * per_page)
+        links.append({"page": number, "cursor": cursor, "current": number == page})
+    if next_cursor and last < total_pages:
+        links.append(None)
+    return links
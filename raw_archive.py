@@ -0,0 +1,256 @@
+"""
+Архив исходных писем в формате RFC 822
+
+Письма сжимаются по отдельности (zlib) и дописываются в файлы-сегменты
+каталога archive рядом с базой данных. Для каждого письма в таблице emails
+хранится расположение в архиве: сегмент, смещение и длина сжатых данных.
+Чтение выполняется через mmap, поэтому любое письмо можно заново разобрать
+без обращения к почтовому серверу.
+"""
+import mmap
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+# Размер сегмента, после которого начинается новый файл
+SEGMENT_SIZE = 256 * 1024 * 1024
+
+# Уровень сжатия zlib: 6 - разумный компромисс между скоростью и размером
+COMPRESSION_LEVEL = 6
+
+# Сегменты, которые изменялись за последние GRACE_PERIOD секунд, при сжатии архива
+# не трогаем: ссылки на их письма могут быть еще не сохранены в базе данных
+GRACE_PERIOD = 60 * 60
+
+# Сегмент переписывается при сжатии архива, если письма, на которые ссылается
+# база данных, занимают меньше этой доли сегмента
+MIN_LIVE_RATIO = 0.5
+
+# Количество писем, которые копируются в новый сегмент за один раз
+COPY_BATCH = 1000
+
+def get_archive_dir(db_path):
+    """Возвращает каталог архива писем: каталог archive рядом с базой данных"""
+    return os.path.join(os.path.dirname(os.path.abspath(db_path)), "archive")
+
+
+class RawArchive:
+    """
+    Архив исходных писем, разбитый на сегменты
+
+    Каждый процесс дописывает письма только в свои сегменты (в имени сегмента
+    есть время запуска и PID), поэтому несколько процессов загрузки могут
+    работать с одним архивом одновременно. Внутри процесса запись защищена блокировкой.
+    """
+
+    def __init__(self, archive_dir, segment_size=SEGMENT_SIZE):
+        """
+        Args:
+            archive_dir (str): Каталог архива
+            segment_size (int): Размер сегмента в байтах
+        """
+        self.archive_dir = archive_dir
+        self.segment_size = segment_size
+        self.lock = threading.Lock()
+        self.prefix = f"{time.strftime('%Y%m%d%H%M%S')}-{os.getpid()}"
+        self.segment_no = 0
+        self.segment = None
+        self.file = None
+        self.maps = {}
+
+    def _open_segment(self):
+        """Начинает новый сегмент"""
+        if self.file:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+        os.makedirs(self.archive_dir, exist_ok=True)
+        # Не дописываем в чужой сегмент с тем же именем (другой архив этого процесса)
+        while True:
+            self.segment_no += 1
+            self.segment = f"{self.prefix}-{self.segment_no:04d}.seg"
+            if not os.path.exists(os.path.join(self.archive_dir, self.segment)):
+                break
+        self.file = open(os.path.join(self.archive_dir, self.segment), "ab")
+
+    def append_many(self, raw_emails):
+        """
+        Сжимает письма и дописывает их в архив
+
+        Args:
+            raw_emails (list): Письма в формате RFC 822
+
+        Returns:
+            list: Расположение каждого письма в архиве: [сегмент, смещение, длина]
+        """
+        # Сжатие выполняется вне блокировки, чтобы потоки записи не ждали друг друга
+        compressed = [zlib.compress(raw_email, COMPRESSION_LEVEL) for raw_email in raw_emails]
+        return self._write(compressed)
+
+    def _write(self, compressed):
+        """Дописывает сжатые письма в сегменты и возвращает их расположение"""
+        locations = []
+        with self.lock:
+            for data in compressed:
+                if self.file is None or self.file.tell() + len(data) > self.segment_size:
+                    self._open_segment()
+                locations.append([self.segment, self.file.tell(), len(data)])
+                self.file.write(data)
+            # Данные должны оказаться на диске раньше, чем будут зафиксированы ссылки на них в базе данных
+            if self.file:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+        return locations
+
+    def read(self, segment, offset, length):
+        """
+        Читает письмо из архива
+
+        Args:
+            segment (str): Имя сегмента
+            offset (int): Смещение сжатых данных в сегменте
+            length (int): Длина сжатых данных
+
+        Returns:
+            bytes: Письмо в формате RFC 822
+        """
+        with self.lock:
+            mapped = self.maps.get(segment)
+            # Сегмент мог вырасти с момента отображения в память
+            if mapped is None or offset + length > len(mapped[1]):
+                if mapped:
+                    mapped[1].close()
+                    mapped[0].close()
+                f = open(os.path.join(self.archive_dir, segment), "rb")
+                mapped = (f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+                self.maps[segment] = mapped
+            data = mapped[1][offset:offset + length]
+        return zlib.decompress(data)
+
+    def forget(self, segment):
+        """Закрывает отображение сегмента в память перед удалением сегмента"""
+        with self.lock:
+            mapped = self.maps.pop(segment, None)
+            if mapped:
+                mapped[1].close()
+                mapped[0].close()
+
+    def close(self):
+        """Закрывает файлы сегментов"""
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+            for f, mapped in self.maps.values():
+                mapped.close()
+                f.close()
+            self.maps = {}
+
+
+# Открытые архивы текущего процесса по каталогам
+_archives = {}
+_archives_lock = threading.Lock()
+
+def get_archive(archive_dir):
+    """Возвращает общий для процесса архив в указанном каталоге"""
+    archive_dir = os.path.abspath(archive_dir)
+    with _archives_lock:
+        if archive_dir not in _archives:
+            _archives[archive_dir] = RawArchive(archive_dir)
+        return _archives[archive_dir]
+
+
+def compact_archive(conn, archive_dir, grace_period=GRACE_PERIOD, min_live_ratio=MIN_LIVE_RATIO):
+    """
+    Освобождает место в архиве, занятое письмами, на которые не ссылается таблица emails
+
+    Такие письма остаются после удаления писем из базы данных и после повторной
+    загрузки уже сохраненных писем: строка письма отбрасывается (INSERT OR IGNORE),
+    а исходное письмо к этому моменту уже дописано в архив.
+    Сегменты без ссылок удаляются. Из сегментов, где письма со ссылками занимают
+    меньше min_live_ratio, эти письма копируются в новый сегмент; старый сегмент
+    удаляется только после фиксации новых ссылок в базе данных.
+    Сегменты, изменявшиеся за последние grace_period секунд, не трогаются.
+
+    Args:
+        conn (sqlite3.Connection): Соединение с базой данных
+        archive_dir (str): Каталог архива
+        grace_period (int): Сколько секунд после изменения сегмент не трогается
+        min_live_ratio (float): Доля писем со ссылками, при которой сегмент переписывается
+
+    Returns:
+        tuple: (количество удаленных сегментов, освобождено байт)
+    """
+    if not os.path.isdir(archive_dir):
+        return 0, 0
+
+    live = {}
+    for row_id, segment, offset, length in conn.execute(
+        "SELECT id, raw_segment, raw_offset, raw_length FROM emails WHERE raw_segment IS NOT NULL"
+    ):
+        live.setdefault(segment, []).append((row_id, offset, length))
+
+    archive = get_archive(archive_dir)
+    now = time.time()
+    removed = freed = 0
+    for name in sorted(os.listdir(archive_dir)):
+        path = os.path.join(archive_dir, name)
+        # Сегмент, в который сейчас пишет этот процесс, и недавно измененные сегменты пропускаем
+        if not name.endswith(".seg") or name == archive.segment or now - os.path.getmtime(path) < grace_period:
+            continue
+
+        rows = sorted(live.get(name, []), key=lambda row: row[1])
+        size = os.path.getsize(path)
+        used = sum(length for _, _, length in rows)
+        if rows and used >= size * min_live_ratio:
+            continue
+
+        if rows:
+            updates = []
+            with open(path, "rb") as f:
+                for start in range(0, len(rows), COPY_BATCH):
+                    batch = rows[start:start + COPY_BATCH]
+                    compressed = []
+                    for _, offset, length in batch:
+                        f.seek(offset)
+                        compressed.append(f.read(length))
+                    for (row_id, offset, _), location in zip(batch, archive._write(compressed)):
+                        updates.append((*location, row_id, name, offset))
+            try:
+                conn.executemany(
+                    "UPDATE emails SET raw_segment = ?, raw_offset = ?, raw_length = ? "
+                    "WHERE id = ? AND raw_segment = ? AND raw_offset = ?",
+                    updates
+                )
+                conn.commit()
+            except sqlite3.Error:
+                conn.rollback()
+                raise
+
+        archive.forget(name)
+        os.remove(path)
+        removed += 1
+        freed += size - used
+    return removed, freed
+
+if __name__ == "__main__":
+    import create_database
+
+    archive_dir = get_archive_dir(create_database.DB_PATH)
+    conn = sqlite3.connect(create_database.DB_PATH)
+    create_database.migrate_database(conn)
+
+    segments = [name for name in os.listdir(archive_dir) if name.endswith(".seg")] if os.path.isdir(archive_dir) else []
+    total = sum(os.path.getsize(os.path.join(archive_dir, name)) for name in segments)
+    used = conn.execute("SELECT COALESCE(SUM(raw_length), 0) FROM emails WHERE raw_segment IS NOT NULL").fetchone()[0]
+    print(f"Сегментов: {len(segments)} ({total / 1024 / 1024:.1f} МБ), "
+          f"письма со ссылками из базы данных: {used / 1024 / 1024:.1f} МБ")
+
+    print("Перед сжатием импортируйте все JSON-файлы загрузки: ссылки на архив из неимпортированных файлов будут потеряны.")
+    if input("Сжать архив, удалив письма, на которые не ссылается ни одна запись? (y/n): ").lower() == 'y':
+        removed, freed = compact_archive(conn, archive_dir)
+        print(f"Удалено сегментов: {removed}, освобождено {freed / 1024 / 1024:.1f} МБ")
+    get_archive(archive_dir).close()
+    conn.close()
@@ -0,0 +1,243 @@
+"""
+Сверка сохраненных писем с почтовым ящиком на сервере
+
+С сервера запрашивается только список UID писем каждой папки (и при необходимости
+флаги писем), а не сами письма. Список сравнивается с UID, сохраненными в базе данных:
+письма, удаленные на сервере, удаляются из базы данных, письма, перемещенные
+в другую папку, переносятся в нее, не загружаясь повторно.
+"""
+import email
+import os
+import sqlite3
+
+import create_database
+from mail_to_json import (
+    email_address, fetch_emails_batch, make_email_id, open_account, parse_fetch_response,
+    search_uids, select_folder
+)
+
+def get_highest_modseq(mail):
+    """
+    Возвращает HIGHESTMODSEQ выбранной папки
+
+    Returns:
+        int: HIGHESTMODSEQ или None, если сервер не поддерживает CONDSTORE
+    """
+    result, data = mail.response("HIGHESTMODSEQ")
+    if not data or data[0] is None:
+        return None
+    return int(data[0])
+
+def fetch_flags(mail, changed_since=None):
+    """
+    Получает флаги писем выбранной папки
+
+    Args:
+        mail (imaplib.IMAP4): Соединение с выбранной папкой
+        changed_since (int): Получить флаги только писем, измененных после этого MODSEQ (CONDSTORE)
+
+    Returns:
+        dict: Словарь {UID: список флагов} или None при ошибке
+    """
+    items = "(UID FLAGS)"
+    if changed_since is not None:
+        items += f" (CHANGEDSINCE {changed_since})"
+
+    result, data = mail.uid("FETCH", "1:*", items)
+    if result != "OK":
+        print("Ошибка при получении флагов писем")
+        return None
+
+    return {
+        uid: message["flags"] for uid, message in parse_fetch_response(data).items()
+        if message["flags"] is not None
+    }
+
+def fetch_changed_flags(mail, state):
+    """
+    Получает флаги писем выбранной папки, изменившиеся после прошлой сверки
+
+    Если сервер поддерживает CONDSTORE и HIGHESTMODSEQ папки уже сохранен,
+    запрашиваются флаги только писем, измененных после прошлой сверки,
+    иначе - флаги всех писем папки.
+
+    Returns:
+        tuple: (словарь {UID: список флагов} или None при ошибке, текущий HIGHESTMODSEQ)
+    """
+    highest_modseq = get_highest_modseq(mail)
+    changed_since = state.get("highest_modseq") if state else None
+    if highest_modseq is None:
+        changed_since = None
+    elif changed_since is not None and changed_since >= highest_modseq:
+        # Флаги не изменились с прошлой сверки
+        return {}, highest_modseq
+
+    return fetch_flags(mail, changed_since), highest_modseq
+
+def fetch_message_ids(mail, uids, batch_size=1000):
+    """
+    Получает заголовки Message-ID писем выбранной папки
+
+    Returns:
+        dict: Словарь {Message-ID: UID}
+    """
+    message_ids = {}
+    for start in range(0, len(uids), batch_size):
+        batch = uids[start:start + batch_size]
+        for uid, headers in fetch_emails_batch(mail, batch, "(UID BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)])"):
+            message_id = email.message_from_bytes(headers)["Message-ID"]
+            if message_id:
+                message_ids[message_id.strip()] = uid
+    return message_ids
+
+def update_flags(conn, account, folder, flags):
+    """
+    Сохраняет флаги писем папки, если они изменились
+
+    Returns:
+        int: Количество писем с измененными флагами
+    """
+    stored = dict(conn.execute(
+        "SELECT uid, flags FROM emails WHERE account = ? AND folder = ? AND uid IS NOT NULL",
+        (account, folder)
+    ))
+    changed = [
+        (" ".join(uid_flags), account, folder, uid)
+        for uid, uid_flags in flags.items()
+        if uid in stored and stored[uid] != " ".join(uid_flags)
+    ]
+    conn.executemany("UPDATE emails SET flags = ? WHERE account = ? AND folder = ? AND uid = ?", changed)
+    return len(changed)
+
+def reconcile_account(conn, account=None, folders=None, with_flags=True):
+    """
+    Сверяет сохраненные письма почтового ящика с сервером
+
+    Args:
+        conn (sqlite3.Connection): Соединение с базой данных
+        account (str): Адрес почтового ящика; по умолчанию основной ящик EMAIL_RU
+        folders (list): Папки; по умолчанию все папки ящика, письма из которых есть в базе данных
+        with_flags (bool): Обновлять флаги писем (прочитано, отмечено и т.д.)
+
+    Returns:
+        dict: Количество удаленных, перемещенных, новых писем и писем с измененными флагами
+    """
+    account = account or email_address
+    if folders is None:
+        folders = [row[0] for row in conn.execute(
+            "SELECT DISTINCT folder FROM emails WHERE account = ? AND folder IS NOT NULL", (account,)
+        )]
+
+    stats = {"deleted": 0, "moved": 0, "new": 0, "flags": 0}
+    expunged = {}
+    new_uids = {}
+    folder_flags = {}
+
+    mail = open_account(account)
+    try:
+        for folder in folders:
+            uidvalidity = select_folder(mail, folder)
+            if uidvalidity is None:
+                continue
+
+            state = create_database.get_sync_state(conn, account, folder)
+            if state and state["uidvalidity"] != uidvalidity:
+                # UID писем переназначены: сверять по ним нельзя, папка будет загружена заново
+                print(f"{account}/{folder}: UIDVALIDITY папки изменился, сохраненные письма папки удалены")
+                create_database.reset_folder(conn, account, folder)
+                continue
+
+            server_uids = search_uids(mail, None, uidvalidity)
+            if server_uids is None:
+                continue
+            server_uids = set(server_uids)
+            stored_uids = create_database.get_stored_uids(conn, account, folder)
+
+            # Сравниваем списки UID: удалено на сервере и еще не загружено
+            for uid in stored_uids - server_uids:
+                expunged[(folder, uid)] = None
+            new_uids[folder] = (uidvalidity, sorted(server_uids - stored_uids))
+            stats["new"] += len(new_uids[folder][1])
+
+            if with_flags:
+                flags, highest_modseq = fetch_changed_flags(mail, state)
+                if flags is not None:
+                    folder_flags[folder] = (uidvalidity, flags, highest_modseq)
+
+        if expunged:
+            # Письма, удаленные из одной папки, могли появиться в другой - ищем их по Message-ID
+            for (folder, uid) in list(expunged):
+                row_id, message_id = conn.execute(
+                    "SELECT id, message_id FROM emails WHERE account = ? AND folder = ? AND uid = ?",
+                    (account, folder, uid)
+                ).fetchone()
+                expunged[(folder, uid)] = (row_id, message_id.strip() if message_id else None)
+
+            expunged_by_message_id = {
+                message_id: row_id for row_id, message_id in expunged.values() if message_id
+            }
+            moved = set()
+            merged = set()
+            for folder, (uidvalidity, uids) in new_uids.items():
+                if not uids or not expunged_by_message_id:
+                    continue
+                select_folder(mail, folder)
+                for message_id, uid in fetch_message_ids(mail, uids).items():
+                    row_id = expunged_by_message_id.pop(message_id, None)
+                    if row_id is None:
+                        continue
+                    email_id = make_email_id(uid, folder, account)
+                    cursor = conn.execute(
+                        "UPDATE OR IGNORE emails SET folder = ?, uid = ?, email_id = ? WHERE id = ?",
+                        (folder, uid, email_id, row_id)
+                    )
+                    if cursor.rowcount:
+                        moved.add(row_id)
+                    else:
+                        # Письмо в новой папке уже сохранено отдельной записью: переносим на нее
+                        # категории, а устаревшая запись удаляется вместе с удаленными письмами
+                        conn.execute(
+                            "INSERT OR IGNORE INTO email_categories (email_id, category_id) "
+                            "SELECT (SELECT id FROM emails WHERE email_id = ?), category_id "
+                            "FROM email_categories WHERE email_id = ?",
+                            (email_id, row_id)
+                        )
+                        merged.add(row_id)
+                    stats["new"] -= 1
+
+            deleted = [row_id for row_id, _ in expunged.values() if row_id not in moved]
+            create_database.delete_emails(conn, deleted)
+            stats["moved"] = len(moved) + len(merged)
+            stats["deleted"] = len(deleted) - len(merged)
+
+        # Флаги сохраняем после переноса писем, чтобы они обновились и у перемещенных писем
+        for folder, (uidvalidity, flags, highest_modseq) in folder_flags.items():
+            stats["flags"] += update_flags(conn, account, folder, flags)
+            if highest_modseq is not None:
+                create_database.save_highest_modseq(conn, account, folder, uidvalidity, highest_modseq)
+
+        conn.commit()
+    finally:
+        try:
+            mail.logout()
+        except:
+            pass
+
+    return stats
+
+if __name__ == "__main__":
+    if not os.path.exists(create_database.DB_PATH):
+        print(f"База данных {create_database.DB_PATH} не найдена. Сначала создайте базу данных.")
+    else:
+        with_flags = input("Обновить флаги писем (прочитано, отмечено)? (y/n): ").lower() == 'y'
+
+        conn = sqlite3.connect(create_database.DB_PATH)
+        create_database.migrate_database(conn)
+        try:
+            stats = reconcile_account(conn, with_flags=with_flags)
+            print(f"Удалено писем: {stats['deleted']}, перемещено: {stats['moved']}, "
+                  f"изменены флаги: {stats['flags']}, еще не загружено: {stats['new']}")
+        except Exception as e:
+            print(f"Произошла ошибка: {str(e)}")
+        finally:
+            conn.close()
@@ -0,0 +1,230 @@
+"""
+Полнотекстовый поиск писем
+
+Поиск выполняется по индексу FTS5 emails_fts (тема, отправитель и тело письма),
+который создает и поддерживает create_database.migrate_database. Результаты
+упорядочиваются по релевантности (bm25): совпадение в теме весит больше,
+чем в адресе отправителя, а совпадение в адресе - больше, чем в теле письма.
+
+В индекс попадают не исходные слова, а их основы: текст приводится к нижнему
+регистру (Unicode case folding, ё = е), а русские и английские слова сокращаются
+стеммером до основы. Так же обрабатываются слова поискового запроса, поэтому
+"Счет", "счета" и "счетов" находятся одним поиском по индексу.
+"""
+import re
+
+# Веса колонок индекса для bm25: тема, отправитель, тело письма
+SUBJECT_WEIGHT = 10.0
+SENDER_WEIGHT = 5.0
+BODY_WEIGHT = 1.0
+
+# Подзапрос, присоединяемый к emails e: ID подходящих писем и их релевантность
+# (bm25 в SQLite отрицательна - чем меньше значение, тем выше письмо в выдаче)
+FTS_JOIN_SQL = (
+    " JOIN (SELECT rowid, bm25(emails_fts, "
+    f"{SUBJECT_WEIGHT}, {SENDER_WEIGHT}, {BODY_WEIGHT}) AS rank "
+    "FROM emails_fts WHERE emails_fts MATCH ?) f ON f.rowid = e.id"
+)
+
+# Количество писем, подходящих под запрос, но не больше заданного (второй параметр):
+# подсчет останавливается на этом числе и не перебирает все совпадения
+FTS_COUNT_SQL = "SELECT COUNT(*) FROM (SELECT 1 FROM emails_fts WHERE emails_fts MATCH ? LIMIT ?)"
+
+# Слова текста: так же, как их выделяет токенизатор unicode61 (буквы и цифры, без "_")
+WORD = re.compile(r'[^\W_]+')
+
+# Элементы запроса на языке FTS5: строка в кавычках, слово или любой другой символ
+QUERY_TOKEN = re.compile(r'"[^"]*"?|[^\W_]+|.', re.DOTALL)
+
+# Операторы языка запросов FTS5 (пишутся заглавными буквами)
+QUERY_KEYWORDS = {'AND', 'OR', 'NOT', 'NEAR'}
+
+# Стеммер для русского языка по алгоритму Snowball
+RU_VOWELS = 'аеиоуыэюя'
+
+def _endings(*groups, after_a=False):
+    """Собирает окончания в регулярное выражение; after_a - окончание должно идти после "а" или "я" """
+    alternatives = '|'.join(sorted((ending for group in groups for ending in group.split()), key=len, reverse=True))
+    return f'(?<=[ая])(?:{alternatives})' if after_a else f'(?:{alternatives})'
+
+RU_PERFECTIVE_GERUND = re.compile(
+    f"(?:{_endings('в вши вшись', after_a=True)}|{_endings('ив ивши ившись ыв ывши ывшись')})$"
+)
+RU_ADJECTIVE = _endings('ее ие ые ое ими ыми ей ий ый ой ем им ым ом его ого ему ому их ых ую юю ая яя ою ею')
+RU_PARTICIPLE = f"(?:{_endings('ем нн вш ющ щ', after_a=True)}|{_endings('ивш ывш ующ')})"
+RU_ADJECTIVAL = re.compile(f'{RU_PARTICIPLE}?{RU_ADJECTIVE}$')
+RU_REFLEXIVE = re.compile('(?:ся|сь)$')
+RU_VERB = re.compile(
+    f"(?:{_endings('ла на ете йте ли й л ем н ло но ет ют ны ть ешь нно', after_a=True)}|"
+    f"{_endings('ила ыла ена ейте уйте ите или ыли ей уй ил ыл им ым ен ило ыло ено ят ует уют ит ыт ены ить ыть ишь ую ю')})$"
+)
+RU_NOUN = re.compile(
+    f"{_endings('а ев ов ие ье е иями ями ами еи ии и ией ей ой ий й иям ям ием ем ам ом о у ах иях ях ы ь ию ью ю ия ья я')}$"
+)
+RU_SUPERLATIVE = re.compile('(?:ейше|ейш)$')
+RU_DERIVATIONAL = re.compile('(?:ость|ост)$')
+
+def _region(word, start=0):
+    """Возвращает начало области R1 (R2 при start = R1): после первой согласной, следующей за гласной"""
+    for i in range(start + 1, len(word)):
+        if word[i] not in RU_VOWELS and word[i - 1] in RU_VOWELS:
+            return i + 1
+    return len(word)
+
+def stem_russian(word):
+    """
+    Возвращает основу русского слова (алгоритм Snowball для русского языка)
+
+    Args:
+        word (str): Слово в нижнем регистре, ё заменена на е
+    """
+    match = re.search(f'[{RU_VOWELS}]', word)
+    if not match:
+        return word
+    # Окончания ищутся в области RV - после первой гласной
+    prefix, rv = word[:match.end()], word[match.end():]
+
+    # Шаг 1: деепричастие, иначе возвратная частица и окончание прилагательного, глагола или существительного
+    stemmed = RU_PERFECTIVE_GERUND.sub('', rv, count=1)
+    if stemmed == rv:
+        rv = RU_REFLEXIVE.sub('', rv, count=1)
+        for pattern in (RU_ADJECTIVAL, RU_VERB, RU_NOUN):
+            stemmed = pattern.sub('', rv, count=1)
+            if stemmed != rv:
+                break
+    rv = stemmed
+
+    # Шаг 2: окончание "и"
+    if rv.endswith('и'):
+        rv = rv[:-1]
+
+    # Шаг 3: словообразовательный суффикс "ость" в области R2
+    word = prefix + rv
+    match = RU_DERIVATIONAL.search(rv)
+    if match and len(prefix) + match.start() >= _region(word, _region(word)):
+        rv = rv[:match.start()]
+
+    # Шаг 4: превосходная степень, двойное "н" и мягкий знак
+    stemmed = RU_SUPERLATIVE.sub('', rv, count=1)
+    if stemmed != rv or rv.endswith('нн'):
+        rv = stemmed[:-1] if stemmed.endswith('нн') else stemmed
+    elif rv.endswith('ь'):
+        rv = rv[:-1]
+
+    return prefix + rv
+
+EN_VOWELS = 'aeiouy'
+
+def stem_english(word):
+    """
+    Возвращает основу английского слова
+
+    Упрощенный стеммер Портера (шаг 1): отбрасываются окончания множественного числа,
+    -ed, -ing и конечная -y. Этого достаточно, чтобы reports/report, meeting/meet
+    и invoices/invoice совпадали при поиске.
+
+    Args:
+        word (str): Слово в нижнем регистре
+    """
+    if len(word) <= 3:
+        return word
+
+    # Множественное число
+    if word.endswith('sses'):
+        word = word[:-2]
+    elif word.endswith('ies'):
+        word = word[:-2]
+    elif word.endswith('s') and not word.endswith(('ss', 'us', 'is')):
+        word = word[:-1]
+
+    # Прошедшее время и причастия
+    if word.endswith('eed'):
+        if len(word) > 4:
+            word = word[:-1]
+    else:
+        for ending in ('ing', 'ed'):
+            stem = word[:-len(ending)]
+            if word.endswith(ending) and any(letter in EN_VOWELS for letter in stem) and len(stem) > 2:
+                word = stem
+                if word.endswith(('at', 'bl', 'iz')):
+                    word += 'e'
+                elif len(word) > 2 and word[-1] == word[-2] and word[-1] not in 'lsz' + EN_VOWELS:
+                    word = word[:-1]
+                break
+
+    # Конечная -y после согласной
+    if word.endswith('y') and len(word) > 2 and word[-2] not in EN_VOWELS:
+        word = word[:-1] + 'i'
+
+    return word
+
+def normalize_word(word):
+    """Приводит слово к виду, в котором оно хранится в индексе: нижний регистр и основа слова"""
+    word = word.casefold().replace('ё', 'е')
+    if re.search('[а-я]', word):
+        return stem_russian(word)
+    if re.fullmatch('[a-z]+', word):
+        return stem_english(word)
+    return word
+
+def search_text(text):
+    """
+    Приводит текст к виду, в котором он записывается в полнотекстовый индекс
+
+    Регистрируется в соединении как SQL-функция search_text и вызывается
+    триггерами индекса emails_fts (см. create_database.register_functions).
+
+    Returns:
+        str: Основы слов текста через пробел или None, если текста нет
+    """
+    if text is None:
+        return None
+    return ' '.join(normalize_word(word) for word in WORD.findall(text))
+
+def _normalize_syntax_query(query):
+    """Приводит слова запроса на языке FTS5 к виду слов индекса, не затрагивая операторы"""
+    tokens = QUERY_TOKEN.findall(query)
+    result = []
+    in_columns = False
+    for i, token in enumerate(tokens):
+        following = ''.join(tokens[i + 1:i + 3]).lstrip()
+        if token.startswith('"'):
+            token = '"' + ' '.join(normalize_word(word) for word in WORD.findall(token)) + '"'
+        elif token in '{}':
+            # Список колонок: {subject sender}: отчет
+            in_columns = token == '{'
+        elif WORD.fullmatch(token) and token not in QUERY_KEYWORDS and not in_columns \
+                and not following.startswith(':'):
+            token = normalize_word(token)
+        result.append(token)
+    return ''.join(result).strip()
+
+def make_match_query(query, syntax=False):
+    """
+    Преобразует поисковый запрос в выражение MATCH для FTS5
+
+    По умолчанию запрос считается обычным текстом: письмо должно содержать все слова
+    запроса в любой форме, последнее слово ищется как начало слова (удобно при наборе
+    запроса). Знаки препинания и операторы FTS5 в таком запросе не действуют.
+
+    При syntax=True в запросе доступен синтаксис FTS5: OR, NOT, AND, "точная фраза",
+    префикс*, поиск по колонке (subject: отчет, sender: ivan), NEAR(слово1 слово2, 5);
+    слова запроса так же приводятся к основам. Ошибка в таком запросе
+    приводит к sqlite3.OperationalError при выполнении поиска.
+
+    Args:
+        query (str): Поисковый запрос
+        syntax (bool): Запрос написан на языке запросов FTS5
+
+    Returns:
+        str: Выражение MATCH или None, если в запросе нет ни одного слова
+    """
+    if syntax:
+        return _normalize_syntax_query(query) or None
+
+    words = WORD.findall(query)
+    if not words:
+        return None
+    terms = [f'"{normalize_word(word)}"' for word in words]
+    terms[-1] += '*'
+    return ' '.join(terms)
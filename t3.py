@@ -2,18 +2,16 @@ import imaplib, email, base64, os, json
 
 from dotenv import load_dotenv, dotenv_values
 
-load_dotenv()
-
+from mail_to_json import connect_imap
 
-mail_server = "imap.mail.ru"
-mail_port = 993
+load_dotenv()
 
 
 email_address = os.getenv("EMAIL_RU")
 app_password = os.getenv("PASSWORD_RU")
 
 
-mail = imaplib.IMAP4_SSL(mail_server, mail_port)
+mail = connect_imap()
 
 try:
     mail.login(email_address, app_password)
@@ -3,15 +3,16 @@ import email
 import base64
 import os
 import json
+import sqlite3
 from email.header import decode_header
 from datetime import datetime
 
 from dotenv import load_dotenv, dotenv_values
 
-load_dotenv()
+import create_database
+from mail_to_json import connect_imap, make_email_id, select_folder, search_uids
 
-mail_server = "imap.mail.ru"
-mail_port = 993
+load_dotenv()
 
 email_address = os.getenv("EMAIL_RU")
 app_password = os.getenv("PASSWORD_RU")
@@ -61,32 +62,50 @@ def get_email_body(msg):
 
     return "[Тело письма не найдено]", "text/plain"
 
-def get_all_emails():
-    """Получает все письма из почтового ящика"""
+def get_all_emails(incremental=False):
+    """
+    Получает все письма из почтового ящика
+
+    Args:
+        incremental (bool): Получать только письма, появившиеся после последней синхронизации
+            базы данных (mail_to_json.py, mail_to_db.py). Письма этого скрипта в базу данных
+            не сохраняются, поэтому отметка синхронизации здесь только читается
+    """
+    conn = None
     try:
         # Подключаемся к почтовому серверу
-        mail = imaplib.IMAP4_SSL(mail_server, mail_port)
+        mail = connect_imap()
         mail.login(email_address, app_password)
 
         # Выбираем папку "Входящие"
-        mail.select("INBOX")
-
-        # Ищем все письма
-        status, messages = mail.search(None, "ALL")
-
-        if status != "OK":
-            print("Ошибка при поиске писем")
+        uidvalidity = select_folder(mail, "INBOX")
+
+        # Загружаем состояние прошлой синхронизации
+        state = None
+        if incremental:
+            conn = sqlite3.connect(create_database.DB_PATH)
+            create_database.migrate_database(conn)
+            state = create_database.get_sync_state(conn, email_address, "INBOX")
+            if state and state["uidvalidity"] != uidvalidity:
+                # UID писем на сервере переназначены, сохраненные письма папки устарели
+                print("UIDVALIDITY папки изменился, выполняется полная синхронизация")
+                create_database.reset_folder(conn, email_address, "INBOX")
+                state = None
+
+        # Ищем все письма (или только новые)
+        email_ids = search_uids(mail, state, uidvalidity)
+
+        if email_ids is None:
             return []
 
-        email_ids = messages[0].split()
         print(f"Найдено {len(email_ids)} писем")
 
         all_emails = []
 
         # Обрабатываем каждое письмо
         for e_id in email_ids:
-            # Получаем письмо по ID
-            status, msg_data = mail.fetch(e_id, "(RFC822)")
+            # Получаем письмо по UID
+            status, msg_data = mail.uid("FETCH", str(e_id), "(RFC822)")
 
             if status != "OK":
                 print(f"Ошибка при получении письма {e_id}")
@@ -112,7 +131,7 @@ def get_all_emails():
 
             # Создаем структуру для хранения информации о письме
             email_info = {
-                "id": e_id.decode(),
+                "id": make_email_id(e_id, "INBOX", email_address),
                 "subject": subject,
                 "from": from_addr,
                 "date": date_formatted,
@@ -133,6 +152,10 @@ def get_all_emails():
         print(f"Произошла ошибка: {str(e)}")
         return []
 
+    finally:
+        if conn:
+            conn.close()
+
 # Получаем все письма
 emails = get_all_emails()
 
@@ -1,9 +1,12 @@
+import asyncio
+
 from fastapi import FastAPI, Request
 from fastapi.responses import RedirectResponse
 from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy import  Column, Integer, String
 from sqlalchemy.orm import Session
 from fastapi.templating import Jinja2Templates
+from email_manager import EmailManager
 
 # Создай подключение к базе данных
 from sqlalchemy import create_engine
@@ -19,7 +22,8 @@ class Email(Base):
     subject = Column(String)
     sender = Column(String)
     date = Column(String)
-    body = Column(String)
+    # Тело письма хранится в таблице email_bodies, в списке писем - только краткий текст
+    preview = Column(String)
 
 
 # Создаем экземпляр приложения
@@ -62,6 +66,11 @@ async def read_email(request: Request, email_id: int):
             # Если письмо не найдено, перенаправляем на главную страницу
             return RedirectResponse(url="/")
 
+        # Тело письма читаем из таблицы email_bodies; если письмо сохранено
+        # только с заголовками, оно загружается с сервера - в отдельном потоке,
+        # чтобы медленный почтовый сервер не останавливал обработку других запросов
+        email = await asyncio.to_thread(EmailManager().get_email_by_id, email.id)
+
         # Отображаем страницу с деталями письма
         return templates.TemplateResponse(
             "detail.html", {"request": request, "email": email}
@@ -0,0 +1,88 @@
+"""
+Проверка инкрементальной загрузки async_ingest.py на локальном IMAP-сервере (fake_imap.py)
+
+Запуск: python -m unittest test_async_ingest
+"""
+import asyncio
+import contextlib
+import functools
+import io
+import os
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+import async_ingest
+import create_database
+import mail_to_json
+import raw_archive
+from fake_imap import FakeIMAPServer, Mailbox, make_message
+
+ACCOUNT_EMAIL = "test@example.ru"
+
+
+class IncrementalIngestTest(unittest.TestCase):
+    """Инкрементальная загрузка сохраняет в базу данных все письма, отмеченные в sync_state"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp.name, "emails.db")
+        self.output_file = os.path.join(self.tmp.name, "emails.ndjson")
+
+        self.db_path_saved, create_database.DB_PATH = create_database.DB_PATH, self.db_path
+        with contextlib.redirect_stdout(io.StringIO()):
+            create_database.create_database()
+
+        self.mailbox = Mailbox(5)
+        self.server = FakeIMAPServer(self.mailbox).start()
+        # Локальный сервер работает без SSL
+        self.patch = mock.patch.object(
+            async_ingest, "connect_imap", functools.partial(mail_to_json.connect_imap, use_ssl=False)
+        )
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+        self.server.stop()
+        create_database.DB_PATH = self.db_path_saved
+        raw_archive.get_archive(raw_archive.get_archive_dir(self.db_path)).close()
+        self.tmp.cleanup()
+
+    def ingest(self):
+        account = {
+            "name": "TEST", "email": ACCOUNT_EMAIL, "password": "test",
+            "server": "127.0.0.1", "port": self.server.port,
+            "folders": ["INBOX"], "max_connections": 2,
+        }
+        with contextlib.redirect_stdout(io.StringIO()):
+            return asyncio.run(async_ingest.ingest_all(
+                [account], self.output_file, max_emails=100, batch_size=2, incremental=True
+            ))
+
+    def stored_uids(self):
+        conn = sqlite3.connect(self.db_path)
+        try:
+            uids = create_database.get_stored_uids(conn, ACCOUNT_EMAIL, "INBOX")
+            state = create_database.get_sync_state(conn, ACCOUNT_EMAIL, "INBOX")
+        finally:
+            conn.close()
+        return uids, state
+
+    def test_incremental_runs_store_every_message(self):
+        self.assertTrue(self.ingest())
+        uids, state = self.stored_uids()
+        self.assertEqual(uids, {1, 2, 3, 4, 5})
+        self.assertEqual(state["last_uid"], 5)
+
+        # Файл загрузки перезаписывается, письма первого запуска должны остаться в базе данных
+        for number in range(6, 9):
+            self.mailbox.append("INBOX", make_message(number))
+        self.assertTrue(self.ingest())
+        uids, state = self.stored_uids()
+        self.assertEqual(uids, set(range(1, 9)))
+        self.assertEqual(state["last_uid"], 8)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,167 @@
+"""
+Проверка планов запросов приложения (EXPLAIN QUERY PLAN)
+
+Схема базы данных создается во временном каталоге, а проверяются те же SQL-константы
+и построители запросов, которые выполняют app.py, email_manager.py и модули загрузки.
+Запрос не должен просматривать таблицу или индекс целиком (SCAN) вместо поиска
+по индексу (SEARCH) - обычно это значит, что для запроса не хватает индекса.
+
+Запуск: python -m unittest test_query_plans
+"""
+import os
+import sqlite3
+import tempfile
+import unittest
+
+import create_database
+import email_manager
+import pagination
+import search
+
+# Допустимые строки плана SCAN задаются началом строки: "SCAN c" допускает и "SCAN c USING INDEX ...".
+# Список писем просматривает индекс по дате по порядку и останавливается по LIMIT.
+LIST_SCANS = ("SCAN e USING INDEX idx_emails_date_ts",)
+# Поиск в полнотекстовом индексе (MATCH) выполняет модуль FTS5
+FTS_SCANS = ("SCAN emails_fts VIRTUAL TABLE INDEX 0:M3",)
+# Поиск по подстроке (LIKE '%...%') в индексе не выполняется - небольшую таблицу отправителей просматриваем
+SENDER_SCANS = ("SCAN senders",)
+
+# SQL-константы: (название, SQL, допустимые строки плана SCAN)
+# Подсчет найденных писем перебирает результаты подзапроса с LIMIT - не больше заданного числа строк.
+# Категории писем страницы ищутся по ID из JSON-массива: json_each перебирает только переданные ID
+CONSTANT_QUERIES = [
+    ("Счетчики писем", create_database.COUNTERS_SQL, ()),
+    ("Категории с количеством писем", create_database.CATEGORY_STATS_SQL, ("SCAN c",)),
+    ("Топ отправителей", create_database.TOP_SENDERS_SQL, ()),
+    ("Топ доменов", create_database.TOP_DOMAINS_SQL, ()),
+    ("Категории писем страницы", create_database.EMAIL_CATEGORIES_SQL, ("SCAN json_each",)),
+    ("Тела писем страницы", create_database.EMAIL_BODIES_SQL, ("SCAN json_each",)),
+    ("Количество найденных писем", search.FTS_COUNT_SQL, FTS_SCANS + ("SCAN (subquery-1)",)),
+]
+
+# Ключи курсора страницы списка писем: первая страница, письмо с датой, письмо без даты
+LIST_KEYS = [None, [1700000000, 10], [None, 10]]
+
+
+def explain(conn, sql, params=None):
+    """
+    Возвращает план запроса
+
+    Параметры без значений подставляются фиктивные - на план они не влияют.
+
+    Returns:
+        list: Строки плана EXPLAIN QUERY PLAN
+    """
+    if params is None:
+        params = [1] * sql.count('?')
+    return [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+
+
+class QueryPlanTest(unittest.TestCase):
+    """Запросы приложения используют индексы"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp.name, "emails.db")
+
+        db_path, create_database.DB_PATH = create_database.DB_PATH, self.db_path
+        try:
+            create_database.create_database()
+        finally:
+            create_database.DB_PATH = db_path
+
+        self.conn = sqlite3.connect(self.db_path)
+        create_database.migrate_database(self.conn)
+        create_database.register_functions(self.conn)
+
+    def tearDown(self):
+        self.conn.close()
+        self.tmp.cleanup()
+
+    def assertUsesIndexes(self, name, sql, allowed_scans=(), params=None):
+        """Проверяет, что в плане запроса нет SCAN, кроме допустимых"""
+        for detail in explain(self.conn, sql, params):
+            if not detail.startswith("SCAN ") or detail == "SCAN CONSTANT ROW":
+                continue
+            if not any(detail == allowed or detail.startswith(allowed + " ") for allowed in allowed_scans):
+                self.fail(f"{name}: {detail}\n{sql}")
+
+    def test_constants(self):
+        for name, sql, allowed_scans in CONSTANT_QUERIES:
+            with self.subTest(name):
+                self.assertUsesIndexes(name, sql, allowed_scans)
+
+    def test_page_queries(self):
+        for key in LIST_KEYS:
+            for direction in (pagination.NEXT, pagination.PREV):
+                for condition, _, order in pagination._list_queries(key, direction):
+                    name = f"Страница списка писем: {key} {direction} {condition}"
+                    for with_offset in ((False, True) if key is None else (False,)):
+                        with self.subTest(name, offset=with_offset):
+                            sql = pagination.page_sql(None, condition, order, with_offset)
+                            self.assertUsesIndexes(name, sql, LIST_SCANS if not condition else ())
+
+        for key in (None, [-1.5, 10]):
+            for direction in (pagination.NEXT, pagination.PREV):
+                for condition, _, order in pagination._search_queries(key, direction):
+                    name = f"Страница результатов поиска: {key} {direction}"
+                    with self.subTest(name):
+                        self.assertUsesIndexes(name, pagination.page_sql("отчет", condition, order), FTS_SCANS)
+
+    def test_search_emails(self):
+        filters = [
+            ("Последние письма", {}, LIST_SCANS),
+            ("Полнотекстовый поиск", {"match": "отчет"}, FTS_SCANS),
+            ("Письма отправителя", {"sender": "ivanov"}, SENDER_SCANS),
+            ("Письма за период", {"date_from": "2025-01-01", "date_to": "2025-01-31"}, ()),
+            ("Необработанные письма", {"processed": False}, ()),
+            ("Письма категории", {"category": "Работа"}, ()),
+        ]
+        for name, kwargs, allowed_scans in filters:
+            with self.subTest(name):
+                sql, params = email_manager.build_search_query(**kwargs)
+                self.assertUsesIndexes(name, sql, allowed_scans, params)
+
+    def test_traced_queries(self):
+        """Запросы, которые выполняются внутри функций сохранения и чтения писем"""
+        statements = []
+        self.conn.set_trace_callback(statements.append)
+
+        email = {
+            "id": "a@b.ru/INBOX/1", "account": "a@b.ru", "folder": "INBOX", "uid": 1,
+            "subject": "Отчет", "from": "Иванов <ivanov@b.ru>", "date": "2025-01-02 10:00:00",
+            "body": "Квартальный отчет",
+            "attachments": [{"filename": "report.pdf", "content_type": "application/pdf",
+                             "sha256": "0" * 64, "size": 1}],
+        }
+        create_database.store_emails(self.conn, [email])
+        create_database.store_attachments(self.conn, [email])
+        self.conn.commit()
+        row_id = self.conn.execute("SELECT id FROM emails WHERE email_id = ?", (email["id"],)).fetchone()[0]
+        create_database.get_stored_uids(self.conn, "a@b.ru", "INBOX")
+
+        manager = email_manager.EmailManager(self.db_path)
+        connect = manager.connect
+
+        def traced_connect():
+            conn = connect()
+            conn.set_trace_callback(statements.append)
+            return conn
+
+        manager.connect = traced_connect
+        self.assertIsNotNone(manager.get_email_by_id(row_id))
+
+        self.conn.set_trace_callback(None)
+        # Запросы модуля FTS5 к его собственным таблицам ('main'.'emails_fts_...') не проверяем
+        queries = [
+            sql for sql in statements
+            if sql.lstrip().upper().startswith(("SELECT", "INSERT", "UPDATE", "DELETE")) and "'main'." not in sql
+        ]
+        self.assertTrue(queries)
+        for sql in queries:
+            with self.subTest(sql):
+                self.assertUsesIndexes("Запрос", sql, ("SCAN json_each",), params=())
+
+
+if __name__ == "__main__":
+    unittest.main()